@@ -10,6 +10,7 @@
 # Compatible ADCs:
 #       MCP3421 - MCP3428
 #       ADS1013 - ADS1015
+#       ADS1113 - ADS1115
 #       Tested MCP3421 on Linux MCU
 #       Tested ADS1015 on Linux MCU
 #############################################################
@@ -23,309 +24,339 @@
 ##  The i2c address that the chip is using on the i2c bus. This
 ##  parameter must be provided.
 #i2c_bus: i2c.1
+#i2c_speed: (default = 100000)
+##  Bus clock in Hz, up to 400000 (fast mode) on all supported chips.
+##  On a Linux MCU the kernel sets the bus clock, set i2c_speed to the
+##  same value so the scan timing matches.
 #sensor_ID: e.g. ADS1015
 ## (Optional config: see device manual)
-#resolution: (default = 12)
+#resolution: (default = 12, 16 for ADS111x)
 #gain: (default = 1)
-#channel: (default = 1 (channel 0))
-#rate: (default = 1600 for ADS101x, none for MCP342x)
+#channel: (default = 1, AIN0-AIN1 on ADS1x1x, CH1 on MCP342x)
+##  Input of the "external_adc_name:" pin, an input name or the
+##  number N of mux setting N-1 (see the pin names below)
+#rate: (default = 1600 for ADS101x, 128 for ADS111x, none for MCP342x)
 #report_time: (default 2 readings/second)
 
+# The chip is run in continuous conversion mode and its conversion
+# register is polled at the data rate (up to 3300 SPS on ADS101x,
+# 240 SPS on MCP342x). Readings are reported every report_time.
+# Every reading carries the estimated end time of its conversion
+# (reactor time). Scanned channels, ready_pin and mcu_sampling know the
+# conversion phase, a single MCP342x channel tracks it through the RDY
+# bit; a single ADS1x1x channel in continuous conversion is stamped
+# half a conversion before its read. At 100 kHz the bus
+# limits a single ADS101x input to about 2700 SPS. A scan of several
+# inputs waits a conversion (plus the oscillator tolerance) after every
+# mux switch, at 3300 SPS it gets about 800 readings/s at 100 kHz and
+# 1800 readings/s at i2c_speed: 400000. Only a single input reaches
+# the full data rate, at 400 kHz.
+
+#ready_pin: (default = none, ADS101x/ADS111x only)
+##  MCU pin wired to ALERT/RDY, e.g. ^rpi:gpio17. The chip then runs
+##  single-shot conversions and every falling edge of the pin starts
+##  the read of the finished conversion. The edge is seen through the
+##  button polling of the MCU (every 2 ms), which limits the rate to
+##  a few hundred conversions per second. Above about 500 SPS the
+##  polling misses the pin going high, the stream then reads the
+##  conversion once the pin is still low two polls later.
+#comparator: (default = False, ADS101x/ADS111x only)
+##  With ready_pin wired to ALERT/RDY and report_deadband or
+##  report_thresholds set, run the chip in continuous conversion with
+##  its window comparator set around the last reported value. The bus
+##  stays quiet until ALERT fires (or report_heartbeat passed), then
+##  the conversion is read and the window moves. One input per chip.
+#mcu_sampling: (default = False)
+##  Let the MCU run the reads on its own clock and send the raw
+##  frames back in bulk messages. Requires sensor_i2c_adc.c in the
+##  MCU firmware. Conversions the MCU skipped because its previous
+##  read was still running count as overruns in I2C_ADC_STATS.
+#history_size: (default = 1024)
+##  Number of readings kept per channel for get_last_value and
+##  history consumers
+#filter_median: (default = 0, off)
+##  Median of the last N readings, rejects single reading spikes
+#filter_average: (default = 1, newest reading only)
+##  Moving average over the last N readings. 0 averages all readings
+##  of each report period (oversampling)
+#filter_lowpass: (default = 0, off)
+##  Cutoff frequency in Hz of a first order IIR low-pass filter
+#report_deadband: (default = 0, report every report_time)
+##  Only call the user of a pin when its filtered value moved by at
+##  least this much since the last call, when it crossed one of
+##  report_thresholds or when report_heartbeat passed. Not for pins
+##  driving heaters, they need every report.
+#report_thresholds: (default = none)
+##  Comma separated values, crossing one of them is always reported
+#report_heartbeat: (default = 5)
+##  Longest time in seconds between two calls with report_deadband or
+##  report_thresholds, 0 for none
+#adaptive: (default = False)
+##  Pick data rate and resolution at runtime from the report_time,
+##  sample rate and filter bandwidth of the users and from the slope
+##  and noise of the signal: fast 12 bit sampling while the signal
+##  moves, slow high resolution sampling while it is steady. The
+##  configured resolution and rate are used until the first update.
+#autorange: (default = False)
+##  Step the PGA gain of every channel up while its readings use less
+##  than AUTORANGE_UP of the range at the next gain and down as soon
+##  as a reading exceeds AUTORANGE_DOWN of the range. gain is the
+##  starting point. Not available with mcu_sampling and on ADS1013/ADS1113.
+#offload: (default = False)
+##  Decode, filter and capture the readings in a worker thread shared
+##  by all chips with offload set; the reactor only matches the bus
+##  responses and runs the callbacks of the users, which arrive up to
+##  20ms later. For installs with many channels at high rates. Not
+##  with autorange or comparator.
+#ch2_gain: (default = gain)
+#ch2_sample_rate: (default = equal share of the scan)
+##  Optional per channel settings for the round-robin scanner, chN
+##  is mux setting N-1 (ch5 is AIN0 on ADS1015/ADS1115)
+#ch1_calibration: (default = none)
+##  Offset and gain correction of channel N, one "gain, offset,
+##  factor" line per PGA gain: value = (volts - offset) * factor
+#ch1_linearization: (default = none)
+##  Optional mapping of the corrected volts of channel N to the value
+##  of the sensor, "poly, c0, c1, c2, ..." for c0 + c1*v + c2*v^2 + ...
+##  or "table" followed by "v, value" lines for a piecewise linear
+##  curve. Calibrated channels report (and range check) this value
+##  instead of volts; the correction costs nothing per reading, it is
+##  folded into a lookup table per gain at setup. adaptive assumes
+##  volts and should not be combined with a linearization.
+
+# Statistics of every chip are available as
+# printer["i2c_adc external_adc_name"].stats (and .channels for the per
+# channel counters) and are printed by
+#   I2C_ADC_STATS CHIP=external_adc_name [RESET=1]
+
+# Calibration points are taken from the readings of a channel in use:
+#   I2C_ADC_CALIBRATE CHIP=name [CHANNEL=input] VALUE=v [SAMPLES=16]
+# averages the raw counts of the next SAMPLES readings with v as the
+# true value. FIT=gain turns the points into chN_calibration (VALUE in
+# volts, two or more points per gain, one point only corrects the
+# offset), FIT=poly [DEGREE=1] or FIT=table into chN_linearization
+# (VALUE in units of the sensor, taken after the gain fit). A fit is
+# used at once and stored by SAVE_CONFIG; RESET=1 drops the points.
+
+# Readings of one or more chips can be captured into a binary file:
+#   ADC_CAPTURE CHIP=name1[,name2] [CHANNEL=AIN0[,AIN1]] [DURATION=s]
+#       [SAMPLES=n] [FILE=path] [WAIT=1]
+# CHANNEL takes input names or numbers like the channel option. The
+# raw counts are stored as fixed size records (see ADC_capture).
+
 # a virtual adc chip is created. 
 # The adc pin can be accessed as "external_adc_name:"
 # e.g. pin: external_adc_name:
+# Further inputs of the chip are available by name
+#   ADS1015/ADS1115: AIN0-AIN1, AIN0-AIN3, AIN1-AIN3, AIN2-AIN3
+#                    (differential), AIN0 ... AIN3 (against GND)
+#   ADS1x13/ADS1x14: AIN0-AIN1 only
+#   MCP342x:         CH1 ... CH4 (each a differential pair)
+# e.g. pin: external_adc_name:AIN2-AIN3 for a bridge sensor, or as
+# "external_adc_name:chN" for mux setting N-1.
+# All channels of a chip are scanned round-robin by a single stream.
+# Several pins may use the same input (e.g. a heater and a
+# temperature_sensor): they share its readings, each with its own
+# report_time and filter, without extra bus traffic. The channel is
+# sampled for the fastest of them and their range checks are combined.
+# A channel joins the scan on its first use (ADC callback or
+# get_last_value); chips without used channels are not touched at
+# startup. All chips are configured in one pipelined connect step,
+# its duration is reported in printer["i2c_adc_startup"].
+# The minval/maxval range check requested by the users of a pin (e.g.
+# heaters) is applied to every streamed reading on its raw counts;
+# range_check_count readings in a row outside of the range shut the
+# printer down.
+# Failed reads (no response, failed on the bus, MCP342x readings of an
+# unfinished conversion or of another channel) are dropped and
+# retried; after a few in a row the chip is reconfigured with a
+# growing backoff. Every event is counted in the stats (timeouts,
+# nacks, stale, retries, recoveries).
 
 #Standard Adresses are:
 # MCP3421: 104 (hex: 0x68)
 # ADS1015: 72 (hex: 0x48)
+# Register layouts of the chips are described in i2c_adc_core.py.
 
-## ADS10XX: ##
-# Second Byte: Address pointer
-# 0 0 0 0 0 0 P1 P2
-#             0  0: Conversion register
-#             0  1: Config register
-#             1  0: Lo_threshold
-#             1  1: Hi_threshold
-
-# Config register
-# 0  0  0  0  0  0  0  0
-# 15 14 13 12 11 10 9  8
-# OS [  MUX ] [ PGA  ] Mode
-# ----------------------
-# 0  0  0  0  0  0  0  0
-# 7  6  5  4  3  2  1  0
-# [  DR ] CM  CP CL [CQ]
-#
-# OS: Operational Status (write 1 for single shot)
-# MUX:                  000: AIN0+AIN1 (def)
-# Input Multiplexer     001: AIN0+AIN3
-# (ADS1015 only)        010: AIN1+AIN3
-#                       011: AIN2+AIN3
-#                       100: AIN0+GND
-#                       101: AIN1+GND
-#                       110: AIN2+GND
-#                       111: AIN3+GND
-# PGA:                  000: FSR = +- 6.144 V (Gain 0.25)
-# No function on        001: FSR = +- 4.096 V (Gain 0.5)
-# ADS1013               010: FSR = +- 2.048 V (def)
-#                       011: FSR = +- 1.024 V (Gain 2)
-#                       100: FSR = +- 0.512 V (Gain 4)
-#                       101: FSR = +- 0.256 V (Gain 8)
-#                       110: FSR = +- 0.256 V
-#                       111: FSR = +- 0.256 V
-# Mode:                 0: continuous conversion
-#                       1: single shot
-# DR:                    000: 128 SPS
-# Data rate             001: 250 SPS
-#                       010: 490 SPS
-#                       011: 920 SPS
-#                       100: 1600 SPS (def)
-#                       101: 2400 SPS
-#                       110: 3300 SPS
-#                       111: 3300 SPS
-## MCP34XX: ##
-# 7th bit: OS (1 start new conversion, no function in continuous)
-# 6+5th bit: address bits (not used in mcp3425)
-# 4th bit: mode (0: one shot mode, 1: continuous)
-# 3rd+2nd bit: sample rate (10: 15 ms, 16 bit)
-# 1st+0th bit: gain selection (00: gain = 1)
-
-
-from . import bus
+from . import i2c_adc_core
 import pins
 import mcu
 import logging
 
-SUPP_DEV_18 = ['MCP3421', 'MCP3422', 'MCP3423', 'MCP3424']
-SUPP_DEV_16 = ['MCP3425', 'MCP3426', 'MCP3427', 'MCP3428']
-SUPP_DEV_12 = ['ADS1013', 'ADS1014', 'ADS1015']
-
-VREF = 2.048
-
-N_CHANNELS = {
-    'MCP3421': 1,
-    'MCP3422': 2,
-    'MCP3423': 3,
-    'MCP3424': 4,
-    'MCP3425': 1,
-    'MCP3426': 2,
-    'MCP3427': 3,
-    'MCP3428': 4,
-    'ADS1013': 1,
-    'ADS1014': 1,
-    'ADS1015': 8,
-}
-
-# ADS1013 does not have PGA
-ADS_GAIN = {
-    0.25: 0,
-    0.5: 1,
-    1: 2,
-    2: 3,
-    4: 4,
-    8: 5
-}
-
-MCP_GAIN = {
-    1: 0,
-    2: 1,
-    4: 2,
-    8: 3
-}
-
-MCP_RATE = {
-    240: (12,0),
-    60: (14,1),
-    15: (16,2),
-    3.75: (18,3)
-}
-
-MCP_RES = {
-    12: (240,0),
-    14: (60,1),
-    16: (15,2),
-    18: (3.75,3)
-}
-
-MCP_CHANNEL = {
-    1: 0b00000000,
-    2: 0b00100000,
-    3: 0b01000000,
-    4: 0b01100000
-}
-
-ADS_RATE = {
-    128: 0,
-    250: 1,
-    490: 2,
-    920: 3,
-    1600: 4,
-    2400: 5,
-    3300: 6,
-    3300: 7
-}
-
-DEFAULT_RATE = {
-    'MCP': 240,
-    'ADS': 1600,
-}
-
-class i2c_adc:
+class i2c_adc(i2c_adc_core.ADC_chip):
     def __init__(self, config):
-        self.printer = config.get_printer()
-        self.reactor = self.printer.get_reactor()
-        self.name = config.get_name().split()[-1]
-        self.i2c = bus.MCU_I2C_from_config(config,
-                    default_speed=100000)
-        self.mcu = self.i2c.get_mcu()
+        i2c_adc_core.ADC_chip.__init__(self, config)
         # Register Chip
         ppins = self.printer.lookup_object('pins')
         ppins.register_chip(self.name, self)
         self.reportTime = config.getfloat('report_time',2)
-        self.deviceId = config.get('sensor_ID').upper()
-        # Check if device is supported
-        if self.deviceId not in SUPP_DEV_18 and \
-                self.deviceId not in SUPP_DEV_16 and \
-                self.deviceId not in SUPP_DEV_12:
-            raise config.error(self.deviceId + " not supported")
-        self.devicePrefix = self.deviceId[0:3]
-        self.channel = config.getint('channel',minval=1,
-                            maxval=N_CHANNELS[self.deviceId],
-                            default=1)-1
-        self.gain = config.get('gain',1)
-        # Check if gain is supported
-        if self.gain not in eval(self.devicePrefix + "_GAIN"):
-            raise config.error("Invalid PGA setting")
-        self.resolution = config.getint('resolution',12)
-        #Check if selected resolution is correct/supported
-        if self.resolution not in [12, 14, 16, 18]:
-            raise config.error("Invalid resolution")
-        elif self.resolution == 18 and \
-                self.deviceId not in SUPP_DEV_18:
-            raise config.error("18 bit sampling not supported by " +
-                            self.deviceId)
-        elif self.resolution != 12 and \
-                self.deviceId in SUPP_DEV_12:
-            raise config.error(self.deviceId +
-                " only supports 12 bit sampling")
-        self.rate = config.getint('rate',
-                DEFAULT_RATE[self.devicePrefix])
-        # Register ADC
-        #self.qadc = self.printer.lookup_object('query_adc')
-        #self.qadc = config.get_printer().load_object(config,
-                             #'query_adc')
-        # query_adc = config.get_printer().load_object(config,
-                             # 'query_adc')
-        # query_adc.register_adc(self.name, self)
+        self.filter_conf = (
+            config.getint('filter_median', 0, minval=0, maxval=31),
+            config.getint('filter_average', 1, minval=0),
+            config.getfloat('filter_lowpass', 0., minval=0.))
+        # Change detection of the pins (ADC_watch)
+        self.watch_conf = None
+        deadband = config.getfloat('report_deadband', 0., minval=0.)
+        thresholds = [float(v) for v in
+                      config.getlist('report_thresholds', ())]
+        if deadband or thresholds:
+            self.watch_conf = (deadband, thresholds, config.getfloat(
+                'report_heartbeat', 5., minval=0.))
+        # Per channel overrides for the round-robin scanner
+        self.channel_conf = {}
+        for ch in range(1, self.profile.channels + 1):
+            gain = config.getfloat('ch%d_gain' % (ch,), self.gain)
+            if gain not in self.profile.gains:
+                raise config.error("Invalid PGA setting")
+            sample_rate = config.getfloat('ch%d_sample_rate' % (ch,),
+                                          None, above=0.)
+            self.channel_conf[ch - 1] = (gain, sample_rate)
         #Configure ADC
-        self.conf = (self.channel, self.gain, self.resolution,
-                    self.rate, self.devicePrefix, self.name,
-                    self.reportTime)
+        ready_pin = config.get('ready_pin', None)
+        comparator = config.getboolean('comparator', False)
+        if comparator and (ready_pin is None or self.watch_conf is None):
+            raise config.error("comparator needs ready_pin and"
+                               " report_deadband or report_thresholds")
+        if ready_pin is not None:
+            if not self.profile.family.alert_pin:
+                raise config.error("ready_pin is only supported on ADS1x1x")
+            buttons = self.printer.load_object(config, 'buttons')
+            buttons.register_buttons([ready_pin], self.stream.handle_ready)
+            if comparator:
+                self.stream.comparator = True
+            else:
+                self.stream.ready_mode = True
+        if config.getboolean('mcu_sampling', False):
+            if ready_pin is not None:
+                raise config.error(
+                    "mcu_sampling can not be combined with ready_pin")
+            self.stream.setup_mcu_sampling()
+        self.setup_stream_modes(config)
+        if comparator and (self.stream.autorange
+                           or self.stream.rate_control is not None):
+            raise config.error("comparator can not be combined with"
+                               " autorange or adaptive")
+
+    def handle_connect(self):
+        i2c_adc_core.ADC_chip.handle_connect(self)
+        logging.info('I2C_ADC {} connected. Inputs {}'.format(
+            self.name, [self.profile.inputs[ch]
+                        for ch in self.stream.get_channels()]))
 
     def setup_pin(self, pin_type, pin_params):
         if pin_type != 'adc':
             raise self.printer.config_error(
                     "I2C_ADC only supports adc pins")
-        return ADC_sample(self.printer, self.i2c, self.conf)
+        # Pins are "external_adc_name:" (configured channel), an
+        # input name like "external_adc_name:AIN0-AIN1" or
+        # "external_adc_name:chN"
+        pin = pin_params['pin'].strip()
+        if not pin:
+            channel = self.channel
+        else:
+            channel = self.profile.lookup_input(pin)
+            if channel is None:
+                raise self.printer.config_error(
+                    "%s has no input '%s', use one of %s or chN" % (
+                        self.deviceId, pin,
+                        ", ".join(self.profile.inputs)))
+        gain, sample_rate = self.channel_conf[channel]
+        if channel == self.channel and not pin:
+            gain = self.gain
+        if self.stream.comparator and self.stream.channels \
+                and channel not in self.stream.channels:
+            raise self.printer.config_error(
+                "I2C_ADC %s: comparator allows only one input" % (
+                    self.name,))
+        return ADC_sample(self.printer, self, channel, gain, sample_rate)
 
 class ADC_sample:
-    def __init__(self, printer, i2c, conf):
+    def __init__(self, printer, chip, channel, gain, sample_rate):
         self.printer = printer
         self.reactor = printer.get_reactor()
-        self.i2c = i2c
-        self.channel = conf[0]
-        self.gain = conf[1]
-        self.resolution = conf[2]
-        self.rate = conf[3]
-        self.devicePrefix = conf[4]
-        self.name = conf[5]
-        self.report_time = conf[6]
-        self.read = 0
-        self.sample_timer = 0
+        self.chip = chip
+        self.channel = channel
+        self.gain = gain
+        self.name = chip.name
+        self.report_time = chip.reportTime
         self._last_time = 0
         self._callback = None
+        self.watch = None
         self.rValue = None
-        self.LSB = (VREF*2)/(2**self.resolution)
-        ppins = self.printer.lookup_object('pins')
-        self.adc = ppins.setup_pin('adc', self.name)
-        self.printer.register_event_handler("klippy:connect",
-                          self.handle_connect)
+        self.stream = chip.stream
+        ch = self.stream.add_channel(channel, gain, sample_rate,
+                                     self.report_time, chip.history_size)
+        self.history = ch.history
+        self.filter = i2c_adc_core.ADC_filter(*chip.filter_conf)
+        if chip.filter_conf[2]:
+            self.stream.set_bandwidth(channel, chip.filter_conf[2])
+        # Every pin subscribes to the readings of its channel, pins of
+        # the same input share them
+        self.subscriber = self.stream.subscribe(channel, self._handle_batch,
+                                                self.report_time)
+        if chip.watch_conf is not None:
+            self._set_watch(i2c_adc_core.ADC_watch(*chip.watch_conf))
 
-    def handle_connect(self):
-        self.write_config()
-        self.sample_timer = self.reactor.register_timer(
-            self._sample_timer, self.reactor.NOW)
-        logging.info('I2C_ADC {} connected. Channel {}'.format(
-            self.name, self.channel + 1))
+    def _set_watch(self, watch):
+        self.watch = watch
+        self.stream.add_watch(self.channel, watch)
 
-    def _sample_timer(self, eventtime):
-        self.rValue = self.read_voltage()
-        self._last_time = eventtime
-        self.reactor.pause(self._last_time + self.report_time)
-        self._callback(self.rValue[0], self.rValue[1])
-        return self._last_time + self.report_time + 0.0001
+    def _handle_batch(self, samples):
+        # Filter every reading, report once per batch
+        update = self.filter.update
+        for rTime, rVolt in samples:
+            update(rTime, rVolt)
+        self._last_time = samples[-1][0]
+        self.rValue = (self._last_time, self.filter.report())
+        if self._callback is not None and (
+                self.watch is None or self.watch.check(*self.rValue)):
+            # Channels activated by get_last_value have no callback
+            self.stream.dispatch(self._callback, self.rValue[0],
+                                 self.rValue[1])
 
-    def setup_minmax(self, min_temp, max_temp,
-                     minval=0., maxval=1000, range_check_count=0):
-        self.min_temp = min_temp
-        self.max_temp = max_temp
+    def setup_minmax(self, sample_time, sample_count,
+                     minval=0., maxval=1., range_check_count=0):
+        # Every streamed reading is checked, sample_time and
+        # sample_count of the MCU oversampling do not apply
+        self.minval = minval
+        self.maxval = maxval
+        self.stream.setup_range_check(
+            self.channel, minval, maxval, range_check_count,
+            "I2C_ADC %s channel %d out of range" % (self.name,
+                                                   self.channel + 1))
 
-    def setup_adc_callback(self, report_time, callback):
+    def setup_adc_callback(self, report_time, callback, decimation=None):
         if report_time is not None:
             self.report_time = report_time
+            self.stream.set_report_time(self.channel, self.subscriber,
+                                        report_time)
+        if decimation is not None:
+            # Filter only every decimation-th reading
+            self.subscriber.decimation = decimation
         self._callback = callback
+        self.stream.activate(self.channel)
+
+    def setup_adc_watch(self, callback, deadband=0., thresholds=(),
+                        heartbeat=None):
+        # Like setup_adc_callback, but the callback only runs when the
+        # value moved by deadband, crossed a threshold or heartbeat
+        # seconds passed (see ADC_watch)
+        if self.watch is not None:
+            self.stream.get_channel(self.channel).watches.remove(
+                self.watch)
+        self._set_watch(i2c_adc_core.ADC_watch(deadband, thresholds,
+                                               heartbeat))
+        self.setup_adc_callback(None, callback)
 
     def get_last_value(self):
     # via Query ADC tempereature_sensor
-        return (self.rValue[1], self.rValue[0])
-
-    def write_config(self):
-        _gain = eval(self.devicePrefix + "_GAIN")[self.gain]
-        _rate = eval(self.devicePrefix + "_RATE")[self.rate]
-        # Setup ADC and write ADC configuration
-        if self.devicePrefix == "MCP":
-            _rate = MCP_RES[resolution]
-            self.rate = _rate[0]
-            conf = 0b10010000 | self.channel << 5 | _rate[1] << 2 | _gain
-            self.i2c.i2c_write([conf])
-            self.read = []
-        else:
-            _conf1 = 0b00000000 | int(self.channel) << 4 | _gain << 1
-            _conf2 = 0b00000011 | _rate << 5
-            conf = [0b00000001, _conf1, _conf2]
-            self.read = [0b00000000]
-        self.i2c.i2c_write(bytearray(conf))
+        self.stream.activate(self.channel)
+        rTime, rVolt = self.history.get_last()
+        return (rVolt, rTime)
 
-    def read_voltage(self):
-        # Read 3 bytes of data
-        params = self.i2c.i2c_read(self.read, 3)
-        response = bytearray(params['response'])
-        # Calculate response according to
-        # 12, 14, 16 or 18 bit resolution
-        if self.devicePrefix == 'MCP':
-            if self.resolution == 16:
-                value = response[0] << 8 | response[1]
-            elif self.resolution < 16:
-                value = response[0] << 8 | response[1]
-                #Cut repeating leading bits
-                value &= ((2 ** resolution)-1)
-            else:
-                value = response[2] << 16 | response[1] << 8 \
-                        | response[2]
-                value &= ((2 ** self.resolution)-1)
-        else:
-            if self.resolution < 18:
-                value = response[0] << (self.resolution - 8) | response[1]
-            else:
-                value = response[0] << (self.resolution - 8) \
-                    | response [1] << (self.resolution - 16) | response[2]
-        # Check sign
-        if (value & 1 << (self.resolution - 1)) != 0:
-            value -= ((1 << (self.resolution - 1)))
-        # calculate Voltage
-        rVolt = value * self.LSB / self.gain
-        rTime = params['#receive_time']
-        return (rTime, rVolt)
+    def get_history(self):
+        self.stream.activate(self.channel)
+        return self.history
 
 def load_config_prefix(config):
     return i2c_adc(config)
@@ -0,0 +1,3117 @@
+# Shared core of the i2c_adc and mcp342x modules
+#
+# Copyright (C) 2021 Dawid Murawski <dawid.m@gmx.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Chip profiles, decoding, streaming, filtering, statistics, capture
+# and bus arbitration. i2c_adc.py (virtual adc pins) and mcp342x.py
+# (MCP_READ / query_adc) are front ends on top of this module.
+
+## ADS10XX / ADS11XX: ##
+# Second Byte: Address pointer
+# 0 0 0 0 0 0 P1 P2
+#             0  0: Conversion register
+#             0  1: Config register
+#             1  0: Lo_threshold
+#             1  1: Hi_threshold
+
+# Config register
+# 0  0  0  0  0  0  0  0
+# 15 14 13 12 11 10 9  8
+# OS [  MUX ] [ PGA  ] Mode
+# ----------------------
+# 0  0  0  0  0  0  0  0
+# 7  6  5  4  3  2  1  0
+# [  DR ] CM  CP CL [CQ]
+#
+# OS: Operational Status (write 1 for single shot)
+# MUX (AINP - AINN):    000: AIN0-AIN1 (def)
+# Input Multiplexer     001: AIN0-AIN3
+# (ADS1015/ADS1115      010: AIN1-AIN3
+# only)                 011: AIN2-AIN3
+#                       100: AIN0-GND
+#                       101: AIN1-GND
+#                       110: AIN2-GND
+#                       111: AIN3-GND
+# PGA:                  000: FSR = +- 6.144 V (Gain 0.25)
+# No function on        001: FSR = +- 4.096 V (Gain 0.5)
+# ADS1013               010: FSR = +- 2.048 V (def)
+#                       011: FSR = +- 1.024 V (Gain 2)
+#                       100: FSR = +- 0.512 V (Gain 4)
+#                       101: FSR = +- 0.256 V (Gain 8)
+#                       110: FSR = +- 0.256 V
+#                       111: FSR = +- 0.256 V
+# Mode:                 0: continuous conversion
+#                       1: single shot
+# DR:                    000: 128 SPS
+# Data rate             001: 250 SPS
+#                       010: 490 SPS
+#                       011: 920 SPS
+#                       100: 1600 SPS (def)
+#                       101: 2400 SPS
+#                       110: 3300 SPS
+#                       111: 3300 SPS
+# DR ADS111x:           000: 8 SPS, 001: 16, 010: 32, 011: 64,
+#                       100: 128 (def), 101: 250, 110: 475, 111: 860
+## MCP34XX: ##
+# 7th bit: OS (1 start new conversion, no function in continuous)
+# 6+5th bit: channel selection CH1-CH4, each channel is the
+#            differential pair CHn+ - CHn- (not used in mcp3421/5)
+# 4th bit: mode (0: one shot mode, 1: continuous)
+# 3rd+2nd bit: sample rate (10: 15 ms, 16 bit)
+# 1st+0th bit: gain selection (00: gain = 1)
+
+from . import bus
+import logging
+import collections
+import struct
+import array
+import bisect
+import math
+import heapq
+import mmap
+import os
+import threading
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VREF = 2.048
+
+ADS_GAIN = {
+    0.25: 0,
+    0.5: 1,
+    1: 2,
+    2: 3,
+    4: 4,
+    8: 5
+}
+
+MCP_GAIN = {
+    1: 0,
+    2: 1,
+    4: 2,
+    8: 3
+}
+
+# Full scale range (volts) at each gain. The lowest ADS PGA setting
+# is +-6.144 V, not VREF / 0.25.
+ADS_FSR = {
+    0.25: 6.144,
+    0.5: 4.096,
+    1: 2.048,
+    2: 1.024,
+    4: 0.512,
+    8: 0.256
+}
+
+MCP_FSR = dict((gain, VREF / gain) for gain in MCP_GAIN)
+
+MCP_RES = {
+    12: (240,0),
+    14: (60,1),
+    16: (15,2),
+    18: (3.75,3)
+}
+
+ADS_RATE = {
+    128: 0,
+    250: 1,
+    490: 2,
+    920: 3,
+    1600: 4,
+    2400: 5,
+    3300: 6,
+}
+
+ADS111X_RATE = {
+    8: 0,
+    16: 1,
+    32: 2,
+    64: 3,
+    128: 4,
+    250: 5,
+    475: 6,
+    860: 7
+}
+
+# Chip profiles
+#
+# A family holds what its chips share (register layout, rates,
+# justification), a profile what differs per chip. The rest of the
+# module only talks to profiles, so a new chip is a new entry in
+# CHIP_PROFILES.
+ADC_family = collections.namedtuple('ADC_family', [
+    'name', 'conf_pointer', 'read_pointer', 'conf_size', 'fields',
+    'fixed', 'continuous', 'rates', 'left_justified', 'ready_level',
+    'alert_pin', 'max_speed'])
+
+# ADS101x / ADS111x: config behind pointer 1, conversion behind
+# pointer 0. High speed mode needs a master code the MCU does not send,
+# so 400 kHz is the limit.
+ADS_FIELDS = {'os': (15, 1), 'mux': (12, 3), 'pga': (9, 3),
+              'mode': (8, 1), 'rate': (5, 3), 'cm': (4, 1), 'cl': (2, 1),
+              'cq': (0, 2)}
+ADS_LO_THRESH = 0b00000010
+ADS_HI_THRESH = 0b00000011
+# MCP342x: single config byte, conversion data read without pointer
+MCP_FIELDS = {'os': (7, 1), 'mux': (5, 2), 'mode': (4, 1),
+              'rate': (2, 2), 'pga': (0, 2)}
+
+ADS101X = ADC_family('ADS', [0b00000001], [0b00000000], 2, ADS_FIELDS,
+                     0b00000011, 0, {12: ADS_RATE}, True, 1, True,
+                     400000)
+ADS111X = ADC_family('ADS', [0b00000001], [0b00000000], 2, ADS_FIELDS,
+                     0b00000011, 0, {16: ADS111X_RATE}, True, 1, True,
+                     400000)
+MCP342X = ADC_family('MCP', [], [], 1, MCP_FIELDS, 0b10000000, 1,
+                     dict((res, {rate: code})
+                          for res, (rate, code) in MCP_RES.items()),
+                     False, 0, False, 400000)
+
+# Input names of the mux settings, the list index is the MUX field.
+# Single ended ADS inputs are measured against GND.
+ADS_INPUTS = ['AIN0-AIN1', 'AIN0-AIN3', 'AIN1-AIN3', 'AIN2-AIN3',
+              'AIN0', 'AIN1', 'AIN2', 'AIN3']
+MCP_INPUTS = ['CH1', 'CH2', 'CH3', 'CH4']
+
+class ADC_profile:
+    def __init__(self, name, family, inputs, resolutions, gains,
+                 full_scale, default_rate):
+        self.name = name
+        self.family = family
+        self.prefix = family.name
+        self.inputs = inputs
+        self.channels = len(inputs)
+        self.resolutions = resolutions
+        self.default_resolution = min(resolutions)
+        self.gains = gains
+        self.full_scale = full_scale
+        self.default_rate = default_rate
+        self.read_pointer = family.read_pointer
+        self._config_tables = {}
+
+    def lookup_input(self, name):
+        # Mux setting of an input name (AIN0-AIN1, AIN2, CH1), of
+        # 'chN' or of a number N (mux setting N-1). None if the chip
+        # has no such input.
+        name = str(name).strip().upper().replace(' ', '')
+        if name in self.inputs:
+            return self.inputs.index(name)
+        if name.startswith('CH'):
+            name = name[2:]
+        try:
+            mux = int(name) - 1
+        except ValueError:
+            return None
+        if mux < 0 or mux >= self.channels:
+            return None
+        return mux
+
+    def get_rates(self, resolution):
+        return self.family.rates[resolution]
+
+    def check_rate(self, resolution, rate):
+        # Data rate used at a resolution, None if the chip lacks it
+        rates = self.get_rates(resolution)
+        if len(rates) == 1:
+            # MCP342x: the resolution sets the rate
+            return list(rates)[0]
+        if rate in rates:
+            return rate
+        return None
+
+    def find_resolution(self, rate):
+        for res in self.resolutions:
+            if rate in self.get_rates(res):
+                return res
+        return None
+
+    def get_candidates(self):
+        # All (resolution, rate) settings of the chip
+        return [(res, rate) for res in self.resolutions
+                for rate in sorted(set(self.get_rates(res)))]
+
+    def build_config(self, mux, gain, resolution, rate, mode='continuous'):
+        # Config register write for 'continuous', 'single', 'ready' or
+        # 'comparator' mode
+        family = self.family
+        values = {'mux': mux, 'pga': self.gains[gain],
+                  'rate': self.get_rates(resolution)[rate],
+                  'mode': family.continuous}
+        if mode == 'comparator':
+            values.update({'cm': 1, 'cl': 1, 'cq': 0})
+        elif mode != 'continuous':
+            values['mode'] = 1 - family.continuous
+            values['os'] = 1
+        reg = family.fixed
+        for field, value in values.items():
+            shift, width = family.fields[field]
+            reg = reg & ~(((1 << width) - 1) << shift) | value << shift
+        if mode == 'ready':
+            shift, width = family.fields['cq']
+            reg &= ~(((1 << width) - 1) << shift)
+        return family.conf_pointer + [(reg >> (8 * i)) & 0xff for i in
+                                      reversed(range(family.conf_size))]
+
+    def get_config_table(self, resolution, rate, mode='continuous'):
+        # Config writes of all (mux, gain) pairs of a setting, built
+        # once and shared by all chips with this profile
+        key = (resolution, rate, mode)
+        table = self._config_tables.get(key)
+        if table is None:
+            table = self._config_tables[key] = dict(
+                ((mux, gain), self.build_config(mux, gain, resolution,
+                                                rate, mode))
+                for mux in range(self.channels) for gain in self.gains)
+        return table
+
+    def get_readback(self):
+        # Pointer, length and offset of a read of the config register.
+        # MCP342x has no pointer, its config byte follows the (up to
+        # three) data bytes.
+        family = self.family
+        if family.conf_pointer:
+            return family.conf_pointer, family.conf_size, 0
+        return [], 4, 3
+
+    def check_readback(self, conf, data):
+        # True if a config register read matches the config write. The
+        # OS/RDY bit reports the conversion state and is ignored.
+        family = self.family
+        size = family.conf_size
+        pointer, length, offset = self.get_readback()
+        written = bytearray(conf[len(family.conf_pointer):])
+        read = bytearray(data[offset:offset + size])
+        if len(read) < size:
+            return False
+        shift, width = family.fields['os']
+        mask = ~(((1 << width) - 1) << shift)
+        diff = 0
+        for i in range(size):
+            diff = diff << 8 | (written[i] ^ read[i])
+        return not diff & mask
+
+    def get_read_len(self, resolution):
+        # Bytes of a conversion read: the data, on MCP342x followed by
+        # the config byte that tells new conversions from stale ones
+        data_size = build_decoder(self, resolution, 1).data_size
+        if self.get_status_check(resolution) is not None:
+            return data_size + 1
+        return data_size
+
+    def get_status_check(self, resolution):
+        # (offset, mask, ready) of the OS/RDY bit behind the data of a
+        # conversion read, None if the chip returns no config byte
+        family = self.family
+        if family.conf_pointer:
+            return None
+        data_size = build_decoder(self, resolution, 1).data_size
+        shift, width = family.fields['os']
+        return (data_size, ((1 << width) - 1) << shift,
+                family.ready_level << shift)
+
+    def conversion_done(self, conf):
+        # True if the OS/RDY bit of a config register value reports a
+        # finished single shot conversion
+        shift, width = self.family.fields['os']
+        return (conf >> shift) & 1 == self.family.ready_level
+
+# No PGA on ADS1013 / ADS1113 - fixed +-2.048 V range
+ADS_NO_PGA = {1: ADS_GAIN[1]}
+
+CHIP_PROFILES = dict((p.name, p) for p in [
+    ADC_profile('MCP3421', MCP342X, MCP_INPUTS[:1], [12, 14, 16, 18],
+                MCP_GAIN, MCP_FSR, 240),
+    ADC_profile('MCP3422', MCP342X, MCP_INPUTS[:2], [12, 14, 16, 18],
+                MCP_GAIN, MCP_FSR, 240),
+    ADC_profile('MCP3423', MCP342X, MCP_INPUTS[:2], [12, 14, 16, 18],
+                MCP_GAIN, MCP_FSR, 240),
+    ADC_profile('MCP3424', MCP342X, MCP_INPUTS, [12, 14, 16, 18],
+                MCP_GAIN, MCP_FSR, 240),
+    ADC_profile('MCP3425', MCP342X, MCP_INPUTS[:1], [12, 14, 16],
+                MCP_GAIN, MCP_FSR, 240),
+    ADC_profile('MCP3426', MCP342X, MCP_INPUTS[:2], [12, 14, 16],
+                MCP_GAIN, MCP_FSR, 240),
+    ADC_profile('MCP3427', MCP342X, MCP_INPUTS[:2], [12, 14, 16],
+                MCP_GAIN, MCP_FSR, 240),
+    ADC_profile('MCP3428', MCP342X, MCP_INPUTS, [12, 14, 16],
+                MCP_GAIN, MCP_FSR, 240),
+    # ADS1x13/ADS1x14 have no mux, the input is AIN0-AIN1
+    ADC_profile('ADS1013', ADS101X, ADS_INPUTS[:1], [12], ADS_NO_PGA,
+                ADS_FSR, 1600),
+    ADC_profile('ADS1014', ADS101X, ADS_INPUTS[:1], [12], ADS_GAIN,
+                ADS_FSR, 1600),
+    ADC_profile('ADS1015', ADS101X, ADS_INPUTS, [12], ADS_GAIN,
+                ADS_FSR, 1600),
+    ADC_profile('ADS1113', ADS111X, ADS_INPUTS[:1], [16], ADS_NO_PGA,
+                ADS_FSR, 128),
+    ADC_profile('ADS1114', ADS111X, ADS_INPUTS[:1], [16], ADS_GAIN,
+                ADS_FSR, 128),
+    ADC_profile('ADS1115', ADS111X, ADS_INPUTS, [16], ADS_GAIN,
+                ADS_FSR, 128),
+])
+
+def lookup_profile(config):
+    sensor = config.get('sensor_ID').upper()
+    profile = CHIP_PROFILES.get(sensor)
+    if profile is None:
+        raise config.error("%s not supported" % (sensor,))
+    return profile
+
+# Chip front end base
+#
+# Shared by the [i2c_adc] and [mcp342x] sections.
+class ADC_chip:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.name = config.get_name().split()[-1]
+        self.profile = profile = lookup_profile(config)
+        self.deviceId = profile.name
+        self.devicePrefix = profile.prefix
+        speed = config.getint('i2c_speed', 100000, minval=1)
+        if speed > profile.family.max_speed:
+            raise config.error("%s runs at up to %d Hz, i2c_speed %d is"
+                               " too fast" % (self.deviceId,
+                                              profile.family.max_speed,
+                                              speed))
+        self.i2c = bus.MCU_I2C_from_config(config, default_speed=100000)
+        self.mcu = self.i2c.get_mcu()
+        self.channel = profile.lookup_input(config.get('channel', '1'))
+        if self.channel is None:
+            raise config.error("%s has no input '%s', use one of %s" % (
+                self.deviceId, config.get('channel'),
+                ", ".join(profile.inputs)))
+        self.gain = config.getfloat('gain', 1)
+        if self.gain not in profile.gains:
+            raise config.error("Invalid PGA setting")
+        self.resolution = config.getint('resolution',
+                                        profile.default_resolution)
+        if self.resolution not in profile.resolutions:
+            raise config.error("%s does not support %d bit sampling" % (
+                self.deviceId, self.resolution))
+        self.rate = profile.check_rate(
+            self.resolution, config.getint('rate', profile.default_rate))
+        if self.rate is None:
+            raise config.error("Invalid rate for %s" % (self.deviceId,))
+        self.history_size = config.getint('history_size', 1024, minval=1)
+        self.section = config.get_name()
+        self.calibration = ADC_calibration(config, profile)
+        self.stream = ADC_stream(self.printer, self.i2c, profile,
+                                 self.resolution, self.rate,
+                                 lookup_bus_arbiter(config),
+                                 self.calibration)
+        lookup_startup(self.printer).register_chip(self)
+
+    def setup_stream_modes(self, config):
+        # Options that need the final stream setup
+        if config.getboolean('autorange', False):
+            if self.stream.mcu_mode or len(self.profile.gains) < 2:
+                raise config.error("autorange needs a PGA and is not"
+                                   " available with mcu_sampling")
+            self.stream.autorange = True
+        if config.getboolean('offload', False):
+            if self.stream.autorange or self.stream.comparator:
+                raise config.error("offload can not be combined with"
+                                   " autorange or comparator")
+            self.stream.setup_offload(lookup_worker(self.printer))
+        if config.getboolean('adaptive', False):
+            ADC_rate_control(self.printer, self.name, self.stream)
+        register_stats_command(self.printer, self.name, self.stream)
+        register_calibrate_command(self.printer, self.section, self.name,
+                                   self.stream)
+        lookup_capture(self.printer).register_stream(self.name, self.stream)
+
+    def handle_connect(self):
+        # Called by ADC_startup once the config writes of all chips
+        # went out
+        self.stream.start()
+
+    def get_status(self, eventtime):
+        return self.stream.get_status(eventtime)
+
+# Number of reads that may be outstanding on the bus per chip
+MAX_INFLIGHT = 4
+
+# Data rate tolerance of the chip oscillators (ADS1x1x: +-10%), a
+# conversion is waited for with this margin
+OSC_TOLERANCE = .1
+
+# Period of the MCU button polling that reports the ALERT/RDY pin
+# (QUERY_TIME of buttons.py)
+READY_QUERY_TIME = .002
+
+# Frames per bulk message and time between bulk message checks in
+# MCU sampling mode, time between queries of the MCU overflow counter.
+# BULK_SIZE is the message buffer of sensor_i2c_adc.c, a frame takes
+# read_len plus a slot byte.
+MAX_BULK_FRAMES = 12
+BULK_SIZE = 48
+MAX_BULK_SLOTS = 8
+BULK_TIME = .05
+BULK_STATUS_TIME = 1.
+
+# Time the connect step waits for the config read back of all chips
+STARTUP_TIMEOUT = 1.
+
+# Offloaded streams: blocks the ring holds, ring fill that wakes the
+# worker early and the time the worker collects blocks
+WORKER_RING_SIZE = 1024
+WORKER_WAKE_BLOCKS = 256
+WORKER_PERIOD = .02
+
+# Error handling: time after the expected arrival of a response at
+# which its read is lost, failed reads in a row that are retried
+# before the chip is reconfigured, and the pause before a
+# reconfiguration (doubled for every one that is not followed by a
+# good reading)
+READ_TIMEOUT = .002
+RETRY_BUDGET = 3
+RECOVERY_BACKOFF = .02
+RECOVERY_BACKOFF_MAX = 2.
+
+# Slot byte flag of MCU sampling frames whose read or preceding mux
+# write failed on the bus
+FRAME_ERROR = 0x80
+
+# Share of the bus time the arbiter hands out before slowing down
+# all streams on the bus
+MAX_BUS_UTILIZATION = .8
+
+# Adaptive rate control: update interval, analysed history window,
+# readings wanted per report period, time before switching slower
+ADAPTIVE_TIME = 1.
+ADAPTIVE_WINDOW = 2.
+ADAPTIVE_READINGS = 2.
+ADAPTIVE_HOLD = 5.
+
+# Auto-ranging: share of the code range above which the gain is
+# lowered, share at the next gain below which it is raised, and the
+# number of readings that must fit before raising it
+AUTORANGE_DOWN = .9
+AUTORANGE_UP = .7
+AUTORANGE_READINGS = 8
+
+# Capture file layout: preamble, table of CAPTURE_ENTRIES (chip,
+# channel, scale) entries, then the records
+CAPTURE_MAGIC = b'I2CADC01'
+CAPTURE_PREAMBLE = struct.Struct('<8sIIII')
+CAPTURE_ENTRY = struct.Struct('<22sBBd')
+CAPTURE_RECORD = struct.Struct('<diBBBx')
+CAPTURE_ENTRIES = 64
+CAPTURE_HEADER_SIZE = 32 + CAPTURE_ENTRIES * CAPTURE_ENTRY.size
+
+# Decode descriptor
+#
+# Compiled once per channel configuration, so decoding a frame takes
+# no per-reading decisions.
+ADC_decoder = collections.namedtuple('ADC_decoder', [
+    'frame_size', 'data_size', 'shift', 'mask', 'sign_bit', 'scale'])
+
+_BE16 = struct.Struct('>h')
+
+def build_decoder(profile, resolution, gain, frame_size=None):
+    if profile.family.left_justified:
+        data_size, shift = 2, 16 - resolution
+    elif resolution == 18:
+        data_size, shift = 3, 0
+    else:
+        data_size, shift = 2, 0
+    scale = profile.full_scale[gain] * 2. / (1 << resolution)
+    return ADC_decoder(frame_size or data_size, data_size, shift,
+                       (1 << resolution) - 1, 1 << (resolution - 1), scale)
+
+def decode_counts(dec, data, offset=0):
+    if dec.data_size == 2:
+        return _BE16.unpack_from(data, offset)[0] >> dec.shift
+    value = (data[offset] << 16 | data[offset+1] << 8
+             | data[offset+2]) & dec.mask
+    return value - ((value & dec.sign_bit) << 1)
+
+def decode_frames(dec, data, count):
+    # Vectorized decode of 'count' back to back frames
+    if not count:
+        return []
+    data = memoryview(data)[:count * dec.frame_size]
+    if numpy is not None:
+        raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+            count, dec.frame_size)
+        if dec.data_size == 2:
+            words = numpy.ndarray((count,), dtype='>i2', buffer=data,
+                                  strides=(dec.frame_size,))
+            return (words.astype(numpy.int32) >> dec.shift).tolist()
+        words = (raw[:, 0].astype(numpy.int32) << 16
+                 | raw[:, 1].astype(numpy.int32) << 8 | raw[:, 2])
+        words &= dec.mask
+        return (words - ((words & dec.sign_bit) << 1)).tolist()
+    if dec.data_size == 2:
+        shift = dec.shift
+        frame = struct.Struct('>h%dx' % (dec.frame_size - 2,))
+        return [v >> shift for (v,) in frame.iter_unpack(data)]
+    frame = struct.Struct('>BH%dx' % (dec.frame_size - 3,))
+    mask, sign_bit = dec.mask, dec.sign_bit
+    values = [(hi << 16 | lo) & mask for hi, lo in frame.iter_unpack(data)]
+    return [v - ((v & sign_bit) << 1) for v in values]
+
+# Calibration
+#
+# Per gain offset and factor, then an optional polynomial or table to
+# sensor values. Both stages are folded into one lookup table, so a
+# corrected reading costs the same as a raw one.
+CALIBRATION_STEP = 64
+
+class ADC_calibration:
+    def __init__(self, config, profile):
+        # channel -> {gain: (offset, factor)}
+        self.corrections = {}
+        # channel -> ('poly', [c0, c1, ...]) or ('table', [v], [value])
+        self.linearizations = {}
+        # (channel, gain, scale) -> table
+        self.tables = {}
+        # channel -> [(gain, nominal volts, value)] of the points taken
+        # since the last fit
+        self.points = {}
+        for channel in range(profile.channels):
+            option = 'ch%d_calibration' % (channel + 1,)
+            text = config.get(option, None)
+            if text is not None:
+                try:
+                    self.corrections[channel] = self.parse_correction(
+                        text, profile)
+                except ValueError as e:
+                    raise config.error("%s: %s" % (option, str(e)))
+            option = 'ch%d_linearization' % (channel + 1,)
+            text = config.get(option, None)
+            if text is not None:
+                try:
+                    self.linearizations[channel] = \
+                        self.parse_linearization(text)
+                except ValueError as e:
+                    raise config.error("%s: %s" % (option, str(e)))
+
+    def parse_correction(self, text, profile):
+        # One "gain, offset, factor" line per gain
+        correction = {}
+        for line in text.split('\n'):
+            if not line.strip():
+                continue
+            gain, offset, factor = [float(v) for v in line.split(',')]
+            if gain not in profile.gains:
+                raise ValueError("invalid gain %g" % (gain,))
+            correction[gain] = (offset, factor)
+        return correction
+
+    def parse_linearization(self, text):
+        # "poly, c0, c1, ..." or "table, v1, value1, v2, value2, ..."
+        words = [w.strip() for w in text.replace('\n', ',').split(',')
+                 if w.strip()]
+        if not words:
+            raise ValueError("empty linearization")
+        kind = words[0].lower()
+        values = [float(w) for w in words[1:]]
+        if kind == 'poly':
+            if not values:
+                raise ValueError("poly needs coefficients")
+            return (kind, values)
+        if kind == 'table':
+            if len(values) < 4 or len(values) % 2:
+                raise ValueError("table needs at least two points")
+            points = sorted(zip(values[0::2], values[1::2]))
+            xs = [x for x, y in points]
+            if any(a >= b for a, b in zip(xs, xs[1:])):
+                raise ValueError("table points must differ")
+            return (kind, xs, [y for x, y in points])
+        raise ValueError("unknown linearization '%s'" % (kind,))
+
+    def format_correction(self, channel):
+        return "".join(["\n  %g, %.9g, %.9g" % (gain, offset, factor)
+                        for gain, (offset, factor) in sorted(
+                            self.corrections[channel].items())])
+
+    def format_linearization(self, channel):
+        lin = self.linearizations[channel]
+        if lin[0] == 'poly':
+            return "poly, " + ", ".join(["%.9g" % (c,) for c in lin[1]])
+        return "table" + "".join(["\n  %.9g, %.9g" % (x, y)
+                                  for x, y in zip(lin[1], lin[2])])
+
+    def is_calibrated(self, channel):
+        return channel in self.corrections \
+            or channel in self.linearizations
+
+    def set_correction(self, channel, correction):
+        self.corrections.setdefault(channel, {}).update(correction)
+        self._invalidate(channel)
+
+    def set_linearization(self, channel, linearization):
+        self.linearizations[channel] = linearization
+        self._invalidate(channel)
+
+    def _invalidate(self, channel):
+        for key in list(self.tables):
+            if key[0] == channel:
+                del self.tables[key]
+
+    def correct(self, channel, gain, volts):
+        # First stage only, for fitting the second
+        offset, factor = self.corrections.get(channel, {}).get(
+            gain, (0., 1.))
+        return (volts - offset) * factor
+
+    def get_function(self, channel, gain):
+        # Nominal volts -> corrected value, for single values or numpy
+        # arrays
+        offset, factor = self.corrections.get(channel, {}).get(
+            gain, (0., 1.))
+        lin = self.linearizations.get(channel)
+        if lin is None:
+            return lambda v: (v - offset) * factor
+        if lin[0] == 'poly':
+            coeffs = list(reversed(lin[1]))
+            def poly(v):
+                v = (v - offset) * factor
+                result = 0.
+                for c in coeffs:
+                    result = result * v + c
+                return result
+            return poly
+        xs, ys = lin[1], lin[2]
+        return lambda v: interpolate(xs, ys, (v - offset) * factor)
+
+    def get_tables(self, channel, decoders):
+        # {scale: table} for the decoders of a channel, None if the
+        # channel is not calibrated
+        if not self.is_calibrated(channel):
+            return None
+        tables = {}
+        for gain, dec in decoders.items():
+            key = (channel, gain, dec.scale)
+            table = self.tables.get(key)
+            if table is None:
+                table = self.tables[key] = self._build_table(
+                    self.get_function(channel, gain), dec)
+            tables[dec.scale] = table
+        return tables
+
+    def _build_table(self, func, dec):
+        base = dec.sign_bit
+        if base > 1 << 15:
+            return ADC_interpolation(func, dec)
+        size = 2 * base
+        if numpy is not None:
+            counts = numpy.arange(size)
+            counts[base:] -= size
+            values = func(counts * dec.scale)
+            return array.array('d', numpy.broadcast_to(
+                values, (size,)).tolist())
+        scale = dec.scale
+        return array.array('d', [func((c - size if c >= base else c)
+                                      * scale) for c in range(size)])
+
+    def get_limits(self, table, dec, minval, maxval):
+        # Lowest and highest counts whose value is within [minval,
+        # maxval], the value must be monotonic in the counts
+        if isinstance(table, ADC_interpolation):
+            counts = table.get_knots()
+            values = table.knots
+        else:
+            counts = range(-dec.sign_bit, dec.sign_bit)
+            values = [table[c] for c in counts]
+        inside = [c for c, v in zip(counts, values) if minval <= v <= maxval]
+        if not inside:
+            return (1, 0)
+        return (inside[0], inside[-1]) if inside[0] <= inside[-1] \
+            else (inside[-1], inside[0])
+
+def interpolate(xs, ys, v):
+    # Piecewise linear through (xs, ys), xs ascending
+    last = len(xs) - 2
+    if numpy is not None and isinstance(v, numpy.ndarray):
+        i = numpy.clip(numpy.searchsorted(xs, v, 'right') - 1, 0, last)
+        x0, x1 = numpy.take(xs, i), numpy.take(xs, i + 1)
+        y0, y1 = numpy.take(ys, i), numpy.take(ys, i + 1)
+        return y0 + (v - x0) * (y1 - y0) / (x1 - x0)
+    i = min(max(bisect.bisect_right(xs, v) - 1, 0), last)
+    return ys[i] + (v - xs[i]) * (ys[i+1] - ys[i]) / (xs[i+1] - xs[i])
+
+class ADC_interpolation:
+    # Table of the corrected value at every CALIBRATION_STEP-th code,
+    # indexed with the counts like the full tables
+    def __init__(self, func, dec):
+        self.base = dec.sign_bit
+        knots = range(0, 2 * self.base + 1, CALIBRATION_STEP)
+        scale = dec.scale
+        self.knots = [func((k - self.base) * scale) for k in knots]
+
+    def get_knots(self):
+        return [k * CALIBRATION_STEP - self.base
+                for k in range(len(self.knots))]
+
+    def __getitem__(self, counts):
+        idx, frac = divmod(counts + self.base, CALIBRATION_STEP)
+        low = self.knots[idx]
+        return low + (self.knots[idx+1] - low) * frac / CALIBRATION_STEP
+
+def fit_polynomial(xs, ys, degree):
+    # Least squares coefficients [c0, c1, ...] of y = c0 + c1*x + ...
+    # from the normal equations
+    n = degree + 1
+    a = [[sum([x ** (i + j) for x in xs]) for j in range(n)]
+         for i in range(n)]
+    b = [sum([y * x ** i for x, y in zip(xs, ys)]) for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        if abs(a[pivot][col]) < 1e-15:
+            raise ValueError("points do not determine the fit")
+        a[col], a[pivot] = a[pivot], a[col]
+        b[col], b[pivot] = b[pivot], b[col]
+        for r in range(col + 1, n):
+            f = a[r][col] / a[col][col]
+            for k in range(col, n):
+                a[r][k] -= f * a[col][k]
+            b[r] -= f * b[col]
+    coeffs = [0.] * n
+    for r in reversed(range(n)):
+        coeffs[r] = (b[r] - sum([a[r][k] * coeffs[k]
+                                 for k in range(r + 1, n)])) / a[r][r]
+    return coeffs
+
+# Averages the voltage of the next 'samples' readings of a channel
+# converted after start_time per gain for a calibration point, added
+# to the captures of the stream
+class ADC_calibration_point:
+    def __init__(self, stream, channel, samples, start_time):
+        self.channel = channel
+        self.samples = samples
+        self.start_time = start_time
+        # gain -> [readings, sum of volts]
+        self.sums = {}
+        self.count = 0
+        self.done = False
+        # Offloaded streams add their readings from the worker thread
+        self.lock = threading.Lock()
+        stream.captures.append(self)
+
+    def add(self, stream, chans, times, counts, scales):
+        with self.lock:
+            for ch, rTime, value, scale in zip(chans, times, counts,
+                                               scales):
+                if ch.channel != self.channel or self.done \
+                        or rTime < self.start_time \
+                        or self.count >= self.samples:
+                    continue
+                # Gain of the decoder that took the reading, a rate or
+                # resolution change replaces the decoders
+                gains = [g for g, dec in ch.decoders.items()
+                         if dec.scale == scale]
+                if not gains:
+                    continue
+                s = self.sums.setdefault(gains[0], [0, 0.])
+                s[0] += 1
+                s[1] += value * scale
+                self.count += 1
+        if self.count >= self.samples:
+            self.finish(stream)
+
+    def finish(self, stream):
+        with self.lock:
+            if self in stream.captures:
+                stream.captures.remove(self)
+            self.done = True
+
+    def get_result(self):
+        # (gain, mean volts) of the gain most readings were taken at
+        gain, (count, total) = max(self.sums.items(),
+                                   key=lambda i: i[1][0])
+        return gain, total / count
+
+# Sample history
+#
+# Every reading is stored twice, so the newest n readings are always
+# contiguous and can be handed out as slices without copying.
+class ADC_history:
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', [0.]) * (2 * size)
+        self.values = array.array('d', [0.]) * (2 * size)
+        self.pos = 0
+        self.count = 0
+
+    def append(self, rTime, rVolt):
+        pos = self.pos
+        size = self.size
+        self.times[pos] = self.times[pos + size] = rTime
+        self.values[pos] = self.values[pos + size] = rVolt
+        pos += 1
+        self.pos = pos if pos < size else 0
+        if self.count < size:
+            self.count += 1
+
+    def get_last(self):
+        # Newest (time, value) pair, zeros before the first reading
+        idx = self.pos + self.size - 1
+        return self.times[idx], self.values[idx]
+
+    def get_samples(self, count=None):
+        # memoryviews of times and values of the newest readings
+        if count is None or count > self.count:
+            count = self.count
+        end = self.pos + self.size
+        return (memoryview(self.times)[end - count:end],
+                memoryview(self.values)[end - count:end])
+
+    def get_window(self, start_time, end_time=None):
+        # memoryviews of the readings taken in [start_time, end_time]
+        times, values = self.get_samples()
+        start = bisect.bisect_left(times, start_time)
+        end = len(times)
+        if end_time is not None:
+            end = bisect.bisect_right(times, end_time, start)
+        return times[start:end], values[start:end]
+
+# Reading filter
+#
+# Median, moving average and low-pass, constant work per reading.
+class ADC_filter:
+    def __init__(self, median=0, average=1, lowpass=0.):
+        self.median = median
+        self.med_window = collections.deque()
+        self.med_sorted = []
+        self.average = average
+        self.avg_window = collections.deque()
+        self.avg_sum = 0.
+        self.avg_count = 0
+        self.lowpass_k = 2. * math.pi * lowpass
+        self.lp_time = None
+        self.value = 0.
+
+    def update(self, rTime, rVolt):
+        value = rVolt
+        if self.median > 1:
+            window = self.med_window
+            srt = self.med_sorted
+            window.append(value)
+            bisect.insort(srt, value)
+            if len(window) > self.median:
+                del srt[bisect.bisect_left(srt, window.popleft())]
+            value = srt[len(srt) // 2]
+        if self.average != 1:
+            self.avg_sum += value
+            if self.average:
+                window = self.avg_window
+                window.append(value)
+                if len(window) > self.average:
+                    self.avg_sum -= window.popleft()
+                value = self.avg_sum / len(window)
+            else:
+                self.avg_count += 1
+                value = self.avg_sum / self.avg_count
+        if self.lowpass_k:
+            if self.lp_time is not None:
+                alpha = 1. - math.exp(-self.lowpass_k
+                                      * (rTime - self.lp_time))
+                value = self.value + alpha * (value - self.value)
+            self.lp_time = rTime
+        self.value = value
+        return value
+
+    def report(self):
+        if not self.average:
+            # Start a new oversampling period
+            self.avg_sum = 0.
+            self.avg_count = 0
+        return self.value
+
+# Subscribers
+#
+# All users of a channel share the readings of one stream, a
+# subscriber never adds bus traffic.
+class ADC_subscriber:
+    def __init__(self, callback, report_time=None, decimation=1):
+        self.callback = callback
+        self.report_time = report_time
+        self.decimation = decimation
+        # Readings to skip before the next kept one
+        self.phase = 0
+        self.batch = []
+        self.next_report = 0.
+
+    def add(self, eventtime, samples, flush_time):
+        if self.decimation > 1:
+            kept = samples[self.phase::self.decimation]
+            self.phase = (self.phase - len(samples)) % self.decimation
+            samples = kept
+        if self.batch:
+            self.batch.extend(samples)
+            samples = self.batch
+        # Flushes jitter, a report due within half a flush is sent now
+        if eventtime + .5 * flush_time < self.next_report:
+            if samples is not self.batch:
+                self.batch = list(samples)
+            return
+        self.batch = []
+        if self.report_time:
+            self.next_report = eventtime + self.report_time
+        if samples:
+            self.callback(samples)
+
+# Change detection
+#
+# get_window() is the range of values that would not be reported, the
+# ADS1x1x window comparator is set to it so the chip is only read when
+# something happens.
+class ADC_watch:
+    def __init__(self, deadband=0., thresholds=(), heartbeat=None):
+        self.deadband = deadband
+        self.thresholds = sorted(thresholds)
+        self.heartbeat = heartbeat
+        self.last_time = None
+        self.last_value = None
+        self.region = None
+        self.suppressed = 0
+
+    def check(self, rTime, value):
+        # True if the reading is reported
+        region = bisect.bisect_right(self.thresholds, value)
+        if self.last_time is not None and region == self.region:
+            moved = self.deadband \
+                and abs(value - self.last_value) >= self.deadband
+            beat = self.heartbeat \
+                and rTime - self.last_time >= self.heartbeat
+            if not moved and not beat:
+                self.suppressed += 1
+                return False
+        self.last_time = rTime
+        self.last_value = value
+        self.region = region
+        return True
+
+    def get_window(self):
+        if self.last_time is None:
+            return None
+        low, high = float('-inf'), float('inf')
+        if self.deadband:
+            low = self.last_value - self.deadband
+            high = self.last_value + self.deadband
+        if self.region > 0:
+            low = max(low, self.thresholds[self.region - 1])
+        if self.region < len(self.thresholds):
+            high = min(high, self.thresholds[self.region])
+        return low, high
+
+# Statistics
+#
+# Histograms with power of two buckets keep the always-on counters
+# constant time.
+class ADC_histogram:
+    def __init__(self, base=.00005, buckets=12):
+        self.base = base
+        self.buckets = [0] * buckets
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        idx = 0
+        if value > self.base:
+            idx = min(math.frexp(value / self.base)[1],
+                      len(self.buckets) - 1)
+        self.buckets[idx] += 1
+
+    def get_status(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.,
+            'max': self.max,
+            'base': self.base,
+            'buckets': list(self.buckets),
+        }
+
+class ADC_stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        # Failed transactions and their retries
+        self.errors = 0
+        self.retries = 0
+        # Reads without response, reads failed on the bus, readings of
+        # unfinished or foreign conversions, chip reconfigurations
+        self.timeouts = 0
+        self.nacks = 0
+        self.stale = 0
+        self.recoveries = 0
+        # Conversions that did not signal ready in time, ALERT edges
+        # of the window comparator
+        self.ready_misses = 0
+        self.alerts = 0
+        # Steps skipped because MAX_INFLIGHT reads were outstanding
+        # (or the MCU was still busy with the previous read)
+        self.overruns = 0
+        # Responses without a read in flight, lost MCU bulk messages,
+        # readings discarded after a gain switch
+        self.dropped = 0
+        self.lost = 0
+        self.discarded = 0
+        self.gain_switches = 0
+        # Step time behind schedule, i2c_read round trip
+        self.lateness = ADC_histogram()
+        self.round_trip = ADC_histogram()
+        # Thread CPU time spent on the stream by the reactor and the
+        # worker, blocks dropped because the worker ring was full
+        self.reactor_time = 0.
+        self.worker_time = 0.
+        self.overflows = 0
+
+    def get_status(self):
+        return {
+            'samples': self.samples,
+            'errors': self.errors,
+            'retries': self.retries,
+            'timeouts': self.timeouts,
+            'nacks': self.nacks,
+            'stale': self.stale,
+            'recoveries': self.recoveries,
+            'ready_misses': self.ready_misses,
+            'alerts': self.alerts,
+            'overruns': self.overruns,
+            'dropped': self.dropped,
+            'lost': self.lost,
+            'discarded': self.discarded,
+            'gain_switches': self.gain_switches,
+            'reactor_time': self.reactor_time,
+            'worker_time': self.worker_time,
+            'overflows': self.overflows,
+            'lateness': self.lateness.get_status(),
+            'round_trip': self.round_trip.get_status(),
+        }
+
+class ADC_channel:
+    def __init__(self, channel, gain, sample_rate, batch_time,
+                 history_size):
+        self.channel = channel
+        # Input name of the mux setting, e.g. AIN0-AIN1
+        self.input = None
+        self.gain = gain
+        self.sample_rate = sample_rate
+        self.batch_time = batch_time
+        self.conf = []
+        self.decoder = None
+        # Config bytes and decoders of every gain, calibration tables
+        # by scale (None if the channel is not calibrated)
+        self.confs = {}
+        self.decoders = {}
+        self.tables = None
+        # Scale of the conversion last started on the chip, the send
+        # time of its config write and whether that write went out
+        # right behind a read, and the time its readings become valid
+        # after a gain switch
+        self.armed_scale = None
+        self.armed = (0., False)
+        self.valid_after = 0.
+        # Auto-ranging peak of the readings at the current gain
+        self.range_peak = 0
+        self.range_count = 0
+        self.next_flush = 0.
+        self.batch = []
+        self.subscribers = []
+        # Change detection of the users (ADC_watch)
+        self.watches = []
+        # Channel has a user and is part of the scan
+        self.active = False
+        # Range check: (minval, maxval, count, message) in volts (the
+        # calibrated value on calibrated channels), the limits in raw
+        # counts per scale and the consecutive faults
+        self.range_check = None
+        self.range_limits = None
+        self.range_faults = 0
+        self.history = ADC_history(history_size)
+        # Signal bandwidth in Hz the users of the channel care about
+        self.bandwidth = 0.
+        # Readings handed to the subscribers and time spent in them
+        self.samples = 0
+        self.callback_time = ADC_histogram()
+
+    def reset_stats(self):
+        self.samples = 0
+        self.callback_time = ADC_histogram()
+
+    def get_status(self):
+        rTime, rVolt = self.history.get_last()
+        return {
+            'input': self.input,
+            'voltage': rVolt,
+            'time': rTime,
+            'gain': self.gain,
+            'calibrated': self.tables is not None,
+            'samples': self.samples,
+            'callback_time': self.callback_time.get_status(),
+        }
+
+# Continuous conversion streaming
+#
+# The chip converts continuously and is polled at its data rate, the
+# poll timer never waits for a conversion. Several channels are
+# scanned round-robin, the mux of the next slot is written right after
+# the read of the current one. Reads are queued without waiting for
+# their response, so the bus stays busy. Readings are stamped with the
+# estimated end of their conversion, not with the arrival of the
+# response. A failed or lost read only costs itself, after
+# RETRY_BUDGET failures in a row the chip is reconfigured.
+class ADC_stream:
+    def __init__(self, printer, i2c, profile, resolution, rate, arbiter,
+                 calibration=None):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.i2c = i2c
+        self.mcu = i2c.get_mcu()
+        self.oid = i2c.get_oid()
+        self.read_cmd = None
+        # Channels of the reads in flight and their responses
+        self.pending = collections.deque()
+        self.responses = collections.deque()
+        self.hold = False
+        self.mcu.register_config_callback(self._build_cmds)
+        self.profile = profile
+        self.resolution = resolution
+        self.rate = profile.check_rate(resolution, rate)
+        self.read = profile.read_pointer
+        # Pointer register of the chip as of the last command queued,
+        # confirmed once a read that set it came back, and the send
+        # time of that read. Bytes per conversion read.
+        self.pointer = None
+        self.pointer_confirmed = False
+        self.pointer_time = 0.
+        self.read_len = None
+        self.channels = {}
+        self.calibration = calibration
+        self.plan = []
+        self.plan_pos = 0
+        self.started = False
+        # Set by the startup handler, channels activated later start
+        # the stream themselves
+        self.connected = False
+        self.config_queued = False
+        # Conversions are paced by the ALERT/RDY pin
+        self.ready_mode = False
+        self._last_ready = 0.
+        # Only read when the window comparator of the chip fires or
+        # heartbeat_time passed: current threshold window in counts,
+        # ALERT pin asserted, time of the last read
+        self.comparator = False
+        self.heartbeat_time = 1.
+        self.window = None
+        self.alert_active = False
+        self._last_alert_read = 0.
+        # Reads are run by the MCU (sensor_i2c_adc.c)
+        self.mcu_mode = False
+        self.bulk_oid = None
+        self.query_cmd = None
+        self.slot_cmd = None
+        self.status_cmd = None
+        self.bulk = collections.deque()
+        self.bulk_sequence = 0
+        self.bulk_ticks = 0
+        # i2c_adc_status messages, the last overflow count of the MCU
+        # and the time of the next query
+        self.bulk_status = collections.deque()
+        self.bulk_overflows = 0
+        self.next_status = 0.
+        # Link delay and conversion time estimates for the timestamps
+        self.min_rtt = None
+        self.link_delay = 0.
+        self.last_read_end = None
+        self.chip_conversion_time = None
+        self.chip_time_bounds = None
+        self.arbiter = arbiter
+        self.stats = ADC_stats()
+        self.rate_control = None
+        self.autorange = False
+        self.captures = []
+        # Worker thread of offloaded streams (ADC_worker) and the lock
+        # it holds while it processes the frames of the stream
+        self.worker = None
+        self.lock = threading.Lock()
+        self.stats_time = self.reactor.monotonic()
+        # Stretch factor of the step intervals set by the arbiter,
+        # estimated end of the last config write on the bus
+        self.interval_scale = 1.
+        self._next_poll = 0.
+        self.arm_end = 0.
+        # Error handling state
+        self.status_check = None
+        self.failures = 0
+        self.recoveries = 0
+        self.retry = False
+        self.recover_time = 0.
+        self.resync_time = 0.
+        # Reads in flight ran full, wait until they drained
+        self.draining = False
+        self._setup_timing()
+
+    def setup_mcu_sampling(self):
+        self.mcu_mode = True
+        self.bulk_oid = self.mcu.create_oid()
+
+    def setup_offload(self, worker):
+        self.worker = worker
+        self.lock = worker.lock
+
+    def _build_cmds(self):
+        cq = self.i2c.get_command_queue()
+        self.read_cmd = self.mcu.lookup_command(
+            "i2c_read oid=%c reg=%*s read_len=%u", cq=cq)
+        self._register_response()
+        if not self.mcu_mode:
+            return
+        if len(self.plan) > MAX_BULK_SLOTS:
+            raise self.printer.config_error(
+                "I2C_ADC scan plan too long for MCU sampling")
+        self.mcu.add_config_cmd(
+            "config_i2c_adc oid=%d i2c_oid=%d read_len=%d" % (
+                self.bulk_oid, self.oid, self._get_mcu_read_len()))
+        if len(self.plan) > 1:
+            for ch in self.plan:
+                self.mcu.add_config_cmd(
+                    "i2c_adc_add_slot oid=%d conf=%s" % (
+                        self.bulk_oid, "".join(["%02x" % (x,)
+                                                for x in ch.conf])))
+        self.mcu.add_config_cmd(
+            "query_i2c_adc oid=%d rest_ticks=0 reg= frames=0" % (
+                self.bulk_oid,), on_restart=True)
+        self.query_cmd = self.mcu.lookup_command(
+            "query_i2c_adc oid=%c rest_ticks=%u reg=%*s frames=%c", cq=cq)
+        self.slot_cmd = self.mcu.lookup_command(
+            "i2c_adc_set_slot oid=%c slot=%c conf=%*s", cq=cq)
+        self.status_cmd = self.mcu.lookup_command(
+            "query_i2c_adc_status oid=%c", cq=cq)
+        self.mcu.register_response(self._handle_bulk, "i2c_adc_data",
+                                   self.bulk_oid)
+        self.mcu.register_response(self.bulk_status.append,
+                                   "i2c_adc_status", self.bulk_oid)
+
+    def _handle_bulk(self, params):
+        # Called from the serial thread - just queue the message
+        self.bulk.append(params)
+
+    def _register_response(self):
+        self.mcu.register_response(self._handle_response,
+                                   "i2c_read_response", self.oid)
+
+    def _handle_response(self, params):
+        # Called from the serial thread - just queue the response
+        self.responses.append(params)
+
+    def add_channel(self, channel, gain, sample_rate=None, batch_time=1.,
+                    history_size=1024):
+        ch = self.channels.get(channel)
+        if ch is not None:
+            # Another user shares the readings of the channel
+            if ch.gain != gain:
+                raise self.printer.config_error(
+                    "I2C_ADC channel %d is already in use with gain %g" % (
+                        channel + 1, ch.gain))
+            if sample_rate:
+                ch.sample_rate = max(ch.sample_rate or 0., sample_rate)
+                self.plan = self._build_plan()
+            return ch
+        ch = ADC_channel(channel, gain, sample_rate, batch_time,
+                         history_size)
+        ch.input = self.profile.inputs[channel]
+        self.channels[channel] = ch
+        self._setup_channel(ch)
+        self.plan = self._build_plan()
+        return ch
+
+    def _setup_channel(self, ch):
+        # Look up the config bytes and decoders of all gains, so a
+        # gain switch is a single write
+        mode = 'continuous'
+        if self.ready_mode:
+            mode = 'ready'
+        elif self.comparator:
+            mode = 'comparator'
+        table = self.profile.get_config_table(self.resolution, self.rate,
+                                              mode)
+        for gain in self.profile.gains:
+            ch.confs[gain] = table[(ch.channel, gain)]
+            ch.decoders[gain] = build_decoder(self.profile,
+                                              self.resolution, gain,
+                                              self.read_len)
+        ch.conf = ch.confs[ch.gain]
+        ch.decoder = ch.decoders[ch.gain]
+        ch.tables = None
+        if self.calibration is not None:
+            ch.tables = self.calibration.get_tables(ch.channel,
+                                                    ch.decoders)
+        if ch.range_check is not None:
+            # Limits in raw counts of every gain, a reading is in range
+            # if minval <= counts * scale <= maxval (or its calibrated
+            # value)
+            minval, maxval = ch.range_check[:2]
+            ch.range_limits = dict(
+                (dec.scale, self._count_limits(ch, dec, minval, maxval))
+                for dec in ch.decoders.values())
+
+    def _count_limits(self, ch, dec, minval, maxval):
+        # Lowest and highest counts whose value is in [minval, maxval]
+        if ch.tables is not None:
+            return self.calibration.get_limits(ch.tables[dec.scale], dec,
+                                               minval, maxval)
+        full = dec.sign_bit * dec.scale
+        return (int(math.ceil(max(minval, -2. * full) / dec.scale)),
+                int(math.floor(min(maxval, 2. * full) / dec.scale)))
+
+    def setup_range_check(self, channel, minval, maxval, count, message):
+        # Shut down once count readings in a row are out of range, like
+        # the MCU range check
+        ch = self.channels[channel]
+        if ch.range_check is not None:
+            minval = max(minval, ch.range_check[0])
+            maxval = min(maxval, ch.range_check[1])
+            count = min(count, ch.range_check[2])
+            message = ch.range_check[3]
+        ch.range_check = (minval, maxval, count, message)
+        ch.range_faults = 0
+        self._setup_channel(ch)
+
+    def _range_fault(self, ch):
+        ch.range_faults += 1
+        if ch.range_faults >= ch.range_check[2]:
+            self.dispatch(self.printer.invoke_shutdown, ch.range_check[3])
+
+    def activate(self, channel):
+        # First use of a channel - add it to the scan
+        ch = self.channels[channel]
+        if ch.active:
+            return
+        ch.active = True
+        if self.mcu_mode:
+            return
+        started = self._pause()
+        self.plan = self._build_plan()
+        self._setup_timing()
+        if started or self.connected:
+            self.start()
+
+    def get_channels(self):
+        return sorted(self.channels.keys())
+
+    def get_channel(self, channel):
+        return self.channels[channel]
+
+    def subscribe(self, channel, callback, report_time=None, decimation=1):
+        # Hand the readings of a channel to callback in batches, see
+        # ADC_subscriber. Offloaded streams call it in the worker
+        # thread, results go to the reactor through dispatch()
+        ch = self.channels[channel]
+        sub = ADC_subscriber(callback, report_time, decimation)
+        with self.lock:
+            ch.subscribers.append(sub)
+            self._update_batch_time(ch)
+        return sub
+
+    def set_report_time(self, channel, sub, report_time):
+        sub.report_time = report_time
+        self._update_batch_time(self.channels[channel])
+
+    def _update_batch_time(self, ch):
+        # The batches of a channel are flushed at the shortest report
+        # time of its subscribers
+        times = [s.report_time for s in ch.subscribers if s.report_time]
+        if times:
+            ch.batch_time = min(times)
+
+    def add_watch(self, channel, watch):
+        # Only used for the threshold window in comparator mode, the
+        # watch itself is run by its user
+        self.channels[channel].watches.append(watch)
+
+    def set_bandwidth(self, channel, bandwidth):
+        ch = self.channels[channel]
+        ch.bandwidth = max(ch.bandwidth, bandwidth)
+
+    def has_readings(self, channel, gain):
+        # True if the stream samples this channel at this gain, its
+        # history is current
+        ch = self.channels.get(channel)
+        return (self.started and ch is not None and ch in self.plan
+                and (self.autorange or ch.gain == gain))
+
+    def _build_plan(self):
+        # Smooth weighted round-robin, slots in proportion to the
+        # requested sample rates. MCU sampling fixes the slots at
+        # config time, so it scans all channels.
+        chans = [self.channels[c] for c in sorted(self.channels)
+                 if self.channels[c].active or self.mcu_mode]
+        if len(chans) <= 1:
+            return chans
+        requested = [c.sample_rate for c in chans if c.sample_rate]
+        default = min(requested) if requested else 1.
+        weights = [int(round((c.sample_rate or default) / default * 4.))
+                   for c in chans]
+        weights = [max(1, w) for w in weights]
+        gcd = weights[0]
+        for w in weights[1:]:
+            while w:
+                gcd, w = w, gcd % w
+        weights = [w // gcd for w in weights]
+        total = sum(weights)
+        scan_rate = 1. / self.scan_time
+        if requested and sum(requested) > scan_rate:
+            logging.warning("I2C_ADC requested %.1f samples/s, chip can"
+                            " only scan %.1f", sum(requested), scan_rate)
+        current = [0] * len(chans)
+        plan = []
+        for i in range(total):
+            for j, w in enumerate(weights):
+                current[j] += w
+            best = current.index(max(current))
+            current[best] -= total
+            plan.append(chans[best])
+        return plan
+
+    def queue_config(self):
+        # Queue the writes that start the conversions of the first slot
+        self.plan_pos = 0
+        if self.ready_mode:
+            # Hi_thresh MSB 1 and Lo_thresh MSB 0 turn ALERT into RDY
+            self.i2c.i2c_write([ADS_LO_THRESH, 0x00, 0x00])
+            self.i2c.i2c_write([ADS_HI_THRESH, 0x80, 0x00])
+        elif self.comparator:
+            # Open window until the first reading
+            dec = self.plan[0].decoder
+            self.window = None
+            self._write_window((-dec.sign_bit, dec.sign_bit - 1))
+        self._arm(self.plan[0])
+        self.config_queued = True
+
+    def queue_readback(self):
+        # Queue a read of the config register, its response is the
+        # first one to arrive as no reads are in flight before start()
+        self.responses.clear()
+        pointer, length, offset = self.profile.get_readback()
+        self.read_cmd.send([self.oid, pointer, length])
+        self.pointer = pointer
+
+    def check_readback(self):
+        # None while the read back is outstanding, else whether the
+        # chip took the config of the first slot. A read back that
+        # failed on the bus is sent again.
+        if not self.responses:
+            return None
+        params = self.responses.popleft()
+        if len(params['response']) < self.profile.get_readback()[1]:
+            self.stats.nacks += 1
+            self.queue_readback()
+            return None
+        return self.profile.check_readback(self.plan[0].conf,
+                                           params['response'])
+
+    def start(self):
+        if not self.plan:
+            return
+        if not self.config_queued:
+            self.queue_config()
+        self.config_queued = False
+        self.last_read_end = None
+        self.failures = 0
+        self.retry = False
+        self.recover_time = 0.
+        self.started = True
+        self._setup_timing()
+        self._start_polling()
+        if self.mcu_mode:
+            step_time = self.get_step_time() * self.interval_scale
+            frames = min(MAX_BULK_FRAMES, BULK_SIZE // (self.read_len + 1),
+                         max(1, int(BULK_TIME / step_time)))
+            self.bulk_sequence = 0
+            # query_i2c_adc clears the MCU overflow counter
+            self.bulk_status.clear()
+            self.bulk_overflows = 0
+            self.bulk_ticks = self.mcu.seconds_to_clock(step_time)
+            reg = self.read
+            if len(self.plan) == 1 and reg:
+                # Nothing else is written while the MCU samples a
+                # single slot, point the chip at the conversion
+                # register once
+                self.i2c.i2c_write(reg)
+                self.pointer = reg
+                reg = []
+            self.query_cmd.send([self.bulk_oid, self.bulk_ticks,
+                                 reg, frames])
+
+    def set_rate(self, resolution, rate):
+        # Switch resolution and data rate, restarting the stream
+        rate = self.profile.check_rate(resolution, rate)
+        started = self._pause()
+        self.resolution = resolution
+        self.rate = rate
+        for ch in self.channels.values():
+            self._setup_channel(ch)
+        self._setup_timing()
+        if self.mcu_mode and len(self.plan) > 1 and self.slot_cmd:
+            for i, ch in enumerate(self.plan):
+                self.slot_cmd.send([self.bulk_oid, i, ch.conf])
+        if started:
+            self.start()
+
+    def _pause(self):
+        # Stop stepping and drain the reads in flight before the scan
+        # changes. Returns whether the stream was running.
+        if not self.started:
+            return False
+        self.arbiter.remove_stream(self)
+        if self.mcu_mode:
+            self.query_cmd.send([self.bulk_oid, 0, [], 0])
+            self.reactor.pause(self.reactor.monotonic() + BULK_TIME)
+        # Readings in flight still use the old decoders
+        self._wait_pending()
+        self._process_responses(self.reactor.monotonic())
+        if self.worker is not None:
+            self.worker.drain()
+        return True
+
+    def _setup_timing(self):
+        self.conversion_time = self.chip_conversion_time = 1. / self.rate
+        self.chip_time_bounds = (1. / ((1. + OSC_TOLERANCE) * self.rate),
+                                 (1. + OSC_TOLERANCE) / self.rate)
+        self.poll_time = 1. / self.rate
+        # Time for a conversion of a slow chip to finish after the
+        # config write that started it
+        self.settle_time = (1. + OSC_TOLERANCE) / self.rate
+        # Shortest read of the mode, the decoders take its frames
+        if self.mcu_mode:
+            read_len = self._get_mcu_read_len()
+        else:
+            read_len = self.profile.get_read_len(self.resolution)
+        self.status_check = self.profile.get_status_check(self.resolution)
+        if len(self.plan) == 1 and self.status_check is not None:
+            # Polled faster than a fast chip converts, the stale reads
+            # are dropped and keep the conversion phase
+            self.poll_time = 1. / ((1. + OSC_TOLERANCE) * self.rate)
+        if len(self.plan) == 1 and self.plan[0].sample_rate:
+            # A single channel is polled no faster than requested
+            self.poll_time = max(self.poll_time,
+                                 1. / self.plan[0].sample_rate)
+        if read_len != self.read_len:
+            self.read_len = read_len
+            with self.lock:
+                for ch in self.channels.values():
+                    self._setup_channel(ch)
+        # A scan step reads a slot and writes the config of the next,
+        # the next read waits settle_time from the end of that write
+        self.bus_times = read, write = self.get_bus_times(
+            self.arbiter.speed)
+        self.scan_time = read + write + self.settle_time
+        # Ready mode: time from a read to the falling edge of the next
+        # conversion, with the button polling on top of the conversion
+        self.ready_timeout = read + write + 2. * max(READY_QUERY_TIME,
+                                                     self.settle_time)
+
+    def _get_mcu_read_len(self):
+        # The MCU frame size is fixed at config time, it has to hold
+        # the reads of every resolution
+        return max(self.profile.get_read_len(resolution)
+                   for resolution in self.profile.resolutions)
+
+    def get_scan_rate(self):
+        # Readings per second the stream delivers over all channels
+        return 1. / (self.get_step_time() * self.interval_scale)
+
+    def restore_config(self):
+        # Rewrite the scan configuration after foreign access
+        self._arm(self.plan[self.plan_pos])
+
+    def _start_polling(self):
+        # Give the chip one conversion period to produce its first result
+        curtime = self.reactor.monotonic()
+        self._next_poll = max(curtime, self.arm_end + self.settle_time)
+        self._last_ready = curtime
+        for ch in self.channels.values():
+            ch.next_flush = curtime + ch.batch_time
+        self.arbiter.add_stream(self, self._next_poll)
+
+    def get_step_time(self):
+        # Nominal time between two steps of the stream
+        if self.comparator and self.plan:
+            return self.get_heartbeat()
+        if len(self.plan) > 1:
+            return self.scan_time
+        return self.poll_time
+
+    def get_bus_times(self, speed):
+        # Bus time of a read (start, address, pointer, restart,
+        # address, data, stop - without pointer on MCP342x and single
+        # ADS1x1x channels) and of a config write
+        reg = self.read
+        if len(self.plan) <= 1 and not (self.ready_mode or self.comparator):
+            reg = []
+        if reg:
+            read = (9 * (2 + len(reg) + self.read_len) + 3) / float(speed)
+        else:
+            read = (9 * (1 + self.read_len) + 2) / float(speed)
+        family = self.profile.family
+        write = (9 * (1 + len(family.conf_pointer) + family.conf_size) + 2) \
+            / float(speed)
+        return read, write
+
+    def get_transaction_time(self, speed):
+        # Bus time of one step, plus the mux switch when scanning
+        read, write = self.get_bus_times(speed)
+        if len(self.plan) > 1 or self.ready_mode:
+            return read + write
+        return read
+
+    def _issue_read(self, eventtime):
+        # Read the current slot and start the conversion of the next
+        # slot right behind the read. The read is tagged with the scale
+        # of the conversion it returns (None while a new gain settles).
+        ch = self.plan[self.plan_pos]
+        scale = ch.armed_scale
+        if eventtime < ch.valid_after:
+            scale = None
+        # The conversion phase is only known when a config write
+        # started it or the RDY bit keeps the count in phase
+        armed = None
+        if (len(self.plan) > 1 or self.ready_mode
+                or self.status_check is not None):
+            armed = ch.armed
+        self.read_cmd.send([self.oid, self._get_read_reg(eventtime),
+                            self.read_len])
+        # Until a round trip was measured, wait as long as at startup
+        done = self.arbiter.reserve(eventtime, self.bus_times[0])
+        deadline = done + 2. * self.link_delay + READ_TIMEOUT
+        if self.min_rtt is None:
+            deadline = eventtime + STARTUP_TIMEOUT
+        self.pending.append((ch, scale, armed, eventtime, deadline))
+        if len(self.plan) > 1:
+            self.plan_pos = (self.plan_pos + 1) % len(self.plan)
+            self._arm(self.plan[self.plan_pos], True)
+        elif self.ready_mode:
+            self._arm(ch, True)
+
+    def _get_read_reg(self, eventtime):
+        # Pointer bytes of a conversion read, none once a read that
+        # pointed the chip at the conversion register came back
+        if self.pointer != self.read:
+            self.pointer = self.read
+            self.pointer_confirmed = False
+            self.pointer_time = eventtime
+        elif self.pointer_confirmed:
+            return []
+        return self.read
+
+    def _arm(self, ch, chained=False):
+        # Start conversions of a slot with its current gain. chained
+        # writes follow a read on the bus. The conversion starts when
+        # the write is done on the bus, behind what was queued before.
+        self.write_config(ch.conf)
+        ch.armed_scale = ch.decoder.scale
+        eventtime = self.reactor.monotonic()
+        ch.armed = (eventtime, chained)
+        self.arm_end = self.arbiter.reserve(eventtime, self.bus_times[1])
+
+    def get_read_end(self, params):
+        # Host time the read of a response completed on the bus
+        sent = params['#sent_time']
+        rtt = params['#receive_time'] - sent
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+            read_time = self.get_bus_times(self.arbiter.speed)[0]
+            self.link_delay = max(0., .5 * (rtt - read_time))
+        return params['#receive_time'] - self.link_delay
+
+    def get_conversion_end(self, read_end, armed, conversion_time=None,
+                           single=False):
+        # Estimated host time the conversion returned by a read
+        # finished. Without a known phase (armed None) the reading is
+        # on average half a conversion old.
+        if conversion_time is None:
+            conversion_time = self.conversion_time
+        if armed is None:
+            return read_end - .5 * conversion_time
+        write = self.get_bus_times(self.arbiter.speed)[1]
+        armed_time, chained = armed
+        if chained and self.last_read_end is not None:
+            start = self.last_read_end + write
+        else:
+            start = armed_time + self.link_delay + write
+        count = 1
+        if not single and not self.ready_mode:
+            count = max(1, int((read_end - start) / conversion_time))
+        return min(read_end, start + count * conversion_time)
+
+    def _set_gain(self, ch, gain):
+        ch.gain = gain
+        ch.conf = ch.confs[gain]
+        ch.decoder = ch.decoders[gain]
+        ch.range_peak = ch.range_count = 0
+        self.stats.gain_switches += 1
+        if len(self.plan) == 1 and not self.ready_mode:
+            # Continuous conversion - switch now and skip the readings
+            # of conversions started before the switch
+            self._arm(ch)
+            ch.valid_after = self.arm_end + self.settle_time
+        # Otherwise the new config is written when the slot is armed
+
+    def _autorange(self, chans, counts):
+        gains = sorted(self.profile.gains)
+        for ch, value in zip(chans, counts):
+            full = ch.decoder.sign_bit
+            value = abs(value)
+            idx = gains.index(ch.gain)
+            if value >= AUTORANGE_DOWN * full:
+                if idx > 0:
+                    self._set_gain(ch, gains[idx - 1])
+                continue
+            if value > ch.range_peak:
+                ch.range_peak = value
+            ch.range_count += 1
+            if ch.range_count < AUTORANGE_READINGS:
+                continue
+            if idx + 1 < len(gains):
+                # Peak in counts of the next gain
+                full_scale = self.profile.full_scale
+                peak = ch.range_peak * (full_scale[ch.gain]
+                                        / full_scale[gains[idx + 1]])
+                if peak < AUTORANGE_UP * full:
+                    self._set_gain(ch, gains[idx + 1])
+            ch.range_peak = ch.range_count = 0
+
+    def handle_ready(self, eventtime, state):
+        # ALERT/RDY is active low
+        self.alert_active = not state
+        if state or not self.started or self.recover_time or self.retry:
+            return
+        start = time.thread_time()
+        self._last_ready = eventtime
+        if self.comparator:
+            self.stats.alerts += 1
+            if self.pending or self.hold:
+                return
+            self._last_alert_read = eventtime
+        try:
+            self._process_responses(eventtime)
+            if not self.hold and len(self.pending) < MAX_INFLIGHT:
+                self._issue_read(eventtime)
+                if self.comparator:
+                    # Collect the response with the next step
+                    self._next_poll = eventtime + self.get_heartbeat()
+                    self.arbiter.wake(self, eventtime + self.poll_time)
+        except Exception:
+            logging.exception("I2C_ADC ready handling failed")
+            self.handle_error(eventtime)
+        self.stats.reactor_time += time.thread_time() - start
+
+    def _read_failed(self, eventtime, rearm=False):
+        # The next read of the slot is the retry, after RETRY_BUDGET
+        # failures in a row the chip is reconfigured
+        self.stats.errors += 1
+        self.failures += 1
+        # A failed read may not have set the pointer
+        self.pointer = None
+        if self.failures > RETRY_BUDGET:
+            self._recover(eventtime)
+            return
+        self.stats.retries += 1
+        if rearm:
+            self.retry = True
+
+    def _resync(self, eventtime):
+        # Abandon the reads in flight. A response is sent after its
+        # read reached the MCU, so late responses of the abandoned
+        # reads are the ones sent before now and get dropped.
+        self.pending.clear()
+        self.resync_time = eventtime
+        self.pointer = None
+
+    def _recover(self, eventtime):
+        # Abandon the reads in flight and rewrite the whole config
+        # after the backoff
+        self.stats.recoveries += 1
+        self._resync(eventtime)
+        self.failures = 0
+        self.retry = False
+        backoff = min(RECOVERY_BACKOFF_MAX,
+                      RECOVERY_BACKOFF * 2. ** self.recoveries)
+        self.recoveries += 1
+        self.recover_time = eventtime + backoff
+        logging.warning("I2C_ADC %s at 0x%02x: reconfiguring in %.2fs",
+                        self.profile.name, self.i2c.get_i2c_address(),
+                        backoff)
+
+    def _read_timeout(self, eventtime):
+        # The oldest read got no response, the responses of the reads
+        # behind it can not be matched anymore
+        self.stats.timeouts += 1
+        self._resync(eventtime)
+        self._read_failed(eventtime)
+
+    def handle_error(self, eventtime):
+        # A step raised, returns the time of the next step
+        self.stats.errors += 1
+        if self.mcu_mode:
+            return eventtime + BULK_TIME
+        self._recover(eventtime)
+        return self.recover_time
+
+    def step(self, eventtime):
+        # Decode the responses that arrived since the last step
+        self._process_responses(eventtime)
+        step_time = self.get_step_time() * self.interval_scale
+        if self.mcu_mode:
+            # The MCU runs the reads, just collect its messages
+            self._check_bulk_status(eventtime)
+            return eventtime + BULK_TIME
+        if self.recover_time and not self.hold:
+            if eventtime < self.recover_time:
+                return self.recover_time
+            # Backoff over - rewrite the config and start again
+            self.recover_time = 0.
+            self.queue_config()
+            self.config_queued = False
+            self.last_read_end = None
+            self._last_ready = eventtime
+            self._next_poll = self.arm_end + self.settle_time
+            return self._next_poll
+        if self.pending and eventtime > self.pending[0][4]:
+            self._read_timeout(eventtime)
+            if self.recover_time:
+                return self.recover_time
+        if self.retry and not self.hold:
+            # Rewrite the config of the slot and read it once its
+            # conversion finished
+            self.retry = False
+            self._arm(self.plan[self.plan_pos])
+            self._last_ready = eventtime
+            self._next_poll = self.arm_end + self.settle_time
+            return self._next_poll
+        if self.ready_mode:
+            # The pin paces the reads, the step only flushes batches
+            # and restarts the conversion if an edge got lost
+            timeout = self._last_ready + self.ready_timeout
+            if eventtime < timeout or self.hold:
+                return max(timeout, eventtime + self.poll_time)
+            self._last_ready = eventtime
+            if self.alert_active and not self.pending:
+                # The pin is still low: the conversion finished before
+                # the button polling saw the pin go high, read it
+                self._issue_read(eventtime)
+            else:
+                self.stats.ready_misses += 1
+                self._arm(self.plan[self.plan_pos])
+            return eventtime + self.ready_timeout
+        if self.comparator:
+            return self._comparator_step(eventtime)
+        if self.draining and not self.pending:
+            self.draining = False
+        if self.hold or self.draining or len(self.pending) >= MAX_INFLIGHT:
+            # Bus is busy - retry at the next conversion. Reads whose
+            # response got lost keep the queue full, so it has to
+            # drain (or time out) before reads go on.
+            if not self.hold:
+                self.stats.overruns += 1
+                self.draining = True
+            return eventtime + step_time
+        self._issue_read(eventtime)
+        if len(self.plan) > 1:
+            # The next slot converts from the end of its config write,
+            # which may queue behind other transactions on the bus
+            self._next_poll = max(eventtime + step_time,
+                                  self.arm_end + self.settle_time)
+        else:
+            self._next_poll += step_time
+            if self._next_poll < eventtime:
+                # Polling fell behind - skip the missed conversions
+                self._next_poll = eventtime + step_time
+        return self._next_poll
+
+    def _comparator_step(self, eventtime):
+        # Read again if ALERT is still latched a few conversions after
+        # the last read, the window moved on meanwhile
+        recheck = self._last_alert_read + 4. * self.settle_time
+        if not self.hold and not self.pending and (
+                eventtime >= self._next_poll
+                or (self.alert_active and eventtime >= recheck)):
+            self._last_alert_read = eventtime
+            self._issue_read(eventtime)
+            self._next_poll = eventtime + self.get_heartbeat()
+        if self.pending:
+            return eventtime + self.poll_time
+        if self.alert_active:
+            return min(self._next_poll,
+                       max(recheck, eventtime + self.poll_time))
+        return self._next_poll
+
+    def get_heartbeat(self):
+        # Longest time between two reads in comparator mode: the
+        # shortest heartbeat of the watches of the channel, else its
+        # batch time
+        ch = self.plan[0]
+        beats = [w.heartbeat for w in ch.watches if w.heartbeat]
+        return min(beats or [ch.batch_time])
+
+    def _update_window(self):
+        # Threshold window in counts in which no watch of the channel
+        # reports, ALERT fires when a conversion leaves it
+        ch = self.plan[0]
+        dec = ch.decoder
+        low, high = float('-inf'), float('inf')
+        for watch in ch.watches:
+            window = watch.get_window()
+            if window is not None:
+                low = max(low, window[0])
+                high = min(high, window[1])
+        window = self._count_limits(ch, dec, low, high)
+        window = (max(window[0], -dec.sign_bit),
+                  min(window[1], dec.sign_bit - 1))
+        if window != self.window:
+            self._write_window(window)
+
+    def _write_window(self, window):
+        # Lo_thresh / Hi_thresh take counts left justified like the
+        # conversion data
+        shift = self.plan[0].decoder.shift
+        for pointer, counts in zip((ADS_LO_THRESH, ADS_HI_THRESH), window):
+            self.i2c.i2c_write([pointer] + list(bytearray(
+                _BE16.pack(counts << shift))))
+        self.pointer = [ADS_HI_THRESH]
+        self.window = window
+
+    def _process_responses(self, eventtime):
+        responses = self.responses
+        pending = self.pending
+        stored = False
+        if responses:
+            # Decode all frames of this step in one go
+            chans = []
+            scales = []
+            times = []
+            data = bytearray()
+            round_trip = self.stats.round_trip.add
+            read_end = self.get_read_end
+            conversion_end = self.get_conversion_end
+            status_check = self.status_check
+            resync_time = self.resync_time
+            # A single channel in continuous conversion, its reads may
+            # come before the next conversion finished
+            continuous = len(self.plan) == 1 and not self.ready_mode
+            period = self.chip_conversion_time if continuous else None
+            while responses:
+                params = responses.popleft()
+                if not pending or params['#sent_time'] < resync_time:
+                    # Response of a read that was dropped by stop() or
+                    # abandoned after a lost response, its round trip
+                    # still tells the link delay
+                    read_end(params)
+                    self.stats.dropped += 1
+                    continue
+                ch, scale, armed, sent, deadline = pending.popleft()
+                response = params['response']
+                if len(response) < ch.decoder.frame_size:
+                    # Read failed on the bus
+                    self.stats.nacks += 1
+                    self._read_failed(eventtime)
+                    continue
+                if not self.pointer_confirmed and sent >= self.pointer_time:
+                    # Reads behind this one leave the pointer out
+                    self.pointer_confirmed = True
+                round_trip(params['#receive_time'] - params['#sent_time'])
+                end = read_end(params)
+                rTime = conversion_end(end, armed, period)
+                prev_end = self.last_read_end
+                self.last_read_end = end
+                if scale is None:
+                    # Conversion may predate a gain switch
+                    self.stats.discarded += 1
+                    continue
+                if status_check is not None:
+                    status = self._check_status(ch, bytearray(response))
+                    if status < 2 and continuous and armed is ch.armed:
+                        self._track_conversions(armed, prev_end, end,
+                                                status)
+                        period = self.chip_conversion_time
+                        rTime = conversion_end(end, armed, period)
+                    if status:
+                        if status > 1 or not continuous:
+                            self._read_failed(eventtime, status > 1)
+                        continue
+                self.failures = self.recoveries = 0
+                chans.append(ch)
+                scales.append(scale)
+                times.append(rTime)
+                data += response
+            if chans:
+                block = (eventtime, chans[0].decoder, data, len(chans),
+                         chans, times, scales, None)
+                if self.worker is not None:
+                    self.worker.push(self, block)
+                else:
+                    counts = self.process_frames(*block)
+                    if self.autorange:
+                        self._autorange(chans, counts)
+                    stored = True
+        if self.bulk:
+            self._process_bulk(eventtime)
+        if self.worker is not None:
+            return
+        self.flush_batches(eventtime)
+        if stored and self.comparator:
+            # The watches saw the new readings, move the window
+            self._update_window()
+
+    def _track_conversions(self, armed, prev_end, end, stale):
+        # Each read bounds the chip's conversion time through the RDY
+        # bit, the oscillator is only known within OSC_TOLERANCE
+        period = self.chip_conversion_time
+        if prev_end is None or end - prev_end >= period:
+            # Reads further apart than a conversion always see a new one
+            return
+        write = self.get_bus_times(self.arbiter.speed)[1]
+        start = armed[0] + self.link_delay + write
+        if stale:
+            # Conversion count finished before the previous read and
+            # the next one after this read
+            count = int(round((.5 * (prev_end + end - period) - start)
+                              / period))
+            if count < 1:
+                return
+            low = (end - start) / (count + 1)
+            high = (prev_end - start) / count
+        else:
+            # Conversion count finished between the reads
+            count = int(round((.5 * (prev_end + end) - start) / period))
+            if count < 1:
+                return
+            low, high = (prev_end - start) / count, (end - start) / count
+        old_low, old_high = self.chip_time_bounds
+        if low < old_high and high > old_low:
+            low, high = max(low, old_low), min(high, old_high)
+        # Otherwise the oscillator moved, start over from this read
+        self.chip_time_bounds = (low, high)
+        self.chip_conversion_time = .5 * (low + high)
+
+    def process_frames(self, eventtime, decoder, data, count, chans, times,
+                       scales, keep):
+        # Decode the raw frames of a step and store their readings,
+        # keep selects the frames of chans and times (None for all).
+        # Runs on the worker thread for offloaded streams.
+        counts = decode_frames(decoder, data, count)
+        if keep is not None:
+            counts = [counts[i] for i in keep]
+        self._store(chans, times, counts, scales)
+        return counts
+
+    def flush_batches(self, eventtime):
+        for ch in self.plan:
+            # Comparator mode readings are events, hand them out at once
+            if ch.batch and (eventtime >= ch.next_flush or self.comparator):
+                batch = ch.batch
+                ch.batch = []
+                ch.next_flush = eventtime + ch.batch_time
+                ch.samples += len(batch)
+                if ch.subscribers:
+                    start = time.thread_time()
+                    for sub in ch.subscribers:
+                        sub.add(eventtime, batch, ch.batch_time)
+                    ch.callback_time.add(time.thread_time() - start)
+
+    def dispatch(self, callback, *args):
+        # Run callback in the reactor - right away, or once the worker
+        # thread finished the blocks it is processing
+        if self.worker is None:
+            callback(*args)
+        else:
+            self.worker.results.append((self, callback, args))
+
+    def _check_status(self, ch, data, pos=0):
+        # 0 for a new reading, 1 if it was read before, 2 if the chip
+        # runs the config of another slot (lost write or reset)
+        offset, mask, ready = self.status_check
+        conf = data[pos + offset]
+        if (conf ^ ch.conf[-1]) & ~mask & 0xff:
+            self.stats.stale += 1
+            return 2
+        if conf & mask != ready:
+            self.stats.stale += 1
+            return 1
+        return 0
+
+    def _check_bulk_status(self, eventtime):
+        # Conversions the MCU timer skipped because the read of the
+        # previous one had not run yet count as overruns
+        while self.bulk_status:
+            overflows = self.bulk_status.popleft()['overflows']
+            if overflows > self.bulk_overflows:
+                self.stats.overruns += overflows - self.bulk_overflows
+            self.bulk_overflows = overflows
+        if eventtime >= self.next_status:
+            self.next_status = eventtime + BULK_STATUS_TIME
+            self.status_cmd.send([self.bulk_oid])
+
+    def _process_bulk(self, eventtime):
+        # Frames are the read data followed by the slot index
+        plan = self.plan
+        decoder = plan[0].decoder
+        frame_size = decoder.frame_size + 1
+        decoder = decoder._replace(frame_size=frame_size)
+        mcu = self.mcu
+        # The MCU timer starts each read, it ends one read bus time
+        # later. The next slot is armed right behind each read.
+        read, write = self.get_bus_times(self.arbiter.speed)
+        if len(plan) > 1:
+            # The last conversion that finished before the read ended
+            interval = (mcu.clock_to_print_time(self.bulk_ticks)
+                        - mcu.clock_to_print_time(0))
+            count = max(1, int((interval - write) / self.conversion_time))
+            age = interval - read - write - count * self.conversion_time
+        else:
+            age = .5 * self.conversion_time - read
+        while self.bulk:
+            params = self.bulk.popleft()
+            sequence = params['sequence']
+            if sequence != self.bulk_sequence:
+                self.stats.lost += (sequence - self.bulk_sequence) & 0xffff
+            self.bulk_sequence = (sequence + 1) & 0xffff
+            data = bytearray(params['data'])
+            count = len(data) // frame_size
+            slots = data[frame_size-1::frame_size]
+            # Reads ran every bulk_ticks from the MCU clock of the first
+            # frame on, map their print times to host time
+            clock = mcu.clock32_to_clock64(params['clock'])
+            rTime = params['#receive_time']
+            offset = rTime - mcu.estimated_print_time(rTime) - age
+            ticks = self.bulk_ticks
+            times = [mcu.clock_to_print_time(clock + i * ticks) + offset
+                     for i in range(count)]
+            keep = None
+            if count and (max(slots) & FRAME_ERROR
+                          or self.status_check is not None):
+                # Drop the frames of failed reads and stale conversions
+                keep = []
+                for i, slot in enumerate(slots):
+                    if slot & FRAME_ERROR:
+                        self.stats.nacks += 1
+                        self.stats.errors += 1
+                    elif self.status_check is None or not \
+                            self._check_status(plan[slot], data,
+                                               i * frame_size):
+                        keep.append(i)
+                slots = [slots[i] for i in keep]
+                times = [times[i] for i in keep]
+            block = (eventtime, decoder, data, count,
+                     [plan[slot] for slot in slots], times, None, keep)
+            if self.worker is not None:
+                self.worker.push(self, block)
+            else:
+                self.process_frames(*block)
+
+    def refresh_calibration(self, channel):
+        # Rebuild the tables after the calibration of a channel changed
+        if channel in self.channels:
+            with self.lock:
+                self._setup_channel(self.channels[channel])
+
+    def convert(self, channel, gain, counts, dec):
+        # Counts of a reading outside of the stream to its value
+        if self.calibration is None \
+                or not self.calibration.is_calibrated(channel):
+            return counts * dec.scale
+        return self.calibration.get_function(channel, gain)(
+            counts * dec.scale)
+
+    def _store(self, chans, times, counts, scales=None):
+        # Every reading is scaled with the gain it was converted at,
+        # calibrated channels look the value up in their tables
+        if scales is None:
+            scales = [ch.decoder.scale for ch in chans]
+        self.stats.samples += len(chans)
+        if self.captures:
+            for capture in list(self.captures):
+                capture.add(self, chans, times, counts, scales)
+        for ch, rTime, value, scale in zip(chans, times, counts, scales):
+            if ch.tables is None:
+                rVolt = value * scale
+            else:
+                rVolt = ch.tables[scale][value]
+            ch.history.append(rTime, rVolt)
+            ch.batch.append((rTime, rVolt))
+            limits = ch.range_limits
+            if limits is not None:
+                low, high = limits[scale]
+                if low <= value <= high:
+                    ch.range_faults = 0
+                else:
+                    self._range_fault(ch)
+
+    def write_config(self, conf):
+        self.i2c.i2c_write(conf)
+        self.pointer = conf[:len(self.profile.family.conf_pointer)]
+
+    def i2c_read(self, write, read_len):
+        # Blocking read outside of the pipeline. The query takes over
+        # the response handler of the bus, so wait for the reads in
+        # flight and reinstall the handler afterwards.
+        self._wait_pending()
+        hold = self.hold
+        self.hold = True
+        self.pointer = None
+        try:
+            params = self.i2c.i2c_read(write, read_len)
+            self.pointer = list(write)
+            return params
+        finally:
+            self.hold = hold
+            if self.read_cmd is not None:
+                self._register_response()
+
+    def read_single(self, conf, decoder, conversion_time):
+        # Blocking single shot, the stream holds its reads meanwhile.
+        # Returns the data response and the send time of the config.
+        profile = self.profile
+        pointer, length, offset = profile.get_readback()
+        size = profile.family.conf_size
+        self._wait_pending()
+        self.hold = True
+        try:
+            self.write_config(conf)
+            armed = self.reactor.monotonic()
+            self.reactor.pause(armed + 1.05 * conversion_time)
+            delay = .1 * conversion_time
+            for retry in range(RETRY_BUDGET + 1):
+                params = self.i2c_read(pointer, length)
+                value = 0
+                for byte in bytearray(
+                        params['response'][offset:offset+size]):
+                    value = value << 8 | byte
+                if profile.conversion_done(value):
+                    break
+                self.stats.stale += 1
+                self.stats.retries += 1
+                self.reactor.pause(self.reactor.monotonic() + delay)
+                delay *= 2.
+            else:
+                self.stats.errors += 1
+                raise self.printer.command_error(
+                    "I2C_ADC %s: conversion did not finish" % (
+                        profile.name,))
+            if pointer:
+                # ADS1x1x: the data is in the conversion register
+                params = self.i2c_read(profile.read_pointer,
+                                       decoder.frame_size)
+        finally:
+            self.hold = False
+        return params, armed
+
+    def _wait_pending(self):
+        hold = self.hold
+        self.hold = True
+        try:
+            while self.pending and self.read_cmd is not None:
+                eventtime = self.reactor.pause(
+                    self.reactor.monotonic() + 0.001)
+                self._process_responses(eventtime)
+                if self.pending and eventtime > self.pending[0][4]:
+                    self._read_timeout(eventtime)
+        finally:
+            self.hold = hold
+
+    def get_cpu_load(self, eventtime):
+        # Share of a second the reactor and the worker thread spent on
+        # the stream since the stats were reset
+        elapsed = max(eventtime - self.stats_time, .001)
+        return (self.stats.reactor_time / elapsed,
+                self.stats.worker_time / elapsed)
+
+    def get_status(self, eventtime):
+        reactor_load, worker_load = self.get_cpu_load(eventtime)
+        status = {
+            'resolution': self.resolution,
+            'rate': self.rate,
+            'offload': self.worker is not None,
+            'reactor_load': reactor_load,
+            'worker_load': worker_load,
+            'stats': self.stats.get_status(),
+            'channels': dict(('ch%d' % (c + 1,), ch.get_status())
+                             for c, ch in self.channels.items()),
+        }
+        if self.rate_control is not None:
+            status['adaptive'] = self.rate_control.get_status()
+        return status
+
+    def reset_stats(self):
+        self.stats.reset()
+        self.stats_time = self.reactor.monotonic()
+        for ch in self.channels.values():
+            ch.reset_stats()
+
+# Adaptive rate control
+#
+# The slowest rate that still gives every channel its readings per
+# report, its bandwidth and a reading per noise floor of change has
+# the least bus load and the best resolution. Slower rates are only
+# taken after they were sufficient for ADAPTIVE_HOLD.
+class ADC_rate_control:
+    def __init__(self, printer, name, stream):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.name = name
+        self.stream = stream
+        # (resolution, rate) pairs, slowest first
+        self.candidates = sorted(stream.profile.get_candidates(),
+                                 key=lambda c: c[1])
+        self.demand = 0.
+        self.transitions = 0
+        self._slower_since = None
+        stream.rate_control = self
+        self.timer = self.reactor.register_timer(self._update)
+        printer.register_event_handler("klippy:ready", self._handle_ready)
+
+    def _handle_ready(self):
+        self.reactor.update_timer(self.timer, self.reactor.monotonic()
+                                  + ADAPTIVE_TIME + ADAPTIVE_WINDOW)
+
+    def _analyse(self, ch, eventtime):
+        # Slope in V/s and noise in V of the recent readings
+        times, values = ch.history.get_window(eventtime - ADAPTIVE_WINDOW)
+        count = len(times)
+        if count < 3 or times[-1] <= times[0]:
+            return 0., 0.
+        dsum = dsq = 0.
+        prev = values[0]
+        for value in values[1:]:
+            diff = value - prev
+            dsum += diff
+            dsq += diff * diff
+            prev = value
+        n = count - 1
+        noise = math.sqrt(max(0., dsq / n - (dsum / n) ** 2) / 2.)
+        slope = abs(values[-1] - values[0]) / (times[-1] - times[0])
+        return slope, noise
+
+    def _required_rate(self, resolution, rate, signals):
+        stream = self.stream
+        total = 0.
+        for ch, slope, noise in signals:
+            need = max(ADAPTIVE_READINGS / ch.batch_time,
+                       ch.sample_rate or 0., 2. * ch.bandwidth)
+            if slope:
+                lsb = ch.decoder.scale * (1 << stream.resolution) \
+                    / (1 << resolution)
+                floor = max(noise * math.sqrt(rate / stream.rate), lsb)
+                need = max(need, slope / floor)
+            total += need
+        return total
+
+    def _capacity(self, rate):
+        stream = self.stream
+        if len(stream.plan) > 1:
+            rate /= 1.05
+        return rate / stream.interval_scale
+
+    def _choose(self, eventtime):
+        stream = self.stream
+        signals = [(ch,) + self._analyse(ch, eventtime)
+                   for ch in stream.plan]
+        for resolution, rate in self.candidates:
+            need = self._required_rate(resolution, rate, signals)
+            if self._capacity(rate) >= need:
+                return resolution, rate, need
+        resolution, rate = self.candidates[-1]
+        return resolution, rate, need
+
+    def _update(self, eventtime):
+        stream = self.stream
+        if not stream.started:
+            return eventtime + ADAPTIVE_TIME
+        with stream.lock:
+            resolution, rate, self.demand = self._choose(eventtime)
+        if (resolution, rate) == (stream.resolution, stream.rate):
+            self._slower_since = None
+            return eventtime + ADAPTIVE_TIME
+        if rate < stream.rate:
+            # Only slow down once the demand settled
+            if self._slower_since is None:
+                self._slower_since = eventtime
+            if eventtime < self._slower_since + ADAPTIVE_HOLD:
+                return eventtime + ADAPTIVE_TIME
+        self._slower_since = None
+        logging.info("I2C_ADC %s: adaptive switch from %d bit %g SPS to"
+                     " %d bit %g SPS (demand %.1f readings/s)", self.name,
+                     stream.resolution, stream.rate, resolution, rate,
+                     self.demand)
+        self.transitions += 1
+        stream.set_rate(resolution, rate)
+        return self.reactor.monotonic() + ADAPTIVE_TIME + ADAPTIVE_WINDOW
+
+    def get_status(self):
+        return {
+            'demand': self.demand,
+            'transitions': self.transitions,
+        }
+
+# Capture into a memory mapped file
+#
+# The mapping keeps disk I/O out of the reactor, the flush runs in a
+# helper thread. Layout (little endian): a 32 byte preamble "I2CADC01",
+# header_size, record_size, record_count, entry_count (u32), then
+# CAPTURE_ENTRIES entries (name 22s, chip u8, channel u8, volts per
+# count f64) and from header_size on 16 byte records (time f64,
+# counts i32, chip, channel, entry, pad u8).
+class ADC_capture:
+    def __init__(self, printer, filename, sources, duration=None,
+                 samples=None, callback=None):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.filename = filename
+        self.callback = callback
+        # stream -> (chip index, chip name, channels)
+        self.sources = {}
+        for idx, (name, stream, channels) in enumerate(sources):
+            self.sources[stream] = (idx, name, frozenset(channels))
+        if samples:
+            self.max_records = samples
+        else:
+            rate = sum(stream.get_scan_rate() for stream in self.sources)
+            self.max_records = int(rate * duration * 1.25) + 64
+        self.limit = samples
+        self.entries = {}
+        self.entry_data = []
+        self.count = 0
+        self.truncated = False
+        # No more readings wanted, finish() is on its way
+        self.full = False
+        self.done = False
+        self.start_time = self.reactor.monotonic()
+        self.end_time = None
+        size = CAPTURE_HEADER_SIZE + self.max_records * CAPTURE_RECORD.size
+        self.file = open(filename, 'w+b')
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.pos = CAPTURE_HEADER_SIZE
+        # Offloaded streams add their readings from the worker thread
+        self.lock = threading.Lock()
+        self.timer = None
+        if duration:
+            self.end_time = self.start_time + duration
+            self.timer = self.reactor.register_timer(
+                self._handle_end, self.end_time)
+        for stream in self.sources:
+            stream.captures.append(self)
+
+    def _entry(self, chip, name, ch, scale):
+        key = (chip, ch.channel, scale)
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.entry_data) >= CAPTURE_ENTRIES:
+                return None
+            entry = self.entries[key] = len(self.entry_data)
+            self.entry_data.append(CAPTURE_ENTRY.pack(
+                name.encode()[:22], chip, ch.channel + 1, scale))
+        return entry
+
+    def add(self, stream, chans, times, counts, scales):
+        with self.lock:
+            if self.done or self.full:
+                return
+            self._add(stream, chans, times, counts, scales)
+            self.full = self.truncated or bool(
+                self.limit and self.count >= self.limit)
+        if self.full:
+            stream.dispatch(self.finish)
+
+    def _add(self, stream, chans, times, counts, scales):
+        chip, name, channels = self.sources[stream]
+        start_time = self.start_time
+        end_time = self.end_time or self.reactor.NEVER
+        pack = CAPTURE_RECORD.pack
+        buf = bytearray()
+        for ch, rTime, value, scale in zip(chans, times, counts, scales):
+            if ch.channel not in channels \
+                    or rTime < start_time or rTime > end_time:
+                continue
+            entry = self._entry(chip, name, ch, scale)
+            if entry is None:
+                continue
+            buf += pack(rTime, value, chip, ch.channel + 1, entry)
+        count = len(buf) // CAPTURE_RECORD.size
+        space = self.max_records - self.count
+        if count > space:
+            # More readings than the file was sized for
+            count = space
+            del buf[count * CAPTURE_RECORD.size:]
+            self.truncated = True
+        self.mm[self.pos:self.pos + len(buf)] = buf
+        self.pos += len(buf)
+        self.count += count
+
+    def _handle_end(self, eventtime):
+        self.finish()
+        return self.reactor.NEVER
+
+    def finish(self):
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+        for stream in self.sources:
+            stream.captures.remove(self)
+        if self.timer is not None:
+            self.reactor.unregister_timer(self.timer)
+            self.timer = None
+        self.mm[:CAPTURE_PREAMBLE.size] = CAPTURE_PREAMBLE.pack(
+            CAPTURE_MAGIC, CAPTURE_HEADER_SIZE, CAPTURE_RECORD.size,
+            self.count, len(self.entry_data))
+        table = b''.join(self.entry_data)
+        self.mm[32:32 + len(table)] = table
+        if self.truncated:
+            logging.warning("I2C_ADC capture %s full after %d readings",
+                            self.filename, self.count)
+        size = self.pos
+        mm, f = self.mm, self.file
+        self.mm = self.file = None
+        def flush():
+            mm.flush()
+            mm.close()
+            f.truncate(size)
+            f.close()
+            if self.callback is not None:
+                self.reactor.register_async_callback(
+                    lambda e: self.callback(self))
+        threading.Thread(target=flush).start()
+
+    def get_status(self):
+        return {
+            'file': self.filename,
+            'samples': self.count,
+            'done': self.done,
+            'truncated': self.truncated,
+        }
+
+class ADC_capture_manager:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.streams = {}
+        self.last = None
+        gcode = printer.lookup_object('gcode')
+        gcode.register_command('ADC_CAPTURE', self.cmd_adc_capture,
+                               desc="Capture ADC readings into a file")
+
+    def register_stream(self, name, stream):
+        self.streams[name] = stream
+
+    def start_capture(self, filename, chips, channels=None, duration=None,
+                      samples=None, callback=None):
+        # Capture the given chips for duration seconds or until samples
+        # readings were taken. channels maps chip names to the channels
+        # (mux settings) to capture, None captures all channels in use.
+        if not duration and not samples:
+            raise self.printer.command_error(
+                "ADC_CAPTURE needs a duration or a sample count")
+        sources = []
+        for name in chips:
+            stream = self.streams.get(name)
+            if stream is None:
+                raise self.printer.command_error(
+                    "Unknown I2C_ADC chip '%s'" % (name,))
+            chans = stream.get_channels()
+            if channels is not None:
+                chans = [c for c in chans if c in channels.get(name, ())]
+            if not chans:
+                raise self.printer.command_error(
+                    "I2C_ADC chip '%s' has none of the channels" % (name,))
+            for c in chans:
+                stream.activate(c)
+            sources.append((name, stream, chans))
+        self.last = ADC_capture(self.printer, filename, sources, duration,
+                                samples, callback)
+        return self.last
+
+    def cmd_adc_capture(self, gcmd):
+        chips = [n.strip() for n in gcmd.get('CHIP').split(',')]
+        inputs = gcmd.get('CHANNEL', None)
+        channels = None
+        if inputs is not None:
+            # Input names or numbers, as in the channel option
+            channels = {}
+            for name in chips:
+                stream = self.streams.get(name)
+                if stream is None:
+                    continue
+                chans = channels[name] = []
+                for c in inputs.split(','):
+                    mux = stream.profile.lookup_input(c)
+                    if mux is None:
+                        raise gcmd.error(
+                            "ADC_CAPTURE: I2C_ADC chip '%s' has no input"
+                            " '%s'" % (name, c.strip()))
+                    chans.append(mux)
+        duration = gcmd.get_float('DURATION', 0., minval=0.)
+        samples = gcmd.get_int('SAMPLES', 0, minval=0)
+        filename = os.path.expanduser(gcmd.get(
+            'FILE', '/tmp/adc_capture_%d.bin' % (int(
+                self.reactor.monotonic()),)))
+        def report(capture):
+            gcmd.respond_info("ADC_CAPTURE: %d readings written to %s%s"
+                              % (capture.count, capture.filename,
+                                 " (file full)" if capture.truncated
+                                 else ""))
+        capture = self.start_capture(filename, chips, channels,
+                                     duration, samples, report)
+        gcmd.respond_info("ADC_CAPTURE: capturing into %s" % (filename,))
+        if gcmd.get_int('WAIT', 0):
+            while not capture.done:
+                self.reactor.pause(self.reactor.monotonic() + .1)
+
+    def get_status(self, eventtime):
+        if self.last is None:
+            return {}
+        return self.last.get_status()
+
+# Worker thread
+#
+# Offloaded chips hand the raw frames of every step to one shared
+# worker thread, which decodes, stores, captures and filters them.
+# Reports go back to the reactor once per round. A thread and not a
+# process, so the histories, filters and captures stay shared.
+class ADC_worker:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.ring = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # Report callbacks queued by the current worker round
+        self.results = []
+        # Blocks queued and blocks processed so far
+        self.queued = self.processed = 0
+        self.running = False
+        self.thread = None
+        printer.register_event_handler("klippy:disconnect",
+                                       self._handle_disconnect)
+
+    def push(self, stream, block):
+        # Queue the raw frames of a step (reactor side)
+        if len(self.ring) >= WORKER_RING_SIZE:
+            stream.stats.overflows += 1
+            return
+        self.ring.append((stream, block))
+        self.queued += 1
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._run,
+                                           name="i2c_adc worker")
+            self.thread.daemon = True
+            self.thread.start()
+        elif len(self.ring) >= WORKER_WAKE_BLOCKS:
+            self.wakeup.set()
+
+    def drain(self):
+        # Wait for the blocks queued so far, not for an empty ring
+        queued = self.queued
+        self.wakeup.set()
+        while self.processed < queued:
+            self.reactor.pause(self.reactor.monotonic() + .001)
+
+    def _handle_disconnect(self):
+        self.running = False
+        self.wakeup.set()
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(WORKER_PERIOD)
+            self.wakeup.clear()
+            self._round()
+
+    def _round(self):
+        # Only the blocks queued so far, a worker that falls behind
+        # still hands back its reports every round
+        for i in range(len(self.ring)):
+            stream, block = self.ring.popleft()
+            start = time.thread_time()
+            with self.lock:
+                try:
+                    stream.process_frames(*block)
+                    stream.flush_batches(block[0])
+                except Exception:
+                    logging.exception("I2C_ADC worker failed")
+            stream.stats.worker_time += time.thread_time() - start
+            self.processed += 1
+        results = self.results
+        if results:
+            self.results = []
+            self.reactor.register_async_callback(
+                lambda e, results=results: self._report(results))
+
+    def _report(self, results):
+        for stream, callback, args in results:
+            start = time.thread_time()
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception("I2C_ADC report callback failed")
+            stream.stats.reactor_time += time.thread_time() - start
+
+# Chip startup
+#
+# One connect handler queues the config writes and read backs of all
+# chips back to back and waits once, not once per chip.
+class ADC_startup:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.chips = []
+        self.connect_time = 0.
+        self.configured = 0
+        self.deferred = 0
+        printer.register_event_handler("klippy:connect",
+                                       self.handle_connect)
+
+    def register_chip(self, chip):
+        self.chips.append(chip)
+
+    def handle_connect(self):
+        start = self.reactor.monotonic()
+        active = []
+        for chip in self.chips:
+            stream = chip.stream
+            stream.connected = True
+            if stream.plan:
+                stream.queue_config()
+                stream.queue_readback()
+                active.append(chip)
+        results = [None] * len(active)
+        deadline = start + STARTUP_TIMEOUT
+        while None in results:
+            for i, chip in enumerate(active):
+                if results[i] is None:
+                    results[i] = chip.stream.check_readback()
+            eventtime = self.reactor.monotonic()
+            if None not in results or eventtime > deadline:
+                break
+            self.reactor.pause(eventtime + .001)
+        for chip, result in zip(active, results):
+            if result is None:
+                chip.stream.stats.errors += 1
+                logging.warning("I2C_ADC %s: no config read back within"
+                                " %.1fs", chip.name, STARTUP_TIMEOUT)
+            elif not result:
+                raise self.printer.config_error(
+                    "I2C_ADC %s: chip did not accept its configuration,"
+                    " check sensor_ID (%s)" % (chip.name, chip.deviceId))
+        for chip in self.chips:
+            chip.handle_connect()
+        self.configured = len(active)
+        self.deferred = len(self.chips) - len(active)
+        self.connect_time = self.reactor.monotonic() - start
+        logging.info("I2C_ADC startup: %d chips configured in %.1fms,"
+                     " %d deferred", self.configured,
+                     self.connect_time * 1000., self.deferred)
+
+    def get_status(self, eventtime):
+        return {
+            'chips': len(self.chips),
+            'configured': self.configured,
+            'deferred': self.deferred,
+            'connect_time': self.connect_time,
+        }
+
+def lookup_startup(printer):
+    startup = printer.lookup_object('i2c_adc_startup', None)
+    if startup is None:
+        startup = ADC_startup(printer)
+        printer.add_object('i2c_adc_startup', startup)
+    return startup
+
+def lookup_capture(printer):
+    capture = printer.lookup_object('i2c_adc_capture', None)
+    if capture is None:
+        capture = ADC_capture_manager(printer)
+        printer.add_object('i2c_adc_capture', capture)
+    return capture
+
+def lookup_worker(printer):
+    worker = printer.lookup_object('i2c_adc_worker', None)
+    if worker is None:
+        worker = ADC_worker(printer)
+        printer.add_object('i2c_adc_worker', worker)
+    return worker
+
+# Bus arbiter
+#
+# One timer steps all streams of a bus, staggered so the conversion
+# wait of one chip is filled with the transactions of the others.
+class ADC_bus_arbiter:
+    def __init__(self, printer, name, speed):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.name = name
+        self.speed = speed
+        self.streams = []
+        self.schedule = []
+        self.utilization = 0.
+        self.interval_scale = 1.
+        # Estimated time the transactions queued so far are done
+        self.bus_free = 0.
+        # Stream in its step, None once it got removed
+        self.stepping = None
+        self.bus_timer = self.reactor.register_timer(self._bus_timer)
+
+    def set_speed(self, speed):
+        # Chips configured with different speeds run at the slowest
+        self.speed = min(self.speed, speed)
+
+    def add_stream(self, stream, waketime):
+        if stream not in self.streams:
+            self.streams.append(stream)
+        self._build_plan()
+        # Stagger the first step behind the streams already running
+        offset = sum(s.get_transaction_time(self.speed)
+                     for s in self.streams[:self.streams.index(stream)])
+        self._schedule(stream, waketime + offset)
+
+    def remove_stream(self, stream):
+        if stream in self.streams:
+            self.streams.remove(stream)
+            if stream is self.stepping:
+                self.stepping = None
+            self._unschedule(stream)
+            self._build_plan()
+
+    def reserve(self, eventtime, duration):
+        # Queue a transaction sent at eventtime, returns the estimated
+        # time it is done on the bus. Times are host send times: the
+        # link delay to the MCU is the same for all transactions.
+        start = max(eventtime, self.bus_free)
+        self.bus_free = start + duration
+        return self.bus_free
+
+    def wake(self, stream, waketime):
+        # Move the next step of a stream forward
+        if stream not in self.streams:
+            return
+        self._unschedule(stream)
+        self._schedule(stream, waketime)
+
+    def _unschedule(self, stream):
+        # In place, _bus_timer may be walking the schedule
+        self.schedule[:] = [e for e in self.schedule if e[2] is not stream]
+        heapq.heapify(self.schedule)
+
+    def _schedule(self, stream, waketime):
+        heapq.heappush(self.schedule,
+                       (waketime, self.streams.index(stream), stream))
+        if waketime <= self.schedule[0][0]:
+            self.reactor.update_timer(self.bus_timer, waketime)
+
+    def _build_plan(self):
+        demand = sum(s.get_transaction_time(self.speed) / s.get_step_time()
+                     for s in self.streams)
+        self.interval_scale = max(1., demand / MAX_BUS_UTILIZATION)
+        self.utilization = demand / self.interval_scale
+        for s in self.streams:
+            s.interval_scale = self.interval_scale
+        if self.interval_scale > 1.:
+            logging.warning("I2C_ADC bus %s overloaded (%.0f%%), slowing"
+                            " sampling by %.2f", self.name, demand * 100.,
+                            self.interval_scale)
+        else:
+            logging.info("I2C_ADC bus %s: %d chips, %.0f%% utilization",
+                         self.name, len(self.streams),
+                         self.utilization * 100.)
+
+    def _bus_timer(self, eventtime):
+        schedule = self.schedule
+        while schedule and schedule[0][0] <= eventtime:
+            waketime, idx, stream = heapq.heappop(schedule)
+            stream.stats.lateness.add(eventtime - waketime)
+            start = time.thread_time()
+            self.stepping = stream
+            try:
+                waketime = stream.step(eventtime)
+            except Exception:
+                logging.exception("I2C_ADC step failed")
+                waketime = stream.handle_error(eventtime)
+            stream.stats.reactor_time += time.thread_time() - start
+            if self.stepping is not stream:
+                # Removed in its step (a restart scheduled it again)
+                continue
+            self.stepping = None
+            heapq.heappush(schedule, (waketime, idx, stream))
+        if not schedule:
+            return self.reactor.NEVER
+        return schedule[0][0]
+
+    def get_status(self, eventtime):
+        return {
+            'chips': len(self.streams),
+            'speed': self.speed,
+            'utilization': self.utilization,
+            'interval_scale': self.interval_scale,
+        }
+
+def lookup_bus_arbiter(config):
+    # One arbiter per mcu and i2c bus, shared by i2c_adc and mcp342x
+    printer = config.get_printer()
+    name = "%s:%s" % (config.get('i2c_mcu', 'mcu'),
+                      config.get('i2c_bus', 'default'))
+    speed = config.getint('i2c_speed', 100000)
+    arbiter = printer.lookup_object('i2c_adc_bus ' + name, None)
+    if arbiter is None:
+        arbiter = ADC_bus_arbiter(printer, name, speed)
+        printer.add_object('i2c_adc_bus ' + name, arbiter)
+    arbiter.set_speed(speed)
+    return arbiter
+
+def register_stats_command(printer, name, stream):
+    gcode = printer.lookup_object('gcode')
+    def cmd_stats(gcmd):
+        if gcmd.get_int('RESET', 0):
+            stream.reset_stats()
+            gcmd.respond_info("I2C_ADC %s statistics reset" % (name,))
+            return
+        gcmd.respond_info(format_stats(name, stream))
+    gcode.register_mux_command("I2C_ADC_STATS", "CHIP", name, cmd_stats,
+                               desc="Report I2C_ADC sampling statistics")
+
+def register_calibrate_command(printer, section, name, stream):
+    gcode = printer.lookup_object('gcode')
+    reactor = printer.get_reactor()
+    cal = stream.calibration
+    profile = stream.profile
+    def cmd_calibrate(gcmd):
+        channel = gcmd.get('CHANNEL', None)
+        if channel is None:
+            channel = (stream.get_channels() or [None])[0]
+        else:
+            channel = profile.lookup_input(channel)
+        if channel not in stream.channels:
+            raise gcmd.error("I2C_ADC %s: CHANNEL must be an input in use,"
+                             " one of %s" % (name, ", ".join(
+                                 [profile.inputs[c]
+                                  for c in stream.get_channels()])))
+        points = cal.points.setdefault(channel, [])
+        if gcmd.get_int('RESET', 0):
+            del points[:]
+            gcmd.respond_info("I2C_ADC %s %s: calibration points cleared"
+                              % (name, profile.inputs[channel]))
+            return
+        fit = gcmd.get('FIT', None)
+        if fit is None:
+            points.append(take_point(gcmd, channel))
+            gain, volts, value = points[-1]
+            gcmd.respond_info("I2C_ADC %s %s: point %d at gain %g:"
+                              " %.6f V -> %.6f" % (
+                                  name, profile.inputs[channel],
+                                  len(points), gain, volts, value))
+            return
+        fit = fit.lower()
+        try:
+            if fit == 'gain':
+                option = 'ch%d_calibration' % (channel + 1,)
+                cal.set_correction(channel, fit_correction(points))
+                text = cal.format_correction(channel)
+            elif fit in ('poly', 'table'):
+                option = 'ch%d_linearization' % (channel + 1,)
+                xs = [cal.correct(channel, gain, volts)
+                      for gain, volts, value in points]
+                ys = [value for gain, volts, value in points]
+                if fit == 'poly':
+                    degree = gcmd.get_int('DEGREE', 1, minval=1, maxval=5)
+                    if len(points) <= degree:
+                        raise ValueError("needs %d points" % (degree + 1,))
+                    lin = ('poly', fit_polynomial(xs, ys, degree))
+                else:
+                    lin = cal.parse_linearization("table, " + ", ".join(
+                        ["%.9g, %.9g" % p for p in zip(xs, ys)]))
+                cal.set_linearization(channel, lin)
+                text = cal.format_linearization(channel)
+            else:
+                raise gcmd.error("FIT must be gain, poly or table")
+        except ValueError as e:
+            raise gcmd.error("I2C_ADC %s: %s" % (name, str(e)))
+        stream.refresh_calibration(channel)
+        del points[:]
+        printer.lookup_object('configfile').set(section, option, text)
+        gcmd.respond_info(
+            "I2C_ADC %s %s: %s = %s\nThe SAVE_CONFIG command will update"
+            " the printer config file and restart the printer." % (
+                name, profile.inputs[channel], option,
+                "; ".join([l.strip() for l in text.strip().split('\n')])))
+    def take_point(gcmd, channel):
+        value = gcmd.get_float('VALUE')
+        samples = gcmd.get_int('SAMPLES', 16, minval=1)
+        stream.activate(channel)
+        now = reactor.monotonic()
+        point = ADC_calibration_point(stream, channel, samples, now)
+        deadline = now + 1. + 2. * samples * len(
+            stream.plan or [None]) / stream.get_scan_rate()
+        while not point.done:
+            if reactor.monotonic() > deadline:
+                point.finish(stream)
+                if not point.count:
+                    raise gcmd.error("I2C_ADC %s: no readings" % (name,))
+                break
+            reactor.pause(reactor.monotonic() + .05)
+        gain, volts = point.get_result()
+        return (gain, volts, value)
+    def fit_correction(points):
+        # Offset and factor of every gain with points, a single point
+        # of a gain only gives its offset
+        correction = {}
+        for gain in set([p[0] for p in points]):
+            xs = [volts for g, volts, value in points if g == gain]
+            ys = [value for g, volts, value in points if g == gain]
+            if len(xs) == 1:
+                correction[gain] = (xs[0] - ys[0], 1.)
+                continue
+            offset, factor = fit_polynomial(xs, ys, 1)
+            if not factor:
+                raise ValueError("points of gain %g do not differ" % (
+                    gain,))
+            correction[gain] = (-offset / factor, factor)
+        if not correction:
+            raise ValueError("no calibration points")
+        return correction
+    gcode.register_mux_command(
+        "I2C_ADC_CALIBRATE", "CHIP", name, cmd_calibrate,
+        desc="Take I2C_ADC calibration points and fit them")
+
+def format_stats(name, stream):
+    stats = stream.stats
+    reactor_load, worker_load = stream.get_cpu_load(
+        stream.reactor.monotonic())
+    def hist(h):
+        if not h.count:
+            return "-"
+        return "avg=%.3fms max=%.3fms" % (h.total / h.count * 1000.,
+                                          h.max * 1000.)
+    lines = ["I2C_ADC %s: samples=%d errors=%d retries=%d ready_misses=%d"
+             " overruns=%d dropped=%d lost=%d" % (
+                 name, stats.samples, stats.errors, stats.retries,
+                 stats.ready_misses, stats.overruns, stats.dropped,
+                 stats.lost),
+             "  timeouts=%d nacks=%d stale=%d recoveries=%d alerts=%d" % (
+                 stats.timeouts, stats.nacks, stats.stale,
+                 stats.recoveries, stats.alerts),
+             "  lateness: %s" % (hist(stats.lateness),),
+             "  round trip: %s" % (hist(stats.round_trip),),
+             "  cpu: reactor=%.2fms/s worker=%.2fms/s overflows=%d" % (
+                 reactor_load * 1000., worker_load * 1000.,
+                 stats.overflows)]
+    for c in stream.get_channels():
+        ch = stream.get_channel(c)
+        lines.append("  ch%d (%s): samples=%d callbacks: %s" % (
+            c + 1, ch.input, ch.samples, hist(ch.callback_time)))
+    return "\n".join(lines)
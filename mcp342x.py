@@ -5,6 +5,7 @@
 # Compatible ADCs:
 #       MCP3421 - MCP3428
 #       ADS1013 - ADS1015
+#       ADS1113 - ADS1115
 #       Tested MCP3421 on Linux MCU
 #       Tested ADS1015 on Linux MCU
 #############################################################
@@ -20,14 +21,51 @@
 #   The i2c address that the chip is using on the i2c bus. This
 #   parameter must be provided.
 #i2c_bus: i2c.1
+#i2c_speed: 100000 (default)
+#   Bus clock in Hz, up to 400000 (fast mode). On a Linux MCU the
+#   kernel sets the clock, i2c_speed has to match it.
 #sensor_ID: e.g. ADS1015
 ##(Optional config: see device manual)
-#resolution: 12 (default)
+#resolution: 12 (default, 16 for ADS111x)
+#rate: 1600 (default ADS101x, 128 for ADS111x, set by resolution on MCP)
 #gain: 1 (default)
 #channel: 1 (default)
+#   Input name (e.g. AIN0-AIN1, AIN2, CH1) or number, see i2c_adc.py.
+#report_time: 1 (default)
+#   Interval at which streamed readings are handed out in batches.
+#sample_rate: (default: data rate of the chip)
+#   Rate at which the configured channel is polled.
+#history_size: 1024 (default)
+#   Number of readings kept for status queries and history consumers.
+#   The channel is streamed from the first status query or
+#   get_last_value on; MCP_READ alone only takes single readings.
+#   Status queries, query_adc and MCP_READ of the streamed input and
+#   setting all share the readings of the stream.
+#autorange: False (default)
+#   Step the PGA gain with the size of the signal (see i2c_adc.py).
+#adaptive: False (default)
+#   Let the stream pick resolution and data rate from report_time,
+#   sample_rate and the slope and noise of the signal (see i2c_adc.py).
+#offload: False (default)
+#   Process the readings in the shared worker thread (see i2c_adc.py).
+#ch1_calibration: (default: none)
+#ch1_linearization: (default: none)
+#   Calibration of the inputs, chN is mux setting N-1 (see
+#   i2c_adc.py). Applies to the streamed readings and MCP_READ.
+
+# I2C_ADC_STATS CHIP=external_adc_name [RESET=1] reports the sampling
+# statistics of the stream, also available in get_status as "stats".
+
+# I2C_ADC_CALIBRATE CHIP=external_adc_name VALUE=v takes a calibration
+# point of the configured channel (see i2c_adc.py).
+
+# ADC_CAPTURE CHIP=external_adc_name SAMPLES=n records the streamed
+# readings into a file without a conversion wait per reading (see
+# i2c_adc.py).
 
 # Typing MCP_READ into Terminal returns a single voltage reading
 ## Optional input: MCP_READ CHANNEL= GAIN= RATE= RESOLUTION=
+## CHANNEL takes an input name (e.g. CHANNEL=AIN2) or number
 #  Query_ADC NAME="MCP_34XX" returns a single voltage reading
 #  The Gcode Macro below returns a single voltage and time reading
 ##[gcode_macro QUERY_MCP34]
@@ -41,174 +79,25 @@
 
 # further TODOs: test I2C via mcu; create virtual output pin
 
-## ADS10XX: ##
-# Second Byte: Address pointer
-# 0 0 0 0 0 0 P1 P2
-#             0  0: Conversion register
-#             0  1: Config register
-#             1  0: Lo_threshold
-#             1  1: Hi_threshold
+# Register layouts of the chips are described in i2c_adc_core.py.
 
-# Config register
-# 0  0  0  0  0  0  0  0
-# 15 14 13 12 11 10 9  8
-# OS [  MUX ] [ PGA  ] Mode
-# ----------------------
-# 0  0  0  0  0  0  0  0
-# 7  6  5  4  3  2  1  0
-# [  DR ] CM  CP CL [CQ]
-#
-# OS: Operational Status (write 1 for single shot)
-# MUX:                  000: AIN0+AIN1 (def)
-# Input Multiplexer     001: AIN0+AIN3
-# (ADS1015 only)        010: AIN1+AIN3
-#                       011: AIN2+AIN3
-#                       100: AIN0+GND
-#                       101: AIN1+GND
-#                       110: AIN2+GND
-#                       111: AIN3+GND
-# PGA:                  000: FSR = +- 6.144 V (Gain 0.25)
-# No function on        001: FSR = +- 4.096 V (Gain 0.5)
-# ADS1013               010: FSR = +- 2.048 V (def)
-#                       011: FSR = +- 1.024 V (Gain 2)
-#                       100: FSR = +- 0.512 V (Gain 4)
-#                       101: FSR = +- 0.256 V (Gain 8)
-#                       110: FSR = +- 0.256 V
-#                       111: FSR = +- 0.256 V
-# Mode:                 0: continuous conversion
-#                       1: single shot
-# DR:                    000: 128 SPS
-# Data rate             001: 250 SPS
-#                       010: 490 SPS
-#                       011: 920 SPS
-#                       100: 1600 SPS (def)
-#                       101: 2400 SPS
-#                       110: 3300 SPS
-#                       111: 3300 SPS
-## MCP34XX: ##
-# Write command for one shot reading is 10001000. 
-# The hex value is 0x88.
-# 7th bit: 1 (start new conversion)
-# 6+5th bit: 00 (address bit, not used in mcp3425)
-# 4th bit: 0 (one shot mode)
-# 3rd+2nd bit: 10 (sample rate 15 ms, 16 bit)
-# 1st+0th bit: gain selection: 00 (gain = 1)
-
-
-from . import bus
+from . import i2c_adc_core
 import pins
 import mcu
 import logging
 
-SUPP_DEV_18 = ['MCP3421', 'MCP3422', 'MCP3423', 'MCP3424']
-SUPP_DEV_16 = ['MCP3425', 'MCP3426', 'MCP3427', 'MCP3428']
-SUPP_DEV_12 = ['ADS1013', 'ADS1014', 'ADS1015']
-
-VREF = 2.048
-
-N_CHANNELS = {
-    'MCP3421': 1,
-    'MCP3422': 2,
-    'MCP3423': 3,
-    'MCP3424': 4,
-    'MCP3425': 1,
-    'MCP3426': 2,
-    'MCP3427': 3,
-    'MCP3428': 4,
-    'ADS1013': 1,
-    'ADS1014': 1,
-    'ADS1015': 8,
-}
-
-# ADS1013 does not have PGA
-ADS_GAIN = {
-    0.25: 0,
-    0.5: 1,
-    1: 2,
-    2: 3,
-    4: 4,
-    8: 5
-}
-
-MCP_GAIN = {
-    1: 0,
-    2: 1,
-    4: 2,
-    8: 3
-}
-
-MCP_RATE = {
-    240: (12,0),
-    60: (14,1),
-    15: (16,2),
-    3.75: (18,3)
-}
-
-MCP_RES = {
-    12: (240,0),
-    14: (60,1),
-    16: (15,2),
-    18: (3.75,3)
-}
-
-MCP_CHANNEL = {
-    1: 0b00000000,
-    2: 0b00100000,
-    3: 0b01000000,
-    4: 0b01100000
-}
-
-ADS_RATE = {
-    128: 0,
-    250: 1,
-    490: 2,
-    920: 3,
-    1600: 4,
-    2400: 5,
-    3300: 6,
-    3300: 7
-}
-
-DEFAULT_RATE = {
-    'MCP': 240,
-    'ADS': 1600,
-}
-
-class mcp342x:
+class mcp342x(i2c_adc_core.ADC_chip):
     def __init__(self, config):
-        self.printer = config.get_printer()
-        self.name = config.get_name().split()[-1]
-        self.reactor = self.printer.get_reactor()
-        self.i2c = bus.MCU_I2C_from_config(config,
-                    default_speed=100000)
-        self.deviceId = config.get('sensor_ID').upper()
-        self.devicePrefix = self.deviceId[0:3]
-        self.resolution = config.getint('resolution',12)
-        # Check if device is supported
-        if self.deviceId not in SUPP_DEV_18 and \
-                self.deviceId not in SUPP_DEV_16 and \
-                self.deviceId not in SUPP_DEV_12:
-            raise config.error(self.deviceId + " not supported")
-        # Set channel
-        self.channel = config.getint('channel',minval=1,
-                            maxval=N_CHANNELS[self.deviceId],
-                            default=1)-1
-        # Check if selected resolution is correct/supported
-        if self.resolution not in [12, 14, 16, 18]:
-            raise config.error("Invalid resolution")
-        elif self.resolution == 18 and \
-                self.deviceId not in SUPP_DEV_18:
-            raise config.error("18 bit sampling not supported by " +
-                            self.deviceId)
-        elif self.resolution != 12 and \
-                self.deviceId in SUPP_DEV_12:
-            raise config.error(self.deviceId + 
-                " only supports 12 bit sampling")
-        self.gain = config.get('gain',1)
-        if self.gain not in eval(self.devicePrefix + "_GAIN"):
-            raise config.error("Invalid PGA setting")
-        self.printer.register_event_handler("klippy:connect",
-                                            self.handle_connect)
+        i2c_adc_core.ADC_chip.__init__(self, config)
+        # Keep the configured channel in continuous conversion
+        ch = self.stream.add_channel(self.channel, self.gain,
+            config.getfloat('sample_rate', None, above=0.),
+            config.getfloat('report_time', 1., above=0.),
+            self.history_size)
+        self.history = ch.history
+        self.stream_channel = ch
+        self.setup_stream_modes(config)
+        self._decoders = {}
         self.gcode = self.printer.lookup_object('gcode')
         #Register gcode command
         self.gcode.register_command('MCP_READ', self.cmd_mcp_read)
@@ -217,96 +106,110 @@ class mcp342x:
         query_adc.register_adc("MCP_34XX", self)
 
     def get_status(self, eventtime):
-        last_value = self.sample_voltage(self.channel, 
-        self.gain, self.resolution, DEFAULT_RATE[self.devicePrefix])
+        # Served from the streamed history, no bus access. The channel
+        # is streamed from its first use on.
+        self.stream.activate(self.channel)
+        rTime, rVolt = self.history.get_last()
         return {
-            'voltage': float(last_value[0]),
-            'time': float(last_value[1])
+            'voltage': rVolt,
+            'time': rTime,
+            'resolution': self.stream.resolution,
+            'gain': self.stream_channel.gain,
+            'stats': self.stream.stats.get_status(),
         }
 
+    def get_history(self):
+        self.stream.activate(self.channel)
+        return self.history
+
     def sample_voltage(self, channel, gain, resolution, rate):
-        _gain = eval(self.devicePrefix + "_GAIN")[gain]
-        _rate = eval(self.devicePrefix + "_RATE")[rate]
-        # Setup ADC and write ADC configuration
-        LSB = (VREF*2)/(2**resolution) 
-        if self.devicePrefix == "MCP":
-            _rate = MCP_RES[resolution]
-            rate = _rate[0]
-            conf = 0b10000000 | channel << 5 | _rate[1] << 2 | _gain
-            self.i2c.i2c_write([conf])
-            _read = []
-        else:
-            _conf1 = 0b10000001 | int(channel) << 4 | _gain << 1
-            _conf2 = 0b00000011 | _rate << 5
-            conf = [0b00000001, _conf1, _conf2]
-            _read = [0b00000000]
-            self.i2c.i2c_write(bytearray(conf))   
-        # Wait for conversion end
-        self.reactor.pause(self.reactor.monotonic() \
-                + (1.05 / float(rate)))
-        # Read 3 bytes of data
-        params = self.i2c.i2c_read(_read, 3)
-        response = bytearray(params['response'])
-        #Calculate response according to
-        #12, 14, 16 or 18 bit resolution
-        if self.devicePrefix == 'MCP':
-            if resolution == 16:
-                value = response[0] << 8 | response[1]
-            elif resolution < 16:
-                value = response[0] << 8 | response[1]
-                #Cut repeating leading bits
-                value &= ((2 ** resolution)-1)
-            else:
-                value = response[2] << 16 | response[1] << 8 \
-                        | response[2] 
-                value &= ((2 ** resolution)-1)
-        else:
-            if resolution < 18:
-                value = response[0] << (resolution - 8) | response[1]
-            else:
-                value = response[0] << (resolution - 8) \
-                    | response [1] << (resolution - 16) | response[2]
-        # Check sign
-        if (value & 1 << (resolution - 1)) != 0:
-            value -= ((1 << (resolution - 1)))
+        stream = self.stream
+        if stream.has_readings(channel, gain) \
+                and resolution == stream.resolution \
+                and rate == stream.rate \
+                and stream.get_channel(channel).history.count:
+            # The stream samples this setting - use its readings
+            rTime, rVolt = stream.get_channel(channel).history.get_last()
+            return rVolt, rTime
+        rValue = self._sample_single(channel, gain, resolution, rate)
+        if stream.started:
+            # Return the chip to continuous conversion
+            stream.restore_config()
+        return rValue
+
+    def _sample_single(self, channel, gain, resolution, rate):
+        decoder = self._decoders.get((gain, resolution))
+        if decoder is None:
+            decoder = i2c_adc_core.build_decoder(self.profile,
+                                                 resolution, gain)
+            self._decoders[(gain, resolution)] = decoder
+        # Write the single shot config and read the data once the
+        # chip reports the conversion finished
+        params, armed = self.stream.read_single(
+            self.profile.get_config_table(resolution, rate, 'single')[
+                (channel, gain)], decoder, 1. / float(rate))
         # calculate Voltage
-        rVolt = value * LSB / gain
-        rTime = params['#receive_time']
+        stream = self.stream
+        rVolt = stream.convert(channel, gain, i2c_adc_core.decode_counts(
+            decoder, params['response']), decoder)
+        # Time the single conversion finished
+        rTime = stream.get_conversion_end(stream.get_read_end(params),
+                                          (armed, False), 1. / float(rate),
+                                          single=True)
         return rVolt, rTime
 
     def get_last_value(self):
-        last_value = self.sample_voltage(self.channel,
-            self.gain, self.resolution, 1600)
-        return float(last_value[0]), float(last_value[1])
+        if not self.stream.started:
+            # First use - take a single reading, then start streaming
+            try:
+                rValue = self._sample_single(self.channel, self.gain,
+                                             self.resolution,
+                                             self.stream.rate)
+            except self.printer.command_error as e:
+                # Served from the stream once it has readings
+                logging.warning("mcp342x %s: %s", self.name, str(e))
+                rValue = None
+            self.stream.activate(self.channel)
+            if rValue is not None:
+                return rValue
+        rTime, rVolt = self.history.get_last()
+        return rVolt, rTime
 
     def get_channel(self, channel):
         last_value = self.sample_voltage(channel,
-            self.gain, self.resolution, 1600)
+            self.gain, self.resolution, self.stream.rate)
         return float(last_value[0])
 
     def handle_connect(self):
+        i2c_adc_core.ADC_chip.handle_connect(self)
         logging.info("mcp_connect")
 
 #Single reading
     def cmd_mcp_read(self, gcmd):
-        channel = int(gcmd.get('CHANNEL', self.channel + 1)) - 1
-        gain = float(gcmd.get('GAIN',self.gain))
-        resolution = int(gcmd.get('RESOLUTION',self.resolution))
-        # Setup ADC
-        if self.devicePrefix == "MCP":
-            try:
-                rate = float(gcmd.get('RATE'))
-                _rate = MCP_RATE[rate]
-                resolution = int(_rate[0])
-            except:
-                _rate = MCP_RES[resolution]
-                rate = _rate[0]
-        else:
-            rate = int(gcmd.get('RATE', 1600))
+        profile = self.profile
+        channel = profile.lookup_input(gcmd.get('CHANNEL',
+                                                self.channel + 1))
+        if channel is None:
+            raise gcmd.error("Invalid channel, use one of %s" % (
+                ", ".join(profile.inputs),))
+        gain = gcmd.get_float('GAIN', self.gain)
+        if gain not in profile.gains:
+            raise gcmd.error("Invalid PGA setting")
+        resolution = gcmd.get_int('RESOLUTION', self.resolution)
+        rate = gcmd.get_float('RATE', None)
+        if rate is not None and profile.find_resolution(rate) is None:
+            raise gcmd.error("Invalid rate %g" % (rate,))
+        if rate is not None and len(profile.resolutions) > 1:
+            # MCP342x: the rate selects the resolution
+            resolution = profile.find_resolution(rate)
+        if resolution not in profile.resolutions:
+            raise gcmd.error("Invalid resolution %d" % (resolution,))
+        rate = profile.check_rate(resolution,
+                                  self.stream.rate if rate is None else rate)
         rValue = self.sample_voltage(channel, gain, resolution, rate)
         Volt = rValue[0]
         Time = rValue[1]
-        gcmd.respond_info('Channel {} Voltage: {} V, Time: {}'.format(channel + 1, Volt, Time))
+        gcmd.respond_info('Channel {} Voltage: {} V, Time: {}'.format(profile.inputs[channel], Volt, Time))
         
 def load_config_prefix(config):
     return mcp342x(config)
@@ -0,0 +1,899 @@
+#!/usr/bin/env python3
+# Simulation and benchmark harness for i2c_adc.py and mcp342x.py
+#
+# Copyright (C) 2021 Dawid Murawski <dawid.m@gmx.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Runs the modules against simulated MCP342x / ADS101x chips on a
+# simulated i2c bus under a simulated reactor - no printer needed.
+#
+#   python3 scripts/i2c_adc_bench.py [-d 2] [-s 100000] [-n 0.0005]
+#
+# For every device, resolution, channel count and sampling mode it
+# reports the achieved samples/s, the host CPU time per sample (in the
+# reactor and in the offload worker), the latency from a reading to
+# its delivery to the ADC callback and the lateness percentiles of the
+# reactor timers. Host CPU time spent in
+# the timers is charged to the simulated clock, so a slow hot path
+# shows up as timer lateness. Only the CPU time of the reactor thread
+# counts, the offload worker thread runs beside it.
+import sys, os, types, heapq, math, random, time, optparse, importlib.util
+import collections
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MCU_FREQ = 1000000.
+# Bulk message buffer of sensor_i2c_adc.c
+BULK_SIZE = 48
+
+
+######################################################################
+# Simulated reactor
+######################################################################
+
+class SimTimer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+
+class SimReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+    def __init__(self):
+        self.now = 1000.
+        self.timers = []
+        self.seq = 0
+        self.cpu_time = 0.
+        self.lateness = []
+        # Callbacks registered by other threads
+        self.async_queue = collections.deque()
+    def monotonic(self):
+        return self.now
+    def _push(self, timer):
+        self.seq += 1
+        heapq.heappush(self.timers, (timer.waketime, self.seq, timer))
+    def register_timer(self, callback, waketime=NEVER):
+        timer = SimTimer(callback, waketime)
+        if waketime < self.NEVER:
+            self._push(timer)
+        return timer
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+        if waketime < self.NEVER:
+            self._push(timer)
+    def unregister_timer(self, timer):
+        timer.waketime = self.NEVER
+    def register_async_callback(self, callback, waketime=NOW):
+        # NOW runs the callback as soon as possible - from the current
+        # simulated time on, or its lateness would count from time 0
+        if waketime == self.NOW:
+            waketime = self.now
+        self.async_queue.append((callback, waketime))
+    def register_callback(self, callback, waketime=NOW):
+        if waketime == self.NOW:
+            waketime = self.now
+        def run_once(eventtime):
+            callback(eventtime)
+            return self.NEVER
+        self.register_timer(run_once, waketime)
+    def pause(self, waketime):
+        self.run(waketime)
+        return self.now
+    def run(self, endtime):
+        while True:
+            while self.async_queue:
+                self.register_callback(*self.async_queue.popleft())
+            if not self.timers or self.timers[0][0] > endtime:
+                break
+            waketime, seq, timer = heapq.heappop(self.timers)
+            if timer.waketime != waketime:
+                continue
+            self.now = max(self.now, waketime)
+            self.lateness.append(self.now - waketime)
+            start = time.thread_time()
+            nextwake = timer.callback(self.now)
+            spent = time.thread_time() - start
+            self.cpu_time += spent
+            # The reactor is busy while the callback runs
+            self.now += spent
+            if timer.waketime == waketime:
+                timer.waketime = self.NEVER
+                if nextwake is not None and nextwake < self.NEVER:
+                    self.update_timer(timer, nextwake)
+        self.now = max(self.now, endtime)
+
+
+######################################################################
+# Simulated chips
+######################################################################
+
+# ADS101x register model
+class SimADS101x:
+    RATES = [128, 250, 490, 920, 1600, 2400, 3300, 3300]
+    FSR = [6.144, 4.096, 2.048, 1.024, 0.512, 0.256, 0.256, 0.256]
+    MUX = [(0, 1), (0, 3), (1, 3), (2, 3),
+           (0, None), (1, None), (2, None), (3, None)]
+    def __init__(self, reactor, inputs, noise=0., bits=12, drift=0.):
+        self.reactor = reactor
+        self.inputs = inputs
+        self.noise = noise
+        self.bits = bits
+        # Relative error of the internal oscillator
+        self.drift = drift
+        self.pointer = 0
+        self.regs = [0, 0x8583, 0x8000, 0x7fff]
+        self.conv_start = 0.
+        self.single_done = True
+        # Conversion end of the data returned by each data read
+        self.data_time = 0.
+        self.read_times = []
+    def conversion_time(self):
+        return 1. / (self.RATES[(self.regs[1] >> 5) & 7] * (1. + self.drift))
+    def _convert(self, t):
+        pos, neg = self.MUX[(self.regs[1] >> 12) & 7]
+        v = self.inputs[pos](t)
+        if neg is not None:
+            v -= self.inputs[neg](t)
+        v += random.gauss(0., self.noise) if self.noise else 0.
+        full = 1 << (self.bits - 1)
+        code = int(round(v / self.FSR[(self.regs[1] >> 9) & 7] * full))
+        code = max(-full, min(full - 1, code))
+        return (code << (16 - self.bits)) & 0xffff
+    def write(self, data):
+        self.pointer = data[0] & 3
+        if len(data) < 3:
+            return
+        val = data[1] << 8 | data[2]
+        if self.pointer == 1:
+            self.regs[1] = val & 0x7fff
+            self.conv_start = self.reactor.now
+            self.single_done = not (val & 0x8000 or not val & 0x100)
+        else:
+            self.regs[self.pointer] = val
+    def ready_level(self):
+        # ALERT/RDY in conversion ready mode, active low
+        conf = self.regs[1]
+        if (conf & 3) == 3 or not conf & 0x100:
+            return 1
+        done = self.reactor.now >= self.conv_start + self.conversion_time()
+        return 0 if done else 1
+    def read(self, write, read_len):
+        if write:
+            self.pointer = write[0] & 3
+        now = self.reactor.now
+        period = self.conversion_time()
+        single = self.regs[1] & 0x100
+        if self.pointer == 0:
+            if single:
+                if not self.single_done and now >= self.conv_start + period:
+                    self.data_time = self.conv_start + period
+                    self.regs[0] = self._convert(self.data_time)
+                    self.single_done = True
+            else:
+                k = math.floor((now - self.conv_start) / period)
+                if k >= 1:
+                    self.data_time = self.conv_start + k * period
+                    self.regs[0] = self._convert(self.data_time)
+            val = self.regs[0]
+            self.read_times.append(self.data_time)
+        elif self.pointer == 1:
+            busy = (single and not self.single_done
+                    and now < self.conv_start + period)
+            val = self.regs[1] | (0 if busy else 0x8000)
+        else:
+            val = self.regs[self.pointer]
+        out = [val >> 8, val & 0xff] * 2
+        return out[:read_len]
+
+# MCP342x register model
+class SimMCP342x:
+    RATES = {12: 240., 14: 60., 16: 15., 18: 3.75}
+    def __init__(self, reactor, inputs, noise=0., drift=0.):
+        self.reactor = reactor
+        self.inputs = inputs
+        self.noise = noise
+        self.drift = drift
+        self.conf = 0x90
+        self.conv_start = 0.
+        self.last_k = -1
+        self.data = 0
+        self.data_time = 0.
+        self.read_times = []
+    def resolution(self):
+        return [12, 14, 16, 18][(self.conf >> 2) & 3]
+    def conversion_time(self):
+        return 1. / (self.RATES[self.resolution()] * (1. + self.drift))
+    def write(self, data):
+        self.conf = data[0] & 0x7f
+        self.conv_start = self.reactor.now
+        self.last_k = 0
+    def read(self, write, read_len):
+        res = self.resolution()
+        period = self.conversion_time()
+        k = math.floor((self.reactor.now - self.conv_start) / period)
+        if not self.conf & 0x10:
+            k = min(k, 1)
+        ready = 0x80
+        if k >= 1 and k != self.last_k:
+            t = self.data_time = self.conv_start + k * period
+            v = self.inputs[(self.conf >> 5) & 3](t)
+            v += random.gauss(0., self.noise) if self.noise else 0.
+            full = 1 << (res - 1)
+            code = int(round(v * (1 << (self.conf & 3)) / 2.048 * full))
+            self.data = max(-full, min(full - 1, code))
+            self.last_k = k
+            ready = 0
+        d = self.data & 0xffffff
+        if res == 18:
+            out = [(d >> 16) & 0xff, (d >> 8) & 0xff, d & 0xff]
+        else:
+            out = [(d >> 8) & 0xff, d & 0xff]
+        out += [self.conf | ready] * 3
+        data_size = 3 if res == 18 else 2
+        if read_len == data_size + 1 and not ready:
+            # New reading of a stream read, stale ones are dropped by
+            # the stream (not the config read back)
+            self.read_times.append(self.data_time)
+        return out[:read_len]
+
+
+######################################################################
+# Simulated MCU and i2c bus
+######################################################################
+
+# One i2c bus: transactions run back to back at the bus speed
+class SimBus:
+    def __init__(self, reactor, speed, rtt, error_rate=0.):
+        self.reactor = reactor
+        self.speed = speed
+        self.rtt = rtt
+        # Share of the reads that fail (NACK) or lose their response
+        self.error_rate = error_rate
+        self.free_time = 0.
+        self.busy_time = 0.
+        self.transactions = 0
+    def transaction(self, nbytes, callback, delay=0., local=None):
+        # start/stop plus 9 bits per byte. Host commands reach the MCU
+        # half a round trip after they were sent, local ones (issued
+        # by the MCU itself) start at their MCU time.
+        duration = (9. * nbytes + 3.) / self.speed
+        if local is None:
+            local = self.reactor.now + self.rtt / 2.
+        start = max(local, self.free_time)
+        self.free_time = start + duration
+        self.busy_time += duration
+        self.transactions += 1
+        self.reactor.register_async_callback(callback, self.free_time + delay)
+        return self.free_time
+
+class SimI2C:
+    def __init__(self, mcu, bus, chip, addr):
+        self.mcu = mcu
+        self.bus = bus
+        self.chip = chip
+        self.addr = addr
+        self.oid = mcu.create_oid()
+        self.cmd_queue = mcu.alloc_command_queue()
+        mcu.i2cs[self.oid] = self
+    def get_oid(self):
+        return self.oid
+    def get_mcu(self):
+        return self.mcu
+    def get_i2c_address(self):
+        return self.addr
+    def get_command_queue(self):
+        return self.cmd_queue
+    def write(self, data, local=None):
+        data = list(data)
+        self.bus.transaction(1 + len(data), lambda e: self.chip.write(data),
+                             local=local)
+    def read(self, write, read_len, callback, local=None):
+        write = list(write)
+        def done(eventtime):
+            # The chip is read at the end of the bus transaction, the
+            # response reaches the host half a round trip later
+            times = len(self.chip.read_times)
+            resp = bytes(bytearray(self.chip.read(write, read_len)))
+            if self.bus.error_rate and random.random() < self.bus.error_rate:
+                # The failed read returns no conversion
+                del self.chip.read_times[times:]
+                if local is not None:
+                    # sensor_i2c_adc.c flags the frame
+                    resp = None
+                elif random.random() < .5:
+                    # Response lost on the way to the host
+                    return
+                else:
+                    resp = b''
+            self.mcu.reactor.register_async_callback(
+                lambda e: callback(resp, e), eventtime + self.bus.rtt / 2.)
+        nbytes = 2 + len(write) + read_len if write else 1 + read_len
+        self.bus.transaction(nbytes, done, local=local)
+    def i2c_write(self, data, minclock=0, reqclock=0):
+        self.write(data)
+    def i2c_write_wait_ack(self, data, minclock=0, reqclock=0):
+        self.write(data)
+        self.mcu.reactor.pause(self.bus.free_time + self.bus.rtt / 2.)
+    def i2c_read(self, write, read_len, retry=True):
+        sent = self.mcu.reactor.now
+        result = {}
+        def done(response, receive_time):
+            result.update({'response': response, '#sent_time': sent,
+                           '#receive_time': receive_time})
+        self.read(write, read_len, done)
+        while not result:
+            self.mcu.reactor.pause(self.bus.free_time + self.bus.rtt / 2.)
+        self.mcu.reactor.now = max(self.mcu.reactor.now,
+                                   result['#receive_time'])
+        return result
+
+class SimCommand:
+    def __init__(self, mcu, msgformat):
+        self.mcu = mcu
+        self.name = msgformat.split()[0]
+    def send(self, data=(), minclock=0, reqclock=0):
+        handler = getattr(self.mcu, '_cmd_' + self.name)
+        handler(*data)
+
+class SimMCUShutdown(Exception):
+    pass
+
+class SimMCU:
+    def __init__(self, reactor, name='mcu'):
+        self.reactor = reactor
+        self.name = name
+        self.oid_count = 0
+        self.config_callbacks = []
+        self.handlers = {}
+        self.i2cs = {}
+        self.bulk = {}
+    def get_name(self):
+        return self.name
+    def create_oid(self):
+        self.oid_count += 1
+        return self.oid_count
+    def alloc_command_queue(self):
+        return object()
+    def register_config_callback(self, callback):
+        self.config_callbacks.append(callback)
+    def lookup_command(self, msgformat, cq=None):
+        return SimCommand(self, msgformat)
+    def try_lookup_command(self, msgformat, cq=None):
+        return SimCommand(self, msgformat)
+    def register_response(self, callback, name, oid=None):
+        self.handlers[name, oid] = callback
+    def _dispatch(self, name, params):
+        handler = self.handlers.get((name, params['oid']))
+        if handler is not None:
+            handler(params)
+    def estimated_print_time(self, eventtime):
+        return eventtime - 1000.
+    def print_time_to_clock(self, print_time):
+        return int(print_time * MCU_FREQ)
+    def clock_to_print_time(self, clock):
+        return clock / MCU_FREQ
+    def seconds_to_clock(self, seconds):
+        return int(seconds * MCU_FREQ)
+    def clock32_to_clock64(self, clock32):
+        clock = self.print_time_to_clock(
+            self.estimated_print_time(self.reactor.now))
+        return clock - ((clock - clock32) & 0xffffffff)
+    def is_fileoutput(self):
+        return False
+    def add_config_cmd(self, cmd, is_init=False, on_restart=False):
+        parts = cmd.split()
+        args = dict(p.split('=', 1) for p in parts[1:])
+        if parts[0] == 'config_i2c_adc':
+            self.bulk[int(args['oid'])] = {
+                'i2c': self.i2cs[int(args['i2c_oid'])],
+                'read_len': int(args['read_len']),
+                'slots': [], 'timer': None}
+        elif parts[0] == 'i2c_adc_add_slot':
+            self.bulk[int(args['oid'])]['slots'].append(
+                list(bytearray.fromhex(args['conf'])))
+    def build_config(self):
+        for cb in self.config_callbacks:
+            cb()
+    # MCU commands
+    def _cmd_i2c_write(self, oid, data):
+        self.i2cs[oid].write(data)
+    def _cmd_i2c_read(self, oid, reg, read_len):
+        sent = self.reactor.now
+        def done(response, receive_time):
+            self._dispatch('i2c_read_response', {
+                'oid': oid, 'response': response,
+                '#sent_time': sent, '#receive_time': receive_time})
+        self.i2cs[oid].read(reg, read_len, done)
+    def _cmd_i2c_adc_set_slot(self, oid, slot, conf):
+        self.bulk[oid]['slots'][slot] = list(conf)
+    def _cmd_query_i2c_adc(self, oid, rest_ticks, reg, frames):
+        # Emulation of sensor_i2c_adc.c
+        bulk = self.bulk[oid]
+        if frames * (bulk['read_len'] + 1) > BULK_SIZE:
+            raise SimMCUShutdown("Invalid i2c_adc frames")
+        if bulk['timer'] is not None:
+            self.reactor.unregister_timer(bulk['timer'])
+            bulk['timer'] = None
+        if not rest_ticks:
+            return
+        period = rest_ticks / MCU_FREQ
+        state = bulk['state'] = {'data': bytearray(), 'count': 0,
+                                 'sequence': 0, 'slot': 0, 'clock': 0,
+                                 'start': 0., 'overflows': 0,
+                                 'due': self.reactor.now + period}
+        i2c = bulk['i2c']
+        slots = bulk['slots']
+        def frame_done(response, receive_time, slot, clock):
+            if not state['count']:
+                state['clock'] = clock
+            if response is None:
+                response = bytes(bytearray(bulk['read_len']))
+                slot |= 0x80
+            state['data'] += response + bytearray([slot])
+            state['count'] += 1
+            if state['count'] >= max(1, frames):
+                self._dispatch('i2c_adc_data', {
+                    'oid': oid, 'sequence': state['sequence'],
+                    'clock': state['clock'] & 0xffffffff,
+                    'data': bytes(state['data']),
+                    '#receive_time': receive_time})
+                state['data'] = bytearray()
+                state['count'] = 0
+                state['sequence'] = (state['sequence'] + 1) & 0xffff
+        def event(eventtime):
+            # The MCU timer runs on its own clock, the host CPU time
+            # charged to the simulated reactor does not delay it
+            due = state['due']
+            state['due'] += period
+            if state['start'] > due:
+                # The bus is still busy, the task did not get to the
+                # read of the previous conversion yet
+                state['overflows'] = (state['overflows'] + 1) & 0xffff
+                return state['due']
+            state['start'] = max(due, i2c.bus.free_time)
+            clock = self.print_time_to_clock(
+                self.estimated_print_time(due))
+            slot = state['slot']
+            i2c.read(reg, bulk['read_len'],
+                     lambda r, t: frame_done(r, t, slot, clock), local=due)
+            if len(slots) > 1:
+                state['slot'] = (slot + 1) % len(slots)
+                i2c.write(slots[state['slot']], local=due)
+            return state['due']
+        bulk['timer'] = self.reactor.register_timer(
+            event, self.reactor.now + period)
+    def _cmd_query_i2c_adc_status(self, oid):
+        state = self.bulk[oid].get('state', {})
+        self._dispatch('i2c_adc_status', {
+            'oid': oid, 'sequence': state.get('sequence', 0),
+            'overflows': state.get('overflows', 0),
+            '#receive_time': self.reactor.now})
+
+
+######################################################################
+# Simulated printer objects
+######################################################################
+
+class SimConfigError(Exception):
+    pass
+
+class SimConfig:
+    error = SimConfigError
+    def __init__(self, printer, name, options):
+        self.printer = printer
+        self.name = name
+        self.options = options
+    def get_printer(self):
+        return self.printer
+    def get_name(self):
+        return self.name
+    def _get(self, option, default, parser):
+        if option in self.options:
+            return parser(self.options[option])
+        if default is SimConfigError:
+            raise SimConfigError("Option '%s' in section '%s' must be"
+                                 " specified" % (option, self.name))
+        return default
+    def get(self, option, default=SimConfigError, note_valid=True):
+        return self._get(option, default, str)
+    def getint(self, option, default=SimConfigError, minval=None,
+               maxval=None, note_valid=True):
+        return self._get(option, default, int)
+    def getfloat(self, option, default=SimConfigError, minval=None,
+                 maxval=None, above=None, below=None, note_valid=True):
+        return self._get(option, default, float)
+    def getboolean(self, option, default=SimConfigError, note_valid=True):
+        return self._get(option, default,
+                         lambda v: v.lower() in ('1', 'true', 'yes'))
+    def getchoice(self, option, choices, default=SimConfigError,
+                  note_valid=True):
+        value = self._get(option, default, str)
+        return choices[value] if isinstance(choices, dict) else value
+    def getlist(self, option, default=SimConfigError, sep=',', count=None,
+                note_valid=True):
+        return self._get(option, default,
+                         lambda v: tuple(p.strip() for p in v.split(sep)))
+
+class SimPins:
+    def __init__(self):
+        self.chips = {}
+    def register_chip(self, chip_name, chip):
+        self.chips[chip_name] = chip
+    def setup_pin(self, pin_type, pin_desc):
+        chip_name, pin = pin_desc.split(':', 1)
+        return self.chips[chip_name].setup_pin(pin_type, {
+            'chip': self.chips[chip_name], 'chip_name': chip_name,
+            'pin': pin, 'invert': 0, 'pullup': 0})
+
+class SimButtons:
+    QUERY_TIME = .002
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.callbacks = {}
+    def register_buttons(self, pins, callback):
+        for pin in pins:
+            self.callbacks[pin] = callback
+    def connect_pin(self, pin, level_func):
+        callback = self.callbacks[pin]
+        state = [None]
+        def query(eventtime):
+            level = level_func()
+            if level != state[0]:
+                state[0] = level
+                callback(eventtime, level)
+            return eventtime + self.QUERY_TIME
+        self.reactor.register_timer(query, self.reactor.now)
+
+class SimGCodeCommand:
+    error = SimConfigError
+    def __init__(self, gcode, params):
+        self.gcode = gcode
+        self.params = params
+    def get(self, name, default=SimConfigError, **kw):
+        if name in self.params:
+            return self.params[name]
+        if default is SimConfigError:
+            raise self.gcode.error("Missing %s" % (name,))
+        return default
+    def get_int(self, name, default=SimConfigError, **kw):
+        return int(self.get(name, default))
+    def get_float(self, name, default=SimConfigError, **kw):
+        return float(self.get(name, default))
+    def respond_info(self, msg, log=True):
+        self.gcode.responses.append(msg)
+    def respond_raw(self, msg):
+        self.gcode.responses.append(msg)
+
+class SimGCode:
+    error = SimConfigError
+    def __init__(self):
+        self.commands = {}
+        self.responses = []
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        self.commands[cmd] = func
+    def register_mux_command(self, cmd, key, value, func, desc=None):
+        self.commands['%s %s=%s' % (cmd, key, value)] = func
+    def run(self, cmd, **params):
+        self.commands[cmd](SimGCodeCommand(self, params))
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+
+class SimQueryADC:
+    def __init__(self):
+        self.adcs = {}
+    def register_adc(self, name, mcu_adc):
+        self.adcs[name] = mcu_adc
+
+class SimPrinter:
+    config_error = SimConfigError
+    command_error = SimConfigError
+    def __init__(self):
+        self.reactor = SimReactor()
+        self.objects = {'pins': SimPins(), 'gcode': SimGCode(),
+                        'query_adc': SimQueryADC(),
+                        'buttons': SimButtons(self.reactor)}
+        self.event_handlers = {}
+        self.shutdown_msg = None
+    def get_reactor(self):
+        return self.reactor
+    def lookup_object(self, name, default=SimConfigError):
+        if name in self.objects:
+            return self.objects[name]
+        if default is SimConfigError:
+            raise SimConfigError("Unknown config object '%s'" % (name,))
+        return default
+    def lookup_objects(self, module=None):
+        return [(n, o) for n, o in self.objects.items()
+                if module is None or n.split()[0] == module]
+    def load_object(self, config, section, default=SimConfigError):
+        return self.lookup_object(section, default)
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def invoke_shutdown(self, msg):
+        self.shutdown_msg = msg
+    def get_start_args(self):
+        return {}
+
+
+######################################################################
+# Module loading
+######################################################################
+
+def load_modules():
+    # Import the modules as members of a stand-in klippy extras package
+    extras = types.ModuleType('extras')
+    extras.__path__ = [REPO]
+    sys.modules['extras'] = extras
+    bus = types.ModuleType('extras.bus')
+    sys.modules['extras.bus'] = extras.bus = bus
+    for name in ['pins', 'mcu']:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    modules = {}
+    for name in ['i2c_adc_core', 'i2c_adc', 'mcp342x']:
+        spec = importlib.util.spec_from_file_location(
+            'extras.' + name, os.path.join(REPO, name + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['extras.' + name] = module
+        setattr(extras, name, module)
+        spec.loader.exec_module(module)
+        modules[name] = module
+    return bus, modules
+
+class SimSetup:
+    def __init__(self, speed=100000, rtt=.0005, error_rate=0.):
+        self.bus_module, self.modules = load_modules()
+        self.printer = SimPrinter()
+        self.reactor = self.printer.reactor
+        self.mcu = SimMCU(self.reactor)
+        self.bus = SimBus(self.reactor, speed, rtt, error_rate)
+        self.chips = []
+        self.bus_module.MCU_I2C_from_config = self._i2c_from_config
+    def _i2c_from_config(self, config, default_addr=None,
+                         default_speed=100000):
+        chip = self.chips.pop(0)
+        return SimI2C(self.mcu, self.bus, chip,
+                      config.getint('i2c_address', default_addr))
+    def add_section(self, name, options, chip):
+        chip.reactor = self.reactor
+        self.chips.append(chip)
+        config = SimConfig(self.printer, name, options)
+        obj = self.modules[name.split()[0]].load_config_prefix(config)
+        self.printer.add_object(name, obj)
+        return obj
+    def setup_pin(self, pin_desc):
+        return self.printer.lookup_object('pins').setup_pin('adc', pin_desc)
+    def connect(self):
+        self.mcu.build_config()
+        self.printer.send_event("klippy:connect")
+        self.printer.send_event("klippy:ready")
+    def run(self, duration):
+        self.reactor.run(self.reactor.now + duration)
+
+
+######################################################################
+# Benchmarks
+######################################################################
+
+def percentile(values, pct):
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+def count_samples(stream):
+    # Count the readings stored into the channel histories and keep
+    # their timestamps in the order of storage
+    counter = [0]
+    times = []
+    for ch in stream.channels.values():
+        def append(rTime, rVolt, append=ch.history.append):
+            counter[0] += 1
+            times.append(rTime)
+            append(rTime, rVolt)
+        ch.history.append = append
+    return counter, times
+
+def timestamp_error(times, chip):
+    # Median deviation of the reading timestamps from the end of the
+    # conversions the simulated chip returned
+    errors = [abs(t - c) for t, c in zip(times, chip.read_times)]
+    return percentile(errors, .5)
+
+def constant_inputs(noise_free=(.3, .6, .9, 1.2)):
+    return [lambda t, v=v: v for v in noise_free]
+
+def bench_i2c_adc(options, device, resolution, channels, mode):
+    setup = SimSetup(options.speed, options.rtt, options.error_rate)
+    if device.startswith('ADS'):
+        chip = SimADS101x(None, constant_inputs(), options.noise,
+                           drift=options.drift)
+    else:
+        chip = SimMCP342x(None, constant_inputs(), options.noise,
+                           drift=options.drift)
+    section = {'sensor_ID': device, 'resolution': str(resolution),
+               'i2c_address': '72', 'i2c_speed': str(options.speed),
+               'report_time': str(options.report_time)}
+    if device.startswith('ADS'):
+        section['rate'] = '3300'
+        # Single ended inputs start at mux setting 5
+        section['channel'] = '5'
+    if mode == 'ready':
+        section['ready_pin'] = '^gpio17'
+    elif mode == 'mcu':
+        section['mcu_sampling'] = 'True'
+    elif mode == 'offload':
+        section['offload'] = 'True'
+    obj = setup.add_section('i2c_adc bench', section, chip)
+    first = int(section.get('channel', '1'))
+    stats = {'samples': 0, 'latency': []}
+    def make_callback():
+        def callback(read_time, read_value):
+            stats['latency'].append(setup.reactor.monotonic() - read_time)
+        return callback
+    for i in range(channels):
+        pin = 'bench:' if not i else 'bench:ch%d' % (first + i,)
+        adc = setup.setup_pin(pin)
+        if options.range_check:
+            adc.setup_minmax(.001, 1, minval=0., maxval=2.,
+                             range_check_count=4)
+        adc.setup_adc_callback(options.report_time, make_callback())
+    counter, times = count_samples(obj.stream)
+    setup.connect()
+    if mode == 'ready':
+        setup.printer.lookup_object('buttons').connect_pin(
+            '^gpio17', chip.ready_level)
+    elif mode == 'offload':
+        # Simulated time runs faster than the worker thread, let it
+        # catch up every WORKER_PERIOD of simulated time
+        worker = setup.printer.lookup_object('i2c_adc_worker')
+        def sync_worker(eventtime):
+            queued = worker.queued
+            worker.wakeup.set()
+            while worker.processed < queued:
+                time.sleep(.0001)
+            return eventtime + setup.modules['i2c_adc_core'].WORKER_PERIOD
+        setup.reactor.register_timer(sync_worker, setup.reactor.now)
+    start_cpu = setup.reactor.cpu_time
+    del setup.reactor.lateness[:]
+    setup.run(options.duration)
+    setup.printer.send_event("klippy:disconnect")
+    samples = counter[0]
+    cpu = setup.reactor.cpu_time - start_cpu
+    return {
+        'samples': samples,
+        'sps': samples / options.duration,
+        'cpu_us': cpu / max(1, samples) * 1000000.,
+        'worker_us': obj.stream.stats.worker_time / max(1, samples)
+                     * 1000000.,
+        'latency_ms': percentile(stats['latency'], .5) * 1000.,
+        'ts_err_us': timestamp_error(times, chip) * 1e6,
+        'jitter_p50_us': percentile(setup.reactor.lateness, .5) * 1e6,
+        'jitter_p99_us': percentile(setup.reactor.lateness, .99) * 1e6,
+        'bus_util': setup.bus.busy_time / options.duration,
+        'bus_us': setup.bus.busy_time / max(1, samples) * 1000000.,
+        'errors': obj.stream.stats.errors,
+    }
+
+def bench_mcp342x(options, device, resolution):
+    setup = SimSetup(options.speed, options.rtt, options.error_rate)
+    if device.startswith('ADS'):
+        chip = SimADS101x(None, constant_inputs(), options.noise,
+                           drift=options.drift)
+    else:
+        chip = SimMCP342x(None, constant_inputs(), options.noise,
+                           drift=options.drift)
+    obj = setup.add_section('mcp342x bench', {
+        'sensor_ID': device, 'resolution': str(resolution),
+        'i2c_address': '104', 'i2c_speed': str(options.speed)}, chip)
+    # Channels are streamed from their first use on
+    obj.get_history()
+    counter, times = count_samples(obj.stream)
+    setup.connect()
+    start_cpu = setup.reactor.cpu_time
+    del setup.reactor.lateness[:]
+    setup.run(options.duration)
+    samples = counter[0]
+    cpu = setup.reactor.cpu_time - start_cpu
+    # Age of the reading served by get_status()
+    rTime, rVolt = obj.get_history().get_last()
+    age = setup.reactor.monotonic() - rTime
+    return {
+        'samples': samples,
+        'sps': samples / options.duration,
+        'cpu_us': cpu / max(1, samples) * 1000000.,
+        'latency_ms': age * 1000.,
+        'ts_err_us': timestamp_error(times, chip) * 1e6,
+        'jitter_p50_us': percentile(setup.reactor.lateness, .5) * 1e6,
+        'jitter_p99_us': percentile(setup.reactor.lateness, .99) * 1e6,
+        'bus_util': setup.bus.busy_time / options.duration,
+        'bus_us': setup.bus.busy_time / max(1, samples) * 1000000.,
+        'errors': obj.stream.stats.errors,
+        'worker_us': 0.,
+    }
+
+def bench_startup(options, count):
+    # Connect step of count chips with one used channel each
+    setup = SimSetup(options.speed, options.rtt)
+    for i in range(count):
+        chip = SimADS101x(None, constant_inputs(), options.noise,
+                           drift=options.drift)
+        setup.add_section('i2c_adc chip%d' % (i,), {
+            'sensor_ID': 'ADS1015', 'i2c_address': str(72 + i),
+            'i2c_speed': str(options.speed), 'channel': '5'}, chip)
+        setup.setup_pin('chip%d:' % (i,)).setup_adc_callback(
+            options.report_time, lambda read_time, read_value: None)
+    setup.connect()
+    return setup.printer.lookup_object('i2c_adc_startup').get_status(
+        setup.reactor.monotonic())
+
+SCENARIOS = [
+    ('i2c_adc', 'ADS1015', 12, 1, 'poll'),
+    ('i2c_adc', 'ADS1015', 12, 4, 'poll'),
+    ('i2c_adc', 'ADS1015', 12, 1, 'ready'),
+    ('i2c_adc', 'ADS1015', 12, 1, 'mcu'),
+    ('i2c_adc', 'ADS1015', 12, 4, 'mcu'),
+    ('i2c_adc', 'ADS1015', 12, 4, 'offload'),
+    ('i2c_adc', 'MCP3424', 12, 1, 'poll'),
+    ('i2c_adc', 'MCP3424', 12, 4, 'poll'),
+    ('i2c_adc', 'MCP3424', 16, 1, 'poll'),
+    ('i2c_adc', 'MCP3424', 18, 1, 'poll'),
+    ('i2c_adc', 'MCP3424', 12, 4, 'mcu'),
+    ('i2c_adc', 'MCP3424', 12, 4, 'offload'),
+    ('mcp342x', 'MCP3421', 12, 1, 'poll'),
+    ('mcp342x', 'MCP3421', 18, 1, 'poll'),
+    ('mcp342x', 'ADS1015', 12, 1, 'poll'),
+]
+
+def main():
+    opts = optparse.OptionParser("%prog [options]")
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=2., help="simulated seconds per scenario")
+    opts.add_option("-s", "--speed", type="int", dest="speed",
+                    default=100000, help="i2c bus speed in Hz")
+    opts.add_option("-n", "--noise", type="float", dest="noise",
+                    default=0., help="input noise in volts (sigma)")
+    opts.add_option("-r", "--report-time", type="float", dest="report_time",
+                    default=.1, help="report_time of the ADC callbacks")
+    opts.add_option("--rtt", type="float", dest="rtt", default=.0005,
+                    help="host to MCU round trip time in seconds")
+    opts.add_option("--drift", type="float", dest="drift", default=.01,
+                    help="relative oscillator error of the simulated chips")
+    opts.add_option("--range-check", action="store_true",
+                    dest="range_check", help="enable the min/max range check")
+    opts.add_option("-e", "--error-rate", type="float", dest="error_rate",
+                    default=0., help="share of failed or lost i2c reads")
+    opts.add_option("-c", "--chips", type="int", dest="chips", default=12,
+                    help="number of chips in the startup benchmark")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    random.seed(0)
+    header = ("%-8s %-8s %4s %3s %-7s %8s %8s %8s %9s %8s %9s %9s %6s %7s"
+              " %6s"
+              % ('module', 'device', 'bits', 'ch', 'mode', 'samples/s',
+                 'cpu[us]', 'wrk[us]', 'lat[ms]', 'ts[us]', 'jit50[us]',
+                 'jit99[us]', 'bus', 'bus[us]', 'errors'))
+    print(header)
+    print('-' * len(header))
+    for module, device, resolution, channels, mode in SCENARIOS:
+        if module == 'i2c_adc':
+            res = bench_i2c_adc(options, device, resolution, channels, mode)
+        else:
+            res = bench_mcp342x(options, device, resolution)
+        print("%-8s %-8s %4d %3d %-7s %8.1f %8.1f %8.1f %9.3f %8.1f %9.1f"
+              " %9.1f %5.0f%% %7.1f %6d"
+              % (module, device, resolution, channels, mode, res['sps'],
+                 res['cpu_us'], res['worker_us'], res['latency_ms'],
+                 res['ts_err_us'],
+                 res['jitter_p50_us'], res['jitter_p99_us'],
+                 res['bus_util'] * 100., res['bus_us'], res['errors']))
+    res = bench_startup(options, options.chips)
+    print("\nstartup: %d chips configured in %.1fms"
+          % (res['configured'], res['connect_time'] * 1000.))
+
+if __name__ == '__main__':
+    main()
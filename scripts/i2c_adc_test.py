@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# Regression tests for i2c_adc.py and mcp342x.py
+#
+# Copyright (C) 2021 Dawid Murawski <dawid.m@gmx.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Runs the modules on the simulated chips, bus and reactor of
+# i2c_adc_bench.py. Run with pytest or directly:
+#
+#   python3 scripts/i2c_adc_test.py
+import sys, os, random, tempfile, time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import i2c_adc_bench as bench
+
+
+######################################################################
+# Helpers
+######################################################################
+
+def step_inputs(values, new_values, step_time):
+    return [lambda t, a=a, b=b: a if t < step_time else b
+            for a, b in zip(values, new_values)]
+
+def collect_readings(stream):
+    # Subscribe to every channel, returns {channel: [(time, volt)]}
+    readings = {}
+    for channel in stream.channels:
+        samples = readings[channel] = []
+        stream.subscribe(channel, samples.extend)
+    return readings
+
+def setup_ads1015(speed, inputs, channels, **options):
+    setup = bench.SimSetup(speed)
+    chip = bench.SimADS101x(None, inputs)
+    section = {'sensor_ID': 'ADS1015', 'i2c_address': '72',
+               'i2c_speed': str(speed), 'rate': '3300', 'channel': '5'}
+    section.update(options)
+    obj = setup.add_section('i2c_adc test', section, chip)
+    for i in range(channels):
+        pin = 'test:' if not i else 'test:ch%d' % (5 + i,)
+        setup.setup_pin(pin).setup_adc_callback(
+            .1, lambda read_time, read_value: None)
+    return setup, chip, obj
+
+
+######################################################################
+# Tests
+######################################################################
+
+def check_scan_step(speed):
+    # Step the inputs of a 4 channel scan: every channel reads its own
+    # input, and the first reading converted after the step has the
+    # new value
+    old, new = [.3, .6, .9, 1.2], [1.5, .2, .7, .4]
+    setup, chip, obj = setup_ads1015(speed, [], 4)
+    setup.connect()
+    step = setup.reactor.now + .5
+    chip.inputs[:] = step_inputs(old, new, step)
+    readings = collect_readings(obj.stream)
+    setup.run(1.)
+    period = 1. / 3300
+    for i, channel in enumerate(sorted(readings)):
+        samples = readings[channel]
+        assert len(samples) > 50, (channel, len(samples))
+        for rTime, rVolt in samples:
+            expect = old[i] if rTime < step + period else new[i]
+            if abs(rTime - step - .5 * period) < period:
+                # Conversion spans the step
+                continue
+            assert abs(rVolt - expect) < .005, (speed, channel, rTime,
+                                                rVolt, expect)
+
+def test_scan_step_100k():
+    check_scan_step(100000)
+
+def test_scan_step_400k():
+    check_scan_step(400000)
+
+def test_ads_gain_scale():
+    # Readings of a 3/4 full scale input at every ADS PGA gain
+    fsr = {0.25: 6.144, 0.5: 4.096, 1: 2.048, 2: 1.024, 4: .512, 8: .256}
+    for gain, full_scale in sorted(fsr.items()):
+        volts = .75 * full_scale
+        setup, chip, obj = setup_ads1015(
+            100000, bench.constant_inputs((volts,)), 1, gain=str(gain))
+        setup.connect()
+        readings = collect_readings(obj.stream)
+        setup.run(.3)
+        samples = list(readings.values())[0]
+        assert samples, gain
+        for rTime, rVolt in samples:
+            assert abs(rVolt - volts) < full_scale / 1024., (
+                gain, rVolt, volts)
+
+def test_remove_stream_in_step():
+    # A stream removed (or restarted) by its own step is not stepped
+    # again from the entry of that step
+    for restart in (False, True):
+        setup, chip, obj = setup_ads1015(400000, bench.constant_inputs(),
+                                         1)
+        setup.connect()
+        stream = obj.stream
+        arbiter = stream.arbiter
+        setup.run(.1)
+        steps = [0]
+        step = stream.step
+        def removing_step(eventtime):
+            steps[0] += 1
+            if steps[0] > 1:
+                return step(eventtime)
+            if restart:
+                stream.set_rate(stream.resolution, stream.rate)
+            else:
+                arbiter.remove_stream(stream)
+            # Due again right away, as after a failed step
+            return eventtime
+        stream.step = removing_step
+        setup.run(.1)
+        entries = [e for e in arbiter.schedule if e[2] is stream]
+        if restart:
+            assert len(entries) == 1, entries
+            assert steps[0] > 100, steps
+        else:
+            assert not entries and steps[0] == 1, (entries, steps)
+
+def check_ready_mode(rate):
+    # Button polling is slower than a fast conversion: the stream
+    # must keep reading without counting the conversions as lost
+    setup, chip, obj = setup_ads1015(100000, bench.constant_inputs(), 1,
+                                     rate=str(rate), ready_pin='^gpio17')
+    setup.connect()
+    setup.printer.lookup_object('buttons').connect_pin(
+        '^gpio17', chip.ready_level)
+    readings = collect_readings(obj.stream)
+    setup.run(1.)
+    samples = list(readings.values())[0]
+    stats = obj.stream.stats
+    assert len(samples) > 200, (rate, len(samples))
+    assert stats.ready_misses == 0, (rate, stats.ready_misses)
+    assert all(abs(rVolt - .3) < .002 for rTime, rVolt in samples)
+
+def test_ready_mode_1600():
+    check_ready_mode(1600)
+
+def test_ready_mode_3300():
+    check_ready_mode(3300)
+
+def test_lost_reads():
+    # Reads that fail or lose their response on a bad bus only cost
+    # the reads in flight, not a stalled stream
+    random.seed(0)
+    setup, chip, obj = setup_ads1015(100000, bench.constant_inputs(), 1)
+    setup.bus.error_rate = .05
+    setup.connect()
+    readings = collect_readings(obj.stream)
+    setup.run(1.)
+    samples = list(readings.values())[0]
+    stats = obj.stream.stats
+    assert stats.timeouts > 10, stats.timeouts
+    assert len(samples) > 2000, len(samples)
+    assert all(abs(rVolt - .3) < .002 for rTime, rVolt in samples)
+
+def test_mcu_overflows():
+    # Conversions the MCU skipped show up as overruns
+    setup, chip, obj = setup_ads1015(400000, bench.constant_inputs(), 1,
+                                     mcu_sampling='True')
+    setup.connect()
+    setup.run(.5)
+    stream = obj.stream
+    assert stream.stats.overruns == 0
+    setup.mcu.bulk[stream.bulk_oid]['state']['overflows'] += 5
+    setup.run(1.5)
+    assert stream.stats.overruns == 5, stream.stats.overruns
+
+def test_mcp_mcu_sampling():
+    # MCP342x frames carry the config byte, a 12 bit bulk message still
+    # fits the MCU buffer
+    setup = bench.SimSetup()
+    chip = bench.SimMCP342x(None, bench.constant_inputs())
+    obj = setup.add_section('i2c_adc test', {
+        'sensor_ID': 'MCP3424', 'i2c_address': '104', 'resolution': '12',
+        'mcu_sampling': 'True'}, chip)
+    setup.setup_pin('test:').setup_adc_callback(
+        .1, lambda read_time, read_value: None)
+    setup.connect()
+    readings = collect_readings(obj.stream)
+    setup.run(1.)
+    samples = list(readings.values())[0]
+    assert len(samples) > 150, len(samples)
+    assert all(abs(rVolt - .3) < .002 for rTime, rVolt in samples)
+    assert obj.stream.stats.errors == 0
+
+def test_mcp_stale_single():
+    # A single channel polled faster than its slow chip converts: reads
+    # of a conversion read before are dropped, at every resolution
+    for resolution in (12, 18):
+        setup = bench.SimSetup()
+        chip = bench.SimMCP342x(None, [], drift=-.1)
+        obj = setup.add_section('i2c_adc test', {
+            'sensor_ID': 'MCP3424', 'i2c_address': '104',
+            'resolution': str(resolution)}, chip)
+        setup.setup_pin('test:').setup_adc_callback(
+            .1, lambda read_time, read_value: None)
+        setup.connect()
+        start = setup.reactor.now
+        chip.inputs[:] = [lambda t: .5 * (t - start)] * 4
+        readings = collect_readings(obj.stream)
+        setup.run(2.)
+        stream = obj.stream
+        volts = [rVolt for rTime, rVolt in list(readings.values())[0]]
+        assert len(volts) > 2, (resolution, volts)
+        assert all(b > a for a, b in zip(volts, volts[1:])), (
+            resolution, volts)
+        assert stream.stats.stale > 0 and stream.stats.errors == 0, (
+            resolution, stream.stats.get_status())
+
+def test_mcp_single_timestamps():
+    # A single channel stamps the conversion ends of a chip running
+    # off its nominal data rate, stale reads keep the count in phase.
+    # The input is a 10 V/s sawtooth, so the value of a reading also
+    # tells when its conversion ended, without the chip's read_times.
+    period, slope = .15, 10.
+    sawtooth = [lambda t: slope * (t % period)] * 4
+    for drift in (-.05, .05):
+        setup = bench.SimSetup()
+        chip = bench.SimMCP342x(None, sawtooth, drift=drift)
+        obj = setup.add_section('i2c_adc test', {
+            'sensor_ID': 'MCP3424', 'i2c_address': '104'}, chip)
+        setup.setup_pin('test:').setup_adc_callback(
+            .1, lambda read_time, read_value: None)
+        setup.connect()
+        readings = collect_readings(obj.stream)
+        setup.run(3.)
+        samples = list(readings.values())[0]
+        times = [rTime for rTime, rVolt in samples]
+        errors = sorted(abs(t - c) for t, c in zip(times, chip.read_times))
+        assert len(errors) > 500, (drift, len(errors))
+        # Half a conversion is 2 ms
+        assert errors[len(errors) // 2] < .0002, (drift, errors)
+        value_errors = []
+        for rTime, rVolt in samples:
+            end = rTime - rTime % period + rVolt / slope
+            value_errors.append(min(abs(end + n * period - rTime)
+                                    for n in (-1, 0, 1)))
+        value_errors.sort()
+        # One LSB is 0.1 ms of the sawtooth
+        assert value_errors[len(value_errors) // 2] < .0002, (
+            drift, value_errors)
+        assert obj.stream.stats.errors == 0
+
+def test_calibrate_rate_change():
+    # A point whose readings span a resolution change (new decoders)
+    setup = bench.SimSetup()
+    chip = bench.SimMCP342x(None, bench.constant_inputs())
+    obj = setup.add_section('i2c_adc test', {
+        'sensor_ID': 'MCP3424', 'i2c_address': '104'}, chip)
+    setup.setup_pin('test:').setup_adc_callback(
+        .1, lambda read_time, read_value: None)
+    setup.connect()
+    setup.run(.1)
+    stream = obj.stream
+    # Most of the 16 readings (240 SPS) are taken at 12 bit
+    setup.reactor.register_callback(
+        lambda e: stream.set_rate(14, 60), setup.reactor.now + .05)
+    gcode = setup.printer.lookup_object('gcode')
+    gcode.run('I2C_ADC_CALIBRATE CHIP=test', VALUE='0.3')
+    assert stream.resolution == 14
+    assert gcode.responses[-1].endswith(
+        'point 1 at gain 1: 0.300000 V -> 0.300000'), gcode.responses
+
+def test_capture_channels():
+    # CHANNEL takes input names and numbers, bad ones are an error
+    setup, chip, obj = setup_ads1015(100000, bench.constant_inputs(), 2)
+    setup.connect()
+    gcode = setup.printer.lookup_object('gcode')
+    tmpdir = tempfile.TemporaryDirectory()
+    filename = os.path.join(tmpdir.name, 'capture.bin')
+    for inputs, captured in (('AIN1', [5]), ('6', [5]),
+                             ('ain0,ch6', [4, 5])):
+        gcode.run('ADC_CAPTURE', CHIP='test', CHANNEL=inputs,
+                  SAMPLES='10', FILE=filename)
+        capture = setup.printer.lookup_object('i2c_adc_capture').last
+        chans = [sorted(s[2]) for s in capture.sources.values()]
+        assert chans == [captured], (inputs, chans)
+        setup.run(.1)
+    for inputs in ('AIN7', '0', 'x'):
+        try:
+            gcode.run('ADC_CAPTURE', CHIP='test', CHANNEL=inputs,
+                      SAMPLES='10', FILE=filename)
+        except bench.SimConfigError as e:
+            assert 'has no input' in str(e), e
+        else:
+            assert False, inputs
+    tmpdir.cleanup()
+
+def test_offload_slow_worker():
+    # Draining and a waiting capture finish while the stream feeds a
+    # worker that falls behind
+    setup, chip, obj = setup_ads1015(100000, bench.constant_inputs(), 4,
+                                     offload='True')
+    setup.modules['i2c_adc_core'].WORKER_RING_SIZE = 64
+    setup.connect()
+    stream = obj.stream
+    process_frames = stream.process_frames
+    def slow_process_frames(*args):
+        time.sleep(.0005)
+        return process_frames(*args)
+    stream.process_frames = slow_process_frames
+    setup.run(.05)
+    worker = setup.printer.lookup_object('i2c_adc_worker')
+    queued = worker.queued
+    worker.drain()
+    assert worker.processed >= queued, (worker.processed, queued)
+    gcode = setup.printer.lookup_object('gcode')
+    tmpdir = tempfile.TemporaryDirectory()
+    gcode.run('ADC_CAPTURE', CHIP='test', SAMPLES='50', WAIT='1',
+              FILE=os.path.join(tmpdir.name, 'capture.bin'))
+    capture = setup.printer.lookup_object('i2c_adc_capture').last
+    assert capture.done and capture.count == 50, capture.get_status()
+    setup.printer.send_event("klippy:disconnect")
+    tmpdir.cleanup()
+
+def test_worker_rounds():
+    # Every worker round reports its own results, also when the reactor
+    # runs them after the next round
+    setup, chip, obj = setup_ads1015(100000, bench.constant_inputs(), 1,
+                                     offload='True')
+    setup.connect()
+    setup.run(.1)
+    worker = setup.printer.lookup_object('i2c_adc_worker')
+    setup.printer.send_event("klippy:disconnect")
+    worker.thread.join()
+    reported = []
+    for i in range(2):
+        obj.stream.dispatch(reported.append, i)
+        worker._round()
+    setup.run(.01)
+    assert reported == [0, 1], reported
+
+def main():
+    tests = [(name, func) for name, func in sorted(globals().items())
+             if name.startswith('test_') and callable(func)]
+    for name, func in tests:
+        func()
+        print("%s: ok" % (name,))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+// Periodic i2c_adc conversion reads on the micro-controller
+//
+// Copyright (C) 2021 Dawid Murawski <dawid.m@gmx.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// Copy to klipper/src/ and add to klipper/src/Makefile:
+//   src-$(CONFIG_WANT_I2C) += sensor_i2c_adc.c
+//
+// The host configures one slot per scanned channel (the config
+// register bytes that select the channel) and may rewrite the slots
+// while sampling is stopped. A timer fires every
+// rest_ticks; the task then reads the conversion register, appends
+// the frame (read_len data bytes followed by the slot index) to the
+// bulk buffer and, when scanning, writes the config of the next slot.
+// Every 'frames' frames the buffer is sent as an i2c_adc_data message
+// carrying the clock of its first frame. A failed read, or a read
+// behind a failed slot write, does not shut the MCU down: its frame is
+// sent with FRAME_ERROR set in the slot index and sampling goes on.
+
+#include <string.h> // memcpy, memset
+#include "basecmd.h" // oid_alloc
+#include "board/irq.h" // irq_disable
+#include "board/misc.h" // timer_read_time
+#include "command.h" // DECL_COMMAND
+#include "sched.h" // DECL_TASK
+#include "i2ccmds.h" // i2cdev_oid_lookup
+
+#define MAX_SLOTS 8
+#define MAX_CONF 3
+#define MAX_REG 2
+#define BULK_SIZE 48
+#define FRAME_ERROR 0x80
+
+struct i2c_adc_slot {
+    uint8_t conf_len;
+    uint8_t conf[MAX_CONF];
+};
+
+struct i2c_adc {
+    struct timer timer;
+    uint32_t rest_ticks, sample_clock, bulk_clock;
+    struct i2cdev_s *i2c;
+    uint8_t flags, read_len, reg_len, slot_count, slot_pos;
+    uint8_t bulk_frames, frame_count, write_error;
+    uint8_t reg[MAX_REG];
+    struct i2c_adc_slot slots[MAX_SLOTS];
+    uint16_t sequence, overflows;
+    uint8_t data_count;
+    uint8_t data[BULK_SIZE];
+};
+
+enum {
+    IA_PENDING = 1<<0,
+};
+
+static struct task_wake i2c_adc_wake;
+
+// Event handler that wakes i2c_adc_task() once per conversion
+static uint_fast8_t
+i2c_adc_event(struct timer *timer)
+{
+    struct i2c_adc *ia = container_of(timer, struct i2c_adc, timer);
+    if (ia->flags & IA_PENDING)
+        ia->overflows++;
+    ia->sample_clock = ia->timer.waketime;
+    ia->flags |= IA_PENDING;
+    sched_wake_task(&i2c_adc_wake);
+    ia->timer.waketime += ia->rest_ticks;
+    return SF_RESCHEDULE;
+}
+
+void
+command_config_i2c_adc(uint32_t *args)
+{
+    struct i2c_adc *ia = oid_alloc(args[0], command_config_i2c_adc
+                                   , sizeof(*ia));
+    ia->timer.func = i2c_adc_event;
+    ia->i2c = i2cdev_oid_lookup(args[1]);
+    ia->read_len = args[2];
+    if (ia->read_len + 1 > BULK_SIZE)
+        shutdown("i2c_adc read_len too large");
+}
+DECL_COMMAND(command_config_i2c_adc
+             , "config_i2c_adc oid=%c i2c_oid=%c read_len=%c");
+
+void
+command_i2c_adc_add_slot(uint32_t *args)
+{
+    struct i2c_adc *ia = oid_lookup(args[0], command_config_i2c_adc);
+    uint8_t conf_len = args[1];
+    uint8_t *conf = command_decode_ptr(args[2]);
+    if (ia->slot_count >= MAX_SLOTS || conf_len > MAX_CONF)
+        shutdown("Invalid i2c_adc slot");
+    struct i2c_adc_slot *slot = &ia->slots[ia->slot_count++];
+    slot->conf_len = conf_len;
+    memcpy(slot->conf, conf, conf_len);
+}
+DECL_COMMAND(command_i2c_adc_add_slot, "i2c_adc_add_slot oid=%c conf=%*s");
+
+void
+command_i2c_adc_set_slot(uint32_t *args)
+{
+    struct i2c_adc *ia = oid_lookup(args[0], command_config_i2c_adc);
+    uint8_t pos = args[1], conf_len = args[2];
+    uint8_t *conf = command_decode_ptr(args[3]);
+    if (pos >= ia->slot_count || conf_len > MAX_CONF)
+        shutdown("Invalid i2c_adc slot");
+    struct i2c_adc_slot *slot = &ia->slots[pos];
+    slot->conf_len = conf_len;
+    memcpy(slot->conf, conf, conf_len);
+}
+DECL_COMMAND(command_i2c_adc_set_slot
+             , "i2c_adc_set_slot oid=%c slot=%c conf=%*s");
+
+// Send the frames collected so far
+static void
+i2c_adc_report(struct i2c_adc *ia, uint8_t oid)
+{
+    sendf("i2c_adc_data oid=%c sequence=%hu clock=%u data=%*s"
+          , oid, ia->sequence, ia->bulk_clock, ia->data_count, ia->data);
+    ia->data_count = 0;
+    ia->frame_count = 0;
+    ia->sequence++;
+}
+
+void
+command_query_i2c_adc(uint32_t *args)
+{
+    struct i2c_adc *ia = oid_lookup(args[0], command_config_i2c_adc);
+    sched_del_timer(&ia->timer);
+    ia->flags = 0;
+    ia->data_count = 0;
+    ia->frame_count = 0;
+    ia->sequence = 0;
+    ia->overflows = 0;
+    ia->slot_pos = 0;
+    ia->write_error = 0;
+    uint8_t reg_len = args[2];
+    if (reg_len > MAX_REG)
+        shutdown("Invalid i2c_adc reg");
+    ia->reg_len = reg_len;
+    memcpy(ia->reg, command_decode_ptr(args[3]), reg_len);
+    ia->bulk_frames = args[4];
+    if (ia->bulk_frames * (ia->read_len + 1) > BULK_SIZE)
+        shutdown("Invalid i2c_adc frames");
+    ia->rest_ticks = args[1];
+    if (!ia->rest_ticks)
+        // End measurements
+        return;
+    // Start new measurements
+    irq_disable();
+    ia->timer.waketime = timer_read_time() + ia->rest_ticks;
+    sched_add_timer(&ia->timer);
+    irq_enable();
+}
+DECL_COMMAND(command_query_i2c_adc
+             , "query_i2c_adc oid=%c rest_ticks=%u reg=%*s frames=%c");
+
+void
+command_query_i2c_adc_status(uint32_t *args)
+{
+    struct i2c_adc *ia = oid_lookup(args[0], command_config_i2c_adc);
+    sendf("i2c_adc_status oid=%c sequence=%hu overflows=%hu"
+          , args[0], ia->sequence, ia->overflows);
+}
+DECL_COMMAND(command_query_i2c_adc_status
+             , "query_i2c_adc_status oid=%c");
+
+// Read one conversion and switch to the next slot
+static void
+i2c_adc_sample(struct i2c_adc *ia, uint8_t oid)
+{
+    irq_disable();
+    uint32_t sample_clock = ia->sample_clock;
+    ia->flags &= ~IA_PENDING;
+    irq_enable();
+    if (!ia->data_count)
+        ia->bulk_clock = sample_clock;
+    uint8_t *frame = &ia->data[ia->data_count];
+    int ret = i2c_dev_read(ia->i2c, ia->reg_len, ia->reg, ia->read_len
+                           , frame);
+    frame[ia->read_len] = ia->slot_pos;
+    if (ret != I2C_BUS_SUCCESS || ia->write_error) {
+        memset(frame, 0, ia->read_len);
+        frame[ia->read_len] |= FRAME_ERROR;
+    }
+    ia->write_error = 0;
+    ia->data_count += ia->read_len + 1;
+    if (++ia->frame_count >= ia->bulk_frames)
+        i2c_adc_report(ia, oid);
+    if (ia->slot_count > 1) {
+        if (++ia->slot_pos >= ia->slot_count)
+            ia->slot_pos = 0;
+        struct i2c_adc_slot *slot = &ia->slots[ia->slot_pos];
+        ret = i2c_dev_write(ia->i2c, slot->conf_len, slot->conf);
+        ia->write_error = ret != I2C_BUS_SUCCESS;
+    }
+}
+
+void
+i2c_adc_task(void)
+{
+    if (!sched_check_wake(&i2c_adc_wake))
+        return;
+    uint8_t oid;
+    struct i2c_adc *ia;
+    foreach_oid(oid, ia, command_config_i2c_adc) {
+        if (ia->flags & IA_PENDING)
+            i2c_adc_sample(ia, oid);
+    }
+}
+DECL_TASK(i2c_adc_task);